@@ -0,0 +1,374 @@
+"""
+Local stand-in of OpenAI HTTP API for benchmarks and manual testing.
+
+Implements endpoints used by aigrammy: chat completions (with streaming), embeddings, threads, messages, runs,
+files and batches.
+Latency, streaming speed and `429 Too Many Requests` injection are configurable.
+
+Run standalone: `python -m benchmarks.fake_openai --port 8080 --latency 0.5`
+"""
+import argparse
+import asyncio
+import hashlib
+import json
+import math
+import random
+import time
+import uuid
+
+from aiohttp import web
+
+ANSWER = "This is a fake answer of local OpenAI stand-in. " * 4
+
+
+class FakeOpenAI:
+    def __init__(self,
+                 latency: float = 0.2,
+                 chunk_delay: float = 0.01,
+                 rate_limit_ratio: float = 0.0,
+                 answer: str = ANSWER):
+        """
+        :param latency: delay before answer (or before first streamed chunk) in seconds
+        :param chunk_delay: delay between streamed chunks in seconds
+        :param rate_limit_ratio: share of requests answered with `429`, from 0 to 1
+        :param answer: text of every answer
+        """
+        self.latency = latency
+        self.chunk_delay = chunk_delay
+        self.rate_limit_ratio = rate_limit_ratio
+        self.answer = answer
+        self.requests = 0
+        self.rate_limited = 0
+        self.threads: dict[str, list[dict]] = {}
+        self.runs: dict[str, dict] = {}
+        self.files: dict[str, bytes] = {}
+        self.batches: dict[str, dict] = {}
+        self.prefixes: set[str] = set()  # system messages seen before, served from simulated prompt cache
+
+    def app(self) -> web.Application:
+        app = web.Application(client_max_size=64 * 1024 * 1024)
+        app.router.add_post("/v1/chat/completions", self.chat_completions)
+        app.router.add_post("/v1/embeddings", self.embeddings)
+        app.router.add_post("/v1/threads", self.create_thread)
+        app.router.add_post("/v1/threads/{thread_id}/messages", self.create_message)
+        app.router.add_get("/v1/threads/{thread_id}/messages", self.list_messages)
+        app.router.add_post("/v1/threads/{thread_id}/runs", self.create_run)
+        app.router.add_get("/v1/threads/{thread_id}/runs/{run_id}", self.retrieve_run)
+        app.router.add_post("/v1/threads/{thread_id}/runs/{run_id}/cancel", self.cancel_run)
+        app.router.add_post("/v1/files", self.create_file)
+        app.router.add_get("/v1/files/{file_id}/content", self.file_content)
+        app.router.add_post("/v1/batches", self.create_batch)
+        app.router.add_get("/v1/batches/{batch_id}", self.retrieve_batch)
+        app.router.add_post("/v1/batches/{batch_id}/cancel", self.cancel_batch)
+        return app
+
+    async def start(self, host: str = "127.0.0.1", port: int = 0) -> tuple[web.AppRunner, str]:
+        """ Starts server in current event loop, returns runner and base url for `AsyncOpenAI(base_url=...)` """
+        runner = web.AppRunner(self.app())
+        await runner.setup()
+        site = web.TCPSite(runner, host, port)
+        await site.start()
+        port = site._server.sockets[0].getsockname()[1]
+        return runner, f"http://{host}:{port}/v1"
+
+    # region: chat completions
+    async def chat_completions(self, request: web.Request) -> web.StreamResponse:
+        self.requests += 1
+        if random.random() < self.rate_limit_ratio:
+            self.rate_limited += 1
+            return self._rate_limited()
+
+        body = await request.json()
+        prompt_tokens = len(json.dumps(body["messages"])) // 4
+        completion_tokens = len(self.answer) // 4
+        cached_tokens = self._cached_tokens(body["messages"], prompt_tokens)
+        if body.get("stream"):
+            return await self._stream_completion(request, body, prompt_tokens, completion_tokens, cached_tokens)
+
+        await asyncio.sleep(self.latency)
+        return web.json_response(self._completion(body["model"], prompt_tokens, completion_tokens, cached_tokens),
+                                 headers=self._rate_limit_headers())
+
+    def _completion(self, model: str, prompt_tokens: int, completion_tokens: int, cached_tokens: int) -> dict:
+        return {
+            "id": f"chatcmpl-{uuid.uuid4().hex}",
+            "object": "chat.completion",
+            "created": int(time.time()),
+            "model": model,
+            "choices": [{
+                "index": 0,
+                "message": {"role": "assistant", "content": self.answer},
+                "finish_reason": "stop",
+                "logprobs": None,
+            }],
+            "usage": self._usage(prompt_tokens, completion_tokens, cached_tokens),
+        }
+
+    async def _stream_completion(self, request: web.Request, body: dict,
+                                 prompt_tokens: int, completion_tokens: int, cached_tokens: int) -> web.StreamResponse:
+        response = web.StreamResponse(headers={"Content-Type": "text/event-stream", **self._rate_limit_headers()})
+        await response.prepare(request)
+        await asyncio.sleep(self.latency)
+
+        completion_id = f"chatcmpl-{uuid.uuid4().hex}"
+        words = self.answer.split(" ")
+        for index, word in enumerate(words):
+            last = index == len(words) - 1
+            await self._send_chunk(response, completion_id, body["model"], [{
+                "index": 0,
+                "delta": {"content": word if last else word + " "},
+                "finish_reason": "stop" if last else None,
+            }])
+            await asyncio.sleep(self.chunk_delay)
+
+        if body.get("stream_options", {}).get("include_usage"):
+            await self._send_chunk(response, completion_id, body["model"], [],
+                                   usage=self._usage(prompt_tokens, completion_tokens, cached_tokens))
+        await response.write(b"data: [DONE]\n\n")
+        await response.write_eof()
+        return response
+
+    def _cached_tokens(self, messages: list, prompt_tokens: int) -> int:
+        """ Like OpenAI, caches prompts of 1024+ tokens in increments of 128, here only by the first message """
+        prefix = json.dumps(messages[0])
+        if prompt_tokens < 1024 or prefix not in self.prefixes:
+            self.prefixes.add(prefix)
+            return 0
+        return min(len(prefix) // 4, prompt_tokens) // 128 * 128
+
+    @staticmethod
+    async def _send_chunk(response: web.StreamResponse, completion_id: str, model: str,
+                          choices: list, usage: dict | None = None) -> None:
+        chunk = {
+            "id": completion_id,
+            "object": "chat.completion.chunk",
+            "created": int(time.time()),
+            "model": model,
+            "choices": choices,
+            "usage": usage,
+        }
+        await response.write(f"data: {json.dumps(chunk)}\n\n".encode())
+    # endregion
+
+    async def embeddings(self, request: web.Request) -> web.Response:
+        """ Bag of hashed words, so texts with the same words are similar regardless of their order """
+        self.requests += 1
+        body = await request.json()
+        inputs = body["input"] if isinstance(body["input"], list) else [body["input"]]
+        dimensions = body.get("dimensions") or 64
+        data = []
+        for index, text in enumerate(inputs):
+            vector = [0.0] * dimensions
+            for word in text.lower().split():
+                digest = hashlib.md5(word.strip("?!.,").encode()).digest()
+                vector[int.from_bytes(digest[:4], "little") % dimensions] += 1.0
+            norm = math.sqrt(sum(value * value for value in vector)) or 1.0
+            data.append({"object": "embedding", "index": index, "embedding": [value / norm for value in vector]})
+        tokens = sum(len(text) // 4 for text in inputs)
+        return web.json_response({"object": "list", "data": data, "model": body["model"],
+                                  "usage": {"prompt_tokens": tokens, "total_tokens": tokens}})
+
+    # region: assistants
+    async def create_thread(self, request: web.Request) -> web.Response:
+        thread_id = f"thread_{uuid.uuid4().hex}"
+        self.threads[thread_id] = []
+        return web.json_response({"id": thread_id, "object": "thread", "created_at": int(time.time()),
+                                  "metadata": {}})
+
+    async def create_message(self, request: web.Request) -> web.Response:
+        thread_id = request.match_info["thread_id"]
+        body = await request.json()
+        message = self._message(thread_id, body["role"], body["content"])
+        self.threads.setdefault(thread_id, []).append(message)
+        return web.json_response(message)
+
+    async def list_messages(self, request: web.Request) -> web.Response:
+        thread_id = request.match_info["thread_id"]
+        messages = self.threads.get(thread_id, [])
+        run_id = request.query.get("run_id")
+        if run_id:
+            messages = [message for message in messages if message["run_id"] == run_id]
+        return web.json_response({"object": "list", "data": messages, "has_more": False,
+                                  "first_id": None, "last_id": None})
+
+    async def create_run(self, request: web.Request) -> web.Response:
+        self.requests += 1
+        if random.random() < self.rate_limit_ratio:
+            self.rate_limited += 1
+            return self._rate_limited()
+
+        thread_id = request.match_info["thread_id"]
+        body = await request.json()
+        run = {
+            "id": f"run_{uuid.uuid4().hex}",
+            "object": "thread.run",
+            "created_at": int(time.time()),
+            "thread_id": thread_id,
+            "assistant_id": body.get("assistant_id"),
+            "status": "in_progress",
+            "model": "gpt-4o",
+            "instructions": body.get("instructions") or "",
+            "tools": [],
+            "usage": None,
+            "incomplete_details": None,
+            "_finishes_at": time.monotonic() + self.latency,
+        }
+        self.runs[run["id"]] = run
+        return web.json_response(self._public_run(run))
+
+    async def retrieve_run(self, request: web.Request) -> web.Response:
+        run = self.runs[request.match_info["run_id"]]
+        if run["status"] == "in_progress" and time.monotonic() >= run["_finishes_at"]:
+            run["status"] = "completed"
+            run["usage"] = self._usage(100, len(self.answer) // 4)
+            message = self._message(run["thread_id"], "assistant", self.answer, run_id=run["id"])
+            self.threads.setdefault(run["thread_id"], []).append(message)
+        return web.json_response(self._public_run(run))
+
+    async def cancel_run(self, request: web.Request) -> web.Response:
+        run = self.runs[request.match_info["run_id"]]
+        if run["status"] == "in_progress":
+            run["status"] = "cancelled"
+        return web.json_response(self._public_run(run))
+
+    @staticmethod
+    def _public_run(run: dict) -> dict:
+        return {key: value for key, value in run.items() if not key.startswith("_")}
+
+    @staticmethod
+    def _message(thread_id: str, role: str, content, run_id: str | None = None) -> dict:
+        if isinstance(content, str):
+            content = [{"type": "text", "text": {"value": content, "annotations": []}}]
+        return {
+            "id": f"msg_{uuid.uuid4().hex}",
+            "object": "thread.message",
+            "created_at": int(time.time()),
+            "thread_id": thread_id,
+            "role": role,
+            "content": content,
+            "run_id": run_id,
+            "assistant_id": None,
+            "attachments": [],
+            "metadata": {},
+        }
+    # endregion
+
+    async def create_file(self, request: web.Request) -> web.Response:
+        form = await request.post()
+        upload = form["file"]
+        data = upload.file.read()
+        file_id = f"file-{uuid.uuid4().hex}"
+        self.files[file_id] = data
+        return web.json_response({"id": file_id, "object": "file", "bytes": len(data),
+                                  "created_at": int(time.time()), "filename": upload.filename,
+                                  "purpose": form.get("purpose", "")})
+
+    async def file_content(self, request: web.Request) -> web.Response:
+        file_id = request.match_info["file_id"]
+        if file_id not in self.files:
+            return web.json_response({"error": {"message": f"No such File object: {file_id}"}}, status=404)
+        return web.Response(body=self.files[file_id], content_type="application/octet-stream")
+
+    # region: batches
+    async def create_batch(self, request: web.Request) -> web.Response:
+        body = await request.json()
+        batch = {
+            "id": f"batch_{uuid.uuid4().hex}",
+            "object": "batch",
+            "endpoint": body["endpoint"],
+            "input_file_id": body["input_file_id"],
+            "completion_window": body["completion_window"],
+            "status": "in_progress",
+            "output_file_id": None,
+            "error_file_id": None,
+            "created_at": int(time.time()),
+            "request_counts": {"total": 0, "completed": 0, "failed": 0},
+            "metadata": body.get("metadata"),
+            "_finishes_at": time.monotonic() + self.latency,
+        }
+        self.batches[batch["id"]] = batch
+        return web.json_response(self._public_run(batch))
+
+    async def retrieve_batch(self, request: web.Request) -> web.Response:
+        batch = self.batches[request.match_info["batch_id"]]
+        if batch["status"] == "in_progress" and time.monotonic() >= batch["_finishes_at"]:
+            self._complete_batch(batch, "completed")
+        return web.json_response(self._public_run(batch))
+
+    async def cancel_batch(self, request: web.Request) -> web.Response:
+        batch = self.batches[request.match_info["batch_id"]]
+        if batch["status"] == "in_progress":
+            self._complete_batch(batch, "cancelled", limit=0)
+        return web.json_response(self._public_run(batch))
+
+    def _complete_batch(self, batch: dict, status: str, limit: int | None = None) -> None:
+        """ Answers requests of batch, `limit` of them if it was cancelled. Requests with `max_tokens < 1` fail """
+        lines = self.files[batch["input_file_id"]].splitlines()[:limit]
+        outputs, errors = [], []
+        for line in lines:
+            self.requests += 1
+            request = json.loads(line)
+            body = request["body"]
+            result = {"id": f"batch_req_{uuid.uuid4().hex}", "custom_id": request["custom_id"], "error": None}
+            if body.get("max_tokens", 1) < 1:
+                result["response"] = {"status_code": 400, "request_id": uuid.uuid4().hex, "body": {"error": {
+                    "message": "max_tokens must be at least 1", "type": "invalid_request_error"}}}
+                errors.append(result)
+                continue
+            prompt_tokens = len(json.dumps(body["messages"])) // 4
+            completion = self._completion(body["model"], prompt_tokens, len(self.answer) // 4,
+                                          self._cached_tokens(body["messages"], prompt_tokens))
+            result["response"] = {"status_code": 200, "request_id": uuid.uuid4().hex, "body": completion}
+            outputs.append(result)
+
+        for key, results in (("output_file_id", outputs), ("error_file_id", errors)):
+            if results:
+                file_id = f"file-{uuid.uuid4().hex}"
+                self.files[file_id] = "".join(json.dumps(result) + "\n" for result in results).encode()
+                batch[key] = file_id
+        batch["status"] = status
+        batch["request_counts"] = {"total": len(lines), "completed": len(outputs), "failed": len(errors)}
+    # endregion
+
+    @staticmethod
+    def _usage(prompt_tokens: int, completion_tokens: int, cached_tokens: int = 0) -> dict:
+        return {"prompt_tokens": prompt_tokens, "completion_tokens": completion_tokens,
+                "total_tokens": prompt_tokens + completion_tokens,
+                "prompt_tokens_details": {"cached_tokens": cached_tokens}}
+
+    @staticmethod
+    def _rate_limit_headers() -> dict:
+        return {
+            "x-ratelimit-limit-requests": "10000",
+            "x-ratelimit-remaining-requests": "9999",
+            "x-ratelimit-reset-requests": "6ms",
+            "x-ratelimit-limit-tokens": "2000000",
+            "x-ratelimit-remaining-tokens": "1999000",
+            "x-ratelimit-reset-tokens": "30ms",
+        }
+
+    @staticmethod
+    def _rate_limited() -> web.Response:
+        return web.json_response(
+            {"error": {"message": "Rate limit reached (fake)", "type": "requests", "code": "rate_limit_exceeded"}},
+            status=429,
+            headers={"retry-after-ms": "200", "x-ratelimit-remaining-requests": "0",
+                     "x-ratelimit-reset-requests": "200ms"},
+        )
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Local stand-in of OpenAI API")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8080)
+    parser.add_argument("--latency", type=float, default=0.2)
+    parser.add_argument("--chunk-delay", type=float, default=0.01)
+    parser.add_argument("--rate-limit-ratio", type=float, default=0.0)
+    args = parser.parse_args()
+
+    fake = FakeOpenAI(latency=args.latency, chunk_delay=args.chunk_delay, rate_limit_ratio=args.rate_limit_ratio)
+    web.run_app(fake.app(), host=args.host, port=args.port)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,118 @@
+"""
+Local stand-in of Redis server for benchmarks and manual testing of `aigrammy.state.RedisStateBackend`.
+
+Implements commands used by aigrammy: PING, AUTH, SELECT, GET, MGET, SET (with PX, EX, NX), DEL, INCRBY, PEXPIRE.
+
+Run standalone: `python -m benchmarks.fake_redis --port 6379`
+"""
+import argparse
+import asyncio
+import time
+
+
+class FakeRedis:
+    def __init__(self):
+        self.data: dict[bytes, tuple[bytes, float]] = {}
+        self.commands = 0
+
+    async def start(self, host: str = "127.0.0.1", port: int = 0) -> tuple[asyncio.AbstractServer, int]:
+        """ Starts server in current event loop, returns server and its port """
+        server = await asyncio.start_server(self._serve, host, port)
+        return server, server.sockets[0].getsockname()[1]
+
+    async def _serve(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        try:
+            while True:
+                command = await self._read_command(reader)
+                self.commands += 1
+                writer.write(self._execute(command))
+                if not reader._buffer:  # replies of pipelined commands are flushed together
+                    await writer.drain()
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+
+    @staticmethod
+    async def _read_command(reader: asyncio.StreamReader) -> list[bytes]:
+        line = await reader.readuntil(b"\r\n")
+        count = int(line[1:-2])
+        arguments = []
+        for _ in range(count):
+            length = int((await reader.readuntil(b"\r\n"))[1:-2])
+            arguments.append((await reader.readexactly(length + 2))[:-2])
+        return arguments
+
+    def _execute(self, command: list[bytes]) -> bytes:
+        name, arguments = command[0].upper(), command[1:]
+        if name in (b"PING", b"AUTH", b"SELECT"):
+            return b"+OK\r\n" if name != b"PING" else b"+PONG\r\n"
+        if name == b"GET":
+            return _bulk(self._get(arguments[0]))
+        if name == b"MGET":
+            return b"*%d\r\n" % len(arguments) + b"".join(_bulk(self._get(key)) for key in arguments)
+        if name == b"SET":
+            return self._set(arguments)
+        if name == b"DEL":
+            return b":%d\r\n" % sum(self.data.pop(key, None) is not None for key in arguments)
+        if name == b"INCRBY":
+            key = arguments[0]
+            try:
+                value = int(self._get(key) or 0) + int(arguments[1])
+            except ValueError:
+                return b"-ERR value is not an integer or out of range\r\n"
+            expires_at = self.data[key][1] if key in self.data else float("inf")
+            self.data[key] = (str(value).encode(), expires_at)
+            return b":%d\r\n" % value
+        if name == b"PEXPIRE":
+            key = arguments[0]
+            if self._get(key) is None:
+                return b":0\r\n"
+            self.data[key] = (self.data[key][0], time.time() + int(arguments[1]) / 1000)
+            return b":1\r\n"
+        return b"-ERR unknown command '%s'\r\n" % name
+
+    def _get(self, key: bytes) -> bytes | None:
+        item = self.data.get(key)
+        if item is None:
+            return None
+        if item[1] < time.time():
+            del self.data[key]
+            return None
+        return item[0]
+
+    def _set(self, arguments: list[bytes]) -> bytes:
+        key, value, options = arguments[0], arguments[1], [option.upper() for option in arguments[2:]]
+        expires_at = float("inf")
+        if b"PX" in options:
+            expires_at = time.time() + int(options[options.index(b"PX") + 1]) / 1000
+        elif b"EX" in options:
+            expires_at = time.time() + int(options[options.index(b"EX") + 1])
+        if b"NX" in options and self._get(key) is not None:
+            return b"$-1\r\n"
+        self.data[key] = (value, expires_at)
+        return b"+OK\r\n"
+
+
+def _bulk(value: bytes | None) -> bytes:
+    if value is None:
+        return b"$-1\r\n"
+    return b"$%d\r\n%s\r\n" % (len(value), value)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Local stand-in of Redis server")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=6379)
+    args = parser.parse_args()
+
+    async def serve() -> None:
+        server, _ = await FakeRedis().start(args.host, args.port)
+        async with server:
+            await server.serve_forever()
+
+    asyncio.run(serve())
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,215 @@
+"""
+Benchmark of aigrammy overhead and behaviour under load, against local stand-in of OpenAI API.
+
+Usage: `PYTHONPATH=src python -m benchmarks.run --scenario text --requests 500 --concurrency 50`
+Reports throughput, p50/p99 latency, event loop blocking time and (with `--memory`) memory per in-flight request.
+"""
+import argparse
+import asyncio
+import io
+import multiprocessing
+import os
+import socket
+import statistics
+import time
+import tracemalloc
+
+from openai import AsyncOpenAI
+
+from aigrammy.imaging import ImagePreprocessor
+from aigrammy.middleware import GptAssistantMiddleware, GptChatCompletionMiddleware
+from aigrammy.types.assistant import GptAssistantRepo
+from aigrammy.types.chat_completion import GptChatCompletionRepo
+
+from .fake_openai import FakeOpenAI
+
+SCENARIOS = ("text", "stream", "image_url", "binaryio", "assistant", "middleware", "assistant_middleware")
+
+
+class LoopLagMonitor:
+    """ Measures how long event loop was blocked, by oversleeping of a periodic task """
+
+    def __init__(self, interval: float = 0.005, threshold: float = 0.002):
+        self.interval = interval
+        self.threshold = threshold
+        self.blocked = 0.0
+        self.max_lag = 0.0
+        self._task: asyncio.Task | None = None
+
+    def start(self) -> None:
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self) -> None:
+        self._task.cancel()
+        await asyncio.gather(self._task, return_exceptions=True)
+
+    async def _run(self) -> None:
+        while True:
+            started = time.perf_counter()
+            await asyncio.sleep(self.interval)
+            lag = time.perf_counter() - started - self.interval
+            self.max_lag = max(self.max_lag, lag)
+            if lag > self.threshold:
+                self.blocked += lag
+
+
+def _serve(port: int, latency: float, chunk_delay: float, rate_limit_ratio: float) -> None:
+    from aiohttp import web
+
+    fake = FakeOpenAI(latency=latency, chunk_delay=chunk_delay, rate_limit_ratio=rate_limit_ratio)
+    web.run_app(fake.app(), host="127.0.0.1", port=port, print=None)
+
+
+def start_server(latency: float, chunk_delay: float, rate_limit_ratio: float) -> tuple[multiprocessing.Process, str]:
+    """ Runs fake server in a separate process, so it does not share event loop with measured code """
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        port = sock.getsockname()[1]
+
+    process = multiprocessing.Process(target=_serve, args=(port, latency, chunk_delay, rate_limit_ratio),
+                                      daemon=True)
+    process.start()
+    deadline = time.monotonic() + 10
+    while time.monotonic() < deadline:
+        try:
+            socket.create_connection(("127.0.0.1", port), timeout=0.1).close()
+            break
+        except OSError:
+            time.sleep(0.05)
+    return process, f"http://127.0.0.1:{port}/v1"
+
+
+def make_image(size: int) -> bytes:
+    try:
+        from PIL import Image
+    except ImportError:
+        return b"\xff\xd8\xff\xe0" + os.urandom(size)
+
+    output = io.BytesIO()
+    Image.effect_noise((3000, 2000), 64).convert("RGB").save(output, format="JPEG", quality=95)
+    return output.getvalue()
+
+
+async def build_call(scenario: str, client: AsyncOpenAI, args: argparse.Namespace):
+    """ Returns coroutine function which performs one request of given scenario """
+    preprocessor = ImagePreprocessor(detail="low") if args.preprocess else None
+    chat = GptChatCompletionRepo(client, model="gpt-4o", system_prompt="Be brief", image_preprocessor=preprocessor)
+    assistant = GptAssistantRepo(client, assistant_id="asst_fake", image_preprocessor=preprocessor)
+    image = make_image(args.image_size)
+
+    async def handler(event, data):
+        if "gpt" in data:
+            return await data["gpt"].ask_text(prompt=f"question {event}")
+        return await data["assistant"].push_prompt_to_thread(content=f"question {event}",
+                                                             thread_id=data["thread_id"])
+
+    if scenario == "text":
+        return lambda i: chat.ask_text(prompt=f"question {i}")
+    if scenario == "stream":
+        return lambda i: chat.stream_text(prompt=f"question {i}").get_response()
+    if scenario == "image_url":
+        return lambda i: chat.ask_telegram_image_url(uri=f"https://example.com/{i}.jpg", content="what is it?")
+    if scenario == "binaryio":
+        return lambda i: chat.ask_from_binaryio_image(io.BytesIO(image), content="what is it?")
+    if scenario == "middleware":
+        middleware = GptChatCompletionMiddleware(chat)
+        return lambda i: middleware(handler, i, {})
+
+    thread_id = (await assistant.create_thread()).id
+    if scenario == "assistant":
+        return lambda i: assistant.push_prompt_to_thread(content=f"question {i}", thread_id=thread_id)
+    if scenario == "assistant_middleware":
+        middleware = GptAssistantMiddleware(assistant)
+        return lambda i: middleware(handler, i, {"thread_id": thread_id})
+    raise ValueError(f"Unknown scenario: {scenario}")
+
+
+async def run_scenario(scenario: str, base_url: str, args: argparse.Namespace) -> dict:
+    client = AsyncOpenAI(api_key="fake", base_url=base_url, max_retries=args.max_retries)
+    call = await build_call(scenario, client, args)
+    await call(-1)  # warm up connection pool
+
+    semaphore = asyncio.Semaphore(args.concurrency)
+    latencies = []
+    errors = 0
+
+    async def one(i: int) -> None:
+        nonlocal errors
+        async with semaphore:
+            started = time.perf_counter()
+            try:
+                await call(i)
+            except Exception:
+                errors += 1
+                return
+            latencies.append(time.perf_counter() - started)
+
+    monitor = LoopLagMonitor()
+    if args.memory:
+        tracemalloc.start()
+    baseline = tracemalloc.get_traced_memory()[0] if args.memory else 0
+
+    monitor.start()
+    started = time.perf_counter()
+    await asyncio.gather(*(one(i) for i in range(args.requests)))
+    elapsed = time.perf_counter() - started
+    await monitor.stop()
+
+    memory = None
+    if args.memory:
+        memory = (tracemalloc.get_traced_memory()[1] - baseline) / args.concurrency
+        tracemalloc.stop()
+    await client.close()
+
+    latencies.sort()
+    return {
+        "scenario": scenario,
+        "requests": args.requests,
+        "errors": errors,
+        "throughput": len(latencies) / elapsed,
+        "p50": statistics.median(latencies) if latencies else float("nan"),
+        "p99": latencies[min(len(latencies) - 1, int(len(latencies) * 0.99))] if latencies else float("nan"),
+        "loop_blocked": monitor.blocked,
+        "max_loop_lag": monitor.max_lag,
+        "memory_per_request": memory,
+    }
+
+
+def print_report(result: dict, server_latency: float) -> None:
+    memory = result["memory_per_request"]
+    memory = f"{memory / 1024:.1f} KiB" if memory is not None else "n/a"
+    print(f"{result['scenario']:<22}"
+          f" rps={result['throughput']:8.1f}"
+          f" p50={result['p50'] * 1000:8.1f}ms"
+          f" p99={result['p99'] * 1000:8.1f}ms"
+          f" overhead_p50={(result['p50'] - server_latency) * 1000:7.1f}ms"
+          f" loop_blocked={result['loop_blocked'] * 1000:7.1f}ms"
+          f" max_lag={result['max_loop_lag'] * 1000:6.1f}ms"
+          f" mem/req={memory}"
+          f" errors={result['errors']}")
+
+
+async def main(args: argparse.Namespace) -> None:
+    process, base_url = start_server(args.latency, args.chunk_delay, args.rate_limit_ratio)
+    try:
+        scenarios = SCENARIOS if args.scenario == "all" else (args.scenario,)
+        for scenario in scenarios:
+            print_report(await run_scenario(scenario, base_url, args), args.latency)
+    finally:
+        process.terminate()
+        process.join()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="aigrammy benchmark against local fake OpenAI server")
+    parser.add_argument("--scenario", choices=SCENARIOS + ("all",), default="all")
+    parser.add_argument("--requests", type=int, default=300)
+    parser.add_argument("--concurrency", type=int, default=50)
+    parser.add_argument("--latency", type=float, default=0.2, help="server latency in seconds")
+    parser.add_argument("--chunk-delay", type=float, default=0.005, help="delay between streamed chunks")
+    parser.add_argument("--rate-limit-ratio", type=float, default=0.0, help="share of requests answered with 429")
+    parser.add_argument("--max-retries", type=int, default=2, help="`max_retries` of `AsyncOpenAI`")
+    parser.add_argument("--image-size", type=int, default=2 * 1024 * 1024, help="size of BinaryIO image")
+    parser.add_argument("--preprocess", action="store_true", help="use `ImagePreprocessor` for images")
+    parser.add_argument("--memory", action="store_true", help="measure memory with tracemalloc (slow)")
+    asyncio.run(main(parser.parse_args()))
@@ -0,0 +1,202 @@
+import asyncio
+import json
+import logging
+import uuid
+from typing import TYPE_CHECKING
+
+from openai import AsyncOpenAI
+
+from .context import record_usage
+from .exceptions import GptBatchException, NoGptPromptSpecifiedException
+from .pool import ClientPool
+from .types.response import GptResponse
+
+if TYPE_CHECKING:
+    from .types.chat_completion import GptChatCompletionRepo
+
+MAX_REQUESTS = 50000  # limit of OpenAI Batch API per batch
+FINAL_STATUSES = ("completed", "failed", "expired", "cancelled")
+
+
+class ChatCompletionBatch:
+    """
+    Requests of `GptChatCompletionRepo` executed by OpenAI Batch API: cheaper, not counted against
+    real-time rate limits, but answered within `completion_window` instead of seconds.\n
+    Requests are accumulated into JSONL file, which is uploaded and submitted by `submit()`. Results are
+    polled in background and streamed from output file into futures returned by `ask_text`.
+    Create it with `GptChatCompletionRepo.batch()`::
+
+        batch = repo.batch()
+        futures = [batch.ask_text(prompt) for prompt in prompts]
+        await batch.submit()
+        responses = await asyncio.gather(*futures, return_exceptions=True)
+    """
+
+    def __init__(self,
+                 repo: "GptChatCompletionRepo",
+                 completion_window: str = "24h",
+                 poll_interval: float = 60.0,
+                 path: str | None = None,
+                 metadata: dict[str, str] | None = None):
+        """
+        :param repo: repo whose model, system prompt, `token_estimator` and `metrics` are used
+        :param completion_window: time in which OpenAI completes batch, only `24h` is supported by now
+        :param poll_interval: seconds between checks of batch status
+        :param path: optional path where submitted JSONL file is kept, e.g. for audit or manual resubmission
+        :param metadata: optional metadata of batch, e.g. `{"job": "nightly-summaries"}`
+        """
+        self.repo = repo
+        self.completion_window = completion_window
+        self.poll_interval = poll_interval
+        self.path = path
+        self.metadata = metadata
+        self.batch_id: str | None = None
+        self.status: str | None = None
+        self._lines: list[bytes] = []
+        self._futures: dict[str, asyncio.Future] = {}
+        self._models: dict[str, str] = {}
+        self._client: AsyncOpenAI | None = None
+        self._poll_task: asyncio.Task | None = None
+
+    def __len__(self) -> int:
+        return len(self._futures)
+
+    def ask_text(self, prompt: str, max_tokens: int = 1000, custom_id: str | None = None) -> asyncio.Future:
+        """
+        Adds prompt to batch, like `GptChatCompletionRepo.ask_text` without history.
+        :param prompt: Given prompt
+        :param max_tokens: Maximum number of tokens which ChatGPT can generate, `default=1000`
+        :param custom_id: optional unique id of request within batch, e.g. id of summarized chat
+
+        :return: Returns future of `GptResponse`, resolved after batch is completed.
+            Failed requests raise `aigrammy.exceptions.GptBatchException`
+        """
+        if not prompt:
+            raise NoGptPromptSpecifiedException("Given prompt is `empty` or `None`!")
+        return self.add_messages(self.repo._text_messages(prompt), max_tokens, custom_id)
+
+    def add_messages(self, messages: list, max_tokens: int = 1000, custom_id: str | None = None) -> asyncio.Future:
+        """ Adds request with prepared messages, including system one, to batch. Returns future of `GptResponse` """
+        if self.batch_id is not None:
+            raise RuntimeError("Batch is already submitted, create a new one with `repo.batch()`")
+        if len(self._futures) >= MAX_REQUESTS:
+            raise ValueError(f"Batch can not contain more than {MAX_REQUESTS} requests")
+        custom_id = custom_id if custom_id is not None else f"request-{len(self._futures)}"
+        if custom_id in self._futures:
+            raise ValueError(f"Request `{custom_id}` is already in batch")
+
+        model = self.repo.model
+        messages, max_tokens, _ = self.repo._fit(model, messages, max_tokens)
+        request = {"custom_id": custom_id, "method": "POST", "url": "/v1/chat/completions",
+                   "body": {"model": model, "messages": messages, "max_tokens": max_tokens}}
+        self._lines.append(json.dumps(request, ensure_ascii=False).encode("utf-8") + b"\n")
+        future = asyncio.get_running_loop().create_future()
+        self._futures[custom_id] = future
+        self._models[custom_id] = model
+        return future
+
+    async def submit(self) -> str:
+        """
+        Uploads JSONL file of requests, creates batch and starts polling of its results.
+        :return: Returns id of batch
+        """
+        if self.batch_id is not None:
+            return self.batch_id
+        if not self._lines:
+            raise ValueError("Batch has no requests")
+
+        data = b"".join(self._lines)
+        self._lines = []
+        if self.path is not None:
+            await asyncio.get_running_loop().run_in_executor(None, _write_file, self.path, data)
+
+        client = self.repo.client
+        # file and batch must belong to one organization, so one member of pool serves the whole batch
+        self._client = client.pick().client if isinstance(client, ClientPool) else client
+        uploaded = await self._client.files.create(file=(f"aigrammy-batch-{uuid.uuid4().hex}.jsonl", data),
+                                                   purpose="batch")
+        batch = await self._client.batches.create(input_file_id=uploaded.id,
+                                                  endpoint="/v1/chat/completions",
+                                                  completion_window=self.completion_window,
+                                                  metadata=self.metadata)
+        self.batch_id, self.status = batch.id, batch.status
+        logging.info(f"aigrammy: submitted batch {batch.id} of {len(self._futures)} requests")
+        self._poll_task = asyncio.create_task(self._poll())
+        return batch.id
+
+    async def wait(self) -> dict[str, GptResponse | GptBatchException]:
+        """
+        Waits for results of submitted batch.
+        :return: Returns mapping of `custom_id` to response, or to exception of failed request
+        """
+        if self._poll_task is None:
+            raise RuntimeError("Batch is not submitted, call `submit()` first")
+        await asyncio.shield(self._poll_task)
+        return {custom_id: future.exception() or future.result()
+                for custom_id, future in self._futures.items() if not future.cancelled()}
+
+    async def cancel(self) -> None:
+        """ Cancels submitted batch. Requests completed before cancellation are still delivered """
+        if self.batch_id is not None and self.status not in FINAL_STATUSES:
+            await self._client.batches.cancel(self.batch_id)
+
+    async def _poll(self) -> None:
+        try:
+            while True:
+                batch = await self._client.batches.retrieve(self.batch_id)
+                self.status = batch.status
+                if batch.status in FINAL_STATUSES:
+                    break
+                await asyncio.sleep(self.poll_interval)
+
+            if batch.output_file_id:
+                await self._read_results(batch.output_file_id)
+            if batch.error_file_id:
+                await self._read_results(batch.error_file_id)
+            self._fail_pending(GptBatchException(f"Batch {self.batch_id} is {batch.status}, request was not executed"))
+        except Exception as e:
+            self._fail_pending(GptBatchException(f"Results of batch {self.batch_id} are lost: {e!r}"))
+            raise e
+
+    async def _read_results(self, file_id: str) -> None:
+        """ Streams result file line by line, so futures are resolved without loading the whole file """
+        async with self._client.files.with_streaming_response.content(file_id) as response:
+            async for line in response.iter_lines():
+                if line:
+                    self._resolve(json.loads(line))
+
+    def _resolve(self, result: dict) -> None:
+        future = self._futures.get(result.get("custom_id"))
+        if future is None or future.done():
+            return
+
+        response = result.get("response") or {}
+        body = response.get("body") or {}
+        if result.get("error") or response.get("status_code") != 200:
+            error = result.get("error") or body.get("error") or {}
+            future.set_exception(GptBatchException(f"Request `{result['custom_id']}` of batch {self.batch_id} "
+                                                   f"failed: {error.get('message', error)}"))
+            return
+
+        choice, usage = body["choices"][0], body.get("usage") or {}
+        details = usage.get("prompt_tokens_details") or {}
+        response = GptResponse(text=choice["message"]["content"],
+                               finish_reason=choice["finish_reason"],
+                               completion_tokens=usage.get("completion_tokens", 0),
+                               prompt_tokens=usage.get("prompt_tokens", 0),
+                               cached_tokens=details.get("cached_tokens") or 0,
+                               model=body.get("model"))
+        record_usage(response)
+        if self.repo.metrics is not None:
+            self.repo.metrics.observe_response("chat.batch", self._models[result["custom_id"]], response)
+        future.set_result(response)
+
+    def _fail_pending(self, error: GptBatchException) -> None:
+        for future in self._futures.values():
+            if not future.done():
+                future.set_exception(error)
+
+
+def _write_file(path: str, data: bytes) -> None:
+    with open(path, "wb") as file:
+        file.write(data)
@@ -0,0 +1,202 @@
+import json
+import time
+from abc import ABC, abstractmethod
+from collections import OrderedDict
+from hashlib import sha256
+
+from .state import BaseStateBackend
+from .types.response import GptResponse
+
+
+def make_cache_key(model: str,
+                   system_prompt: str,
+                   prompt: str,
+                   max_tokens: int,
+                   image: str | None = None) -> str:
+    """ Builds stable key of request. `image` is any reference of image: url, telegram `file_unique_id`, etc. """
+    raw = "\x1f".join((model, system_prompt or "", prompt, str(max_tokens), image or ""))
+    return sha256(raw.encode('utf-8')).hexdigest()
+
+
+class BaseCacheBackend(ABC):
+    """ Interface of response cache. Implement it to store responses in your own storage (redis, database, etc.) """
+
+    @abstractmethod
+    async def get(self, key: str) -> GptResponse | None:
+        """ Returns cached response or `None` if key is missing or expired """
+
+    @abstractmethod
+    async def set(self, key: str, response: GptResponse) -> None:
+        """ Stores response under given key """
+
+    @abstractmethod
+    async def delete(self, key: str) -> None:
+        """ Removes key from cache """
+
+
+class InMemoryCache(BaseCacheBackend):
+    """ LRU cache with optional TTL, stored in memory of current process """
+
+    def __init__(self, maxsize: int = 1024, ttl: float | None = 3600):
+        """
+        :param maxsize: maximum number of stored responses. Least recently used response is evicted first
+        :param ttl: lifetime of response in seconds. `None` - responses live until evicted
+        """
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._data: OrderedDict[str, tuple[float, GptResponse]] = OrderedDict()
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+    async def get(self, key: str) -> GptResponse | None:
+        item = self._data.get(key)
+        if item is None:
+            self.misses += 1
+            return None
+
+        expires_at, response = item
+        if expires_at < time.monotonic():
+            del self._data[key]
+            self.misses += 1
+            return None
+
+        self._data.move_to_end(key)
+        self.hits += 1
+        return response
+
+    async def set(self, key: str, response: GptResponse) -> None:
+        expires_at = time.monotonic() + self.ttl if self.ttl is not None else float("inf")
+        self._data[key] = (expires_at, response)
+        self._data.move_to_end(key)
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+
+    async def delete(self, key: str) -> None:
+        self._data.pop(key, None)
+
+    def clear(self) -> None:
+        self._data.clear()
+
+
+class StateCache(BaseCacheBackend):
+    """
+    Response cache in shared `aigrammy.state` backend, e.g. `RedisStateBackend`,
+    so processes of the bot answer each other's cached requests
+    """
+
+    def __init__(self, state: BaseStateBackend, ttl: float | None = 3600, prefix: str = "aigrammy:cache:"):
+        """
+        :param state: instance of `aigrammy.state.BaseStateBackend`
+        :param ttl: lifetime of response in seconds. `None` - responses live until removed
+        :param prefix: prefix of keys in backend
+        """
+        self.state = state
+        self.ttl = ttl
+        self.prefix = prefix
+
+    async def get(self, key: str) -> GptResponse | None:
+        value = await self.state.get(self.prefix + key)
+        if value is None:
+            return None
+        return GptResponse.from_dict(json.loads(value))
+
+    async def set(self, key: str, response: GptResponse) -> None:
+        await self.state.set(self.prefix + key, json.dumps(response.to_dict()).encode("utf-8"), self.ttl)
+
+    async def delete(self, key: str) -> None:
+        await self.state.delete(self.prefix + key)
+
+
+class ImagePayloadCache:
+    """ LRU cache of prepared images (`data:` urls) keyed by telegram `file_unique_id`, bounded by total size """
+
+    def __init__(self, max_bytes: int = 64 * 1024 * 1024):
+        """
+        :param max_bytes: maximum total size of stored images. Least recently used image is evicted first
+        """
+        self.max_bytes = max_bytes
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self._data: OrderedDict[str, str] = OrderedDict()
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+    def get(self, file_unique_id: str) -> str | None:
+        img_url = self._data.get(file_unique_id)
+        if img_url is None:
+            self.misses += 1
+            return None
+
+        self._data.move_to_end(file_unique_id)
+        self.hits += 1
+        return img_url
+
+    def set(self, file_unique_id: str, img_url: str) -> None:
+        if len(img_url) > self.max_bytes:
+            return
+
+        old = self._data.pop(file_unique_id, None)
+        if old is not None:
+            self.size -= len(old)
+        self._data[file_unique_id] = img_url
+        self.size += len(img_url)
+        while self.size > self.max_bytes:
+            _, evicted = self._data.popitem(last=False)
+            self.size -= len(evicted)
+
+
+class FileIdCache:
+    """
+    LRU mapping of image keys (telegram `file_unique_id` or content hash) to ids of files uploaded to OpenAI.\n
+    Files are uploaded with expiration of `ttl` seconds, so OpenAI deletes them; ids are forgotten an hour earlier,
+    so a reused file outlives run which references it
+    """
+
+    def __init__(self, maxsize: int = 10000, ttl: int | None = 30 * 24 * 3600):
+        """
+        :param maxsize: maximum number of cached ids
+        :param ttl: lifetime of uploaded files in seconds, from 1 hour to 30 days. `None` - files are never deleted
+        """
+        if ttl is not None and not 3600 <= ttl <= 30 * 24 * 3600:
+            raise ValueError("`ttl` of uploaded files must be from 1 hour to 30 days")
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._data: OrderedDict[str, tuple[str, float]] = OrderedDict()  # key -> (file id, `time.monotonic()` expiry)
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+    def expires_after(self) -> dict | None:
+        """ Returns `expires_after` parameter of `files.create`, or `None` if files do not expire """
+        if self.ttl is None:
+            return None
+        return {"anchor": "created_at", "seconds": self.ttl}
+
+    def get(self, key: str) -> str | None:
+        item = self._data.get(key)
+        if item is None or item[1] <= time.monotonic():
+            if item is not None:
+                del self._data[key]
+            self.misses += 1
+            return None
+
+        self._data.move_to_end(key)
+        self.hits += 1
+        return item[0]
+
+    def set(self, key: str, file_id: str) -> None:
+        expires_at = time.monotonic() + self.ttl - 3600 if self.ttl is not None else float("inf")
+        self._data[key] = (file_id, expires_at)
+        self._data.move_to_end(key)
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+
+    def delete(self, key: str) -> None:
+        self._data.pop(key, None)
@@ -0,0 +1,66 @@
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Iterator
+
+from .types.response import GptResponse
+
+
+class UsageScope:
+    """ Telegram user and chat of currently handled update, with tokens consumed by upstream calls made for it """
+
+    __slots__ = ("user_id", "chat_id", "tokens")
+
+    def __init__(self, user_id: int | None = None, chat_id: int | None = None):
+        self.user_id = user_id
+        self.chat_id = chat_id
+        self.tokens = 0
+
+
+_scope: ContextVar[UsageScope | None] = ContextVar("aigrammy_usage_scope", default=None)
+_deadline: ContextVar[float | None] = ContextVar("aigrammy_deadline", default=None)  # `time.monotonic()` based
+
+
+def current_scope() -> UsageScope | None:
+    """ Returns scope of currently handled update, or `None` outside of `usage_scope` """
+    return _scope.get()
+
+
+@contextmanager
+def usage_scope(user_id: int | None = None, chat_id: int | None = None) -> Iterator[UsageScope]:
+    """ Opens scope, so tokens of all upstream calls made inside it (including tasks created inside) are summed """
+    scope = UsageScope(user_id, chat_id)
+    token = _scope.set(scope)
+    try:
+        yield scope
+    finally:
+        _scope.reset(token)
+
+
+def record_usage(response: GptResponse) -> None:
+    """ Adds tokens of upstream response to current scope. Called by repos, does nothing outside of scope """
+    scope = _scope.get()
+    if scope is not None:
+        scope.tokens += response.total_tokens_used
+
+
+@contextmanager
+def deadline_scope(seconds: float | None) -> Iterator[None]:
+    """ Sets deadline of upstream calls made inside, e.g. by handler. Nested scopes can only shorten it """
+    if seconds is None:
+        yield
+        return
+
+    deadline = time.monotonic() + seconds
+    outer = _deadline.get()
+    token = _deadline.set(deadline if outer is None else min(outer, deadline))
+    try:
+        yield
+    finally:
+        _deadline.reset(token)
+
+
+def remaining_time() -> float | None:
+    """ Returns seconds left until deadline of current scope, or `None` without deadline """
+    deadline = _deadline.get()
+    return deadline - time.monotonic() if deadline is not None else None
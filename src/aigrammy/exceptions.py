@@ -1,2 +1,22 @@
 class NoGptPromptSpecifiedException(Exception):
     """ Raise for cases where no prompt was specified for ChatGPT"""
+
+
+class GptTimeoutException(Exception):
+    """ Raise for cases where ChatGPT did not answer before deadline"""
+
+
+class GptPromptTooLongException(Exception):
+    """ Raise for cases where prompt does not fit into context window of model"""
+
+
+class GptQueueFullException(Exception):
+    """ Raise for cases where request can not be queued, since queue of scheduler is full"""
+
+
+class GptBatchException(Exception):
+    """ Raise for cases where request of batch failed or batch was not completed"""
+
+
+class GptQuotaExceededException(Exception):
+    """ Raise for cases where user has exhausted token quota"""
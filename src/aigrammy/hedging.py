@@ -0,0 +1,47 @@
+from collections import deque
+
+
+class HedgePolicy:
+    """
+    Deadline and hedging policy of `GptChatCompletionRepo`.\n
+    If primary request is not answered within hedge delay, a duplicate request is sent
+    (optionally to a faster `hedge_model`). The first answer wins, the other request is cancelled.
+    Hedge delay is a quantile of recently observed latencies, unless fixed `hedge_delay` is given.
+    """
+
+    def __init__(self,
+                 deadline: float | None = 60.0,
+                 hedge_delay: float | None = None,
+                 hedge_quantile: float = 0.95,
+                 hedge_model: str | None = None,
+                 min_samples: int = 20,
+                 window: int = 200):
+        """
+        :param deadline: maximum time of request in seconds, including hedged one. `None` - no deadline
+        :param hedge_delay: fixed delay before hedged request. `None` - derived from `hedge_quantile` of latencies
+        :param hedge_quantile: quantile of observed latencies used as hedge delay, `0.95` is p95
+        :param hedge_model: model of hedged request, e.g. `aigrammy.models.GPTModel.four_omni_mini`.
+            Model of repo if `None`
+        :param min_samples: number of observed latencies required before hedging starts
+        :param window: number of the most recent latencies used for quantile
+        """
+        self.deadline = deadline
+        self.hedge_delay = hedge_delay
+        self.hedge_quantile = hedge_quantile
+        self.hedge_model = hedge_model
+        self.min_samples = min_samples
+        self._latencies: deque[float] = deque(maxlen=window)
+
+    def delay(self) -> float | None:
+        """ Returns delay before hedged request, `None` if request should not be hedged yet """
+        if self.hedge_delay is not None:
+            return self.hedge_delay
+        if len(self._latencies) < self.min_samples:
+            return None
+
+        ordered = sorted(self._latencies)
+        return ordered[min(len(ordered) - 1, int(len(ordered) * self.hedge_quantile))]
+
+    def observe(self, latency: float) -> None:
+        """ Records latency of primary request, or time it was in flight if hedged request answered first """
+        self._latencies.append(latency)
@@ -0,0 +1,121 @@
+import asyncio
+import io
+import logging
+from base64 import b64encode
+from concurrent.futures import Executor
+from typing import BinaryIO
+
+try:
+    from PIL import Image
+except ImportError:  # Pillow is optional, without it images are only encoded in executor
+    Image = None
+
+# OpenAI vision limits: `low` detail is a single 512px image,
+# `high` detail is fit into 2048x2048 and then shortest side is scaled to 768px
+_LOW_SIDE = 512
+_HIGH_MAX_SIDE = 2048
+_HIGH_SHORT_SIDE = 768
+
+_SIGNATURES = (
+    (b"\xff\xd8\xff", "image/jpeg"),
+    (b"\x89PNG\r\n\x1a\n", "image/png"),
+    (b"GIF87a", "image/gif"),
+    (b"GIF89a", "image/gif"),
+)
+
+
+def detect_mime_type(data: bytes) -> str:
+    """ Detects mime type of image by its signature. Falls back to `image/jpeg` """
+    for signature, mime_type in _SIGNATURES:
+        if data.startswith(signature):
+            return mime_type
+    if data[:4] == b"RIFF" and data[8:12] == b"WEBP":
+        return "image/webp"
+    return "image/jpeg"
+
+
+def target_size(width: int, height: int, detail: str) -> tuple[int, int]:
+    """ Returns size of image after downscale performed by OpenAI for given `detail` """
+    if detail == "low":
+        scale = min(1.0, _LOW_SIDE / max(width, height))
+    else:
+        scale = min(1.0, _HIGH_MAX_SIDE / max(width, height), _HIGH_SHORT_SIDE / min(width, height))
+    return max(1, round(width * scale)), max(1, round(height * scale))
+
+
+class ImagePreprocessor:
+    """
+    Prepares telegram images before sending them to OpenAI.\n
+    Detects real format, downscales to resolution of `detail` tier and recompresses to JPEG (requires `Pillow`).
+    Work is done in executor, so event loop is not blocked by large images.
+    """
+
+    def __init__(self,
+                 detail: str = "auto",
+                 quality: int = 85,
+                 executor: Executor | None = None):
+        """
+        :param detail: default `detail` of images: `auto`, `low` or `high`
+        :param quality: JPEG quality of recompressed images
+        :param executor: executor used for processing, default executor of event loop if `None`
+        """
+        self.detail = detail
+        self.quality = quality
+        self.executor = executor
+        if Image is None:
+            logging.warning("aigrammy: `Pillow` is not installed, images will be sent without resizing")
+
+    async def to_data_url(self, binary_file: BinaryIO, detail: str | None = None) -> str:
+        """
+        Reads image from `BinaryIO` and returns `data:` url ready to be sent to OpenAI
+        :param binary_file: Binary from `aiogram.bot.download_file(file_id: str)`
+        :param detail: `detail` tier which image is resized for. `ImagePreprocessor.detail` if `None`
+        """
+        binary_file.seek(0)
+        data = binary_file.read()
+        mime_type, b64_str = await self.prepare(data, detail)
+        return f"data:{mime_type};base64,{b64_str}"
+
+    async def prepare(self, data: bytes, detail: str | None = None) -> tuple[str, str]:
+        """ Returns mime type and b64 string of processed image """
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.executor, self._prepare, data, detail or self.detail)
+
+    async def process(self, data: bytes, detail: str | None = None) -> tuple[str, bytes]:
+        """ Returns mime type and raw bytes of processed image, e.g. for upload via Files API """
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.executor, self._process, data, detail or self.detail)
+
+    def _prepare(self, data: bytes, detail: str) -> tuple[str, str]:
+        mime_type, data = self._process(data, detail)
+        return mime_type, b64encode(data).decode('utf-8')
+
+    def _process(self, data: bytes, detail: str) -> tuple[str, bytes]:
+        mime_type = detect_mime_type(data)
+        if Image is not None and mime_type != "image/gif":  # gifs are kept as is, since they may be animated
+            try:
+                mime_type, data = self._recompress(data, mime_type, detail)
+            except Exception as e:
+                logging.warning(f"aigrammy: failed to preprocess image, sending original. Error: {e}")
+        return mime_type, data
+
+    def _recompress(self, data: bytes, mime_type: str, detail: str) -> tuple[str, bytes]:
+        with Image.open(io.BytesIO(data)) as image:
+            size = target_size(image.width, image.height, detail)
+            resized = size != image.size
+            if resized:
+                image.draft("RGB", size)  # fast JPEG downscale on decoding
+                image = image.resize(size, Image.LANCZOS)
+
+            output = io.BytesIO()
+            if image.mode in ("RGBA", "LA", "P"):
+                image.save(output, format="PNG", optimize=True)
+                new_mime_type = "image/png"
+            else:
+                image.convert("RGB").save(output, format="JPEG", quality=self.quality, optimize=True)
+                new_mime_type = "image/jpeg"
+
+        processed = output.getvalue()
+        if not resized and len(processed) >= len(data):
+            return mime_type, data
+        return new_mime_type, processed
@@ -0,0 +1,269 @@
+import asyncio
+import json
+import logging
+import sqlite3
+import time
+from typing import Any, Awaitable, Callable, Mapping
+
+from .context import usage_scope
+from .exceptions import GptQuotaExceededException
+from .quota import TokenQuota
+from .sqlite import SqliteExecutor
+from .types.assistant import GptAssistantRepo
+from .types.chat_completion import GptChatCompletionRepo
+from .types.response import GptResponse
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    dedup_key TEXT,
+    repo TEXT NOT NULL,
+    method TEXT NOT NULL,
+    kwargs TEXT NOT NULL,
+    chat_id INTEGER,
+    user_id INTEGER,
+    status TEXT NOT NULL,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    not_before REAL NOT NULL,
+    result TEXT,
+    error TEXT
+);
+CREATE INDEX IF NOT EXISTS jobs_ready ON jobs (status, not_before);
+CREATE UNIQUE INDEX IF NOT EXISTS jobs_dedup ON jobs (dedup_key)
+    WHERE dedup_key IS NOT NULL AND status != 'failed';
+"""
+# queued -> running -> done -> delivering -> (deleted), or -> failed after `max_attempts`
+_READY = ("queued", "done")
+
+
+class Job:
+    """ Request executed by `JobQueue` """
+
+    __slots__ = ("id", "repo", "method", "kwargs", "chat_id", "user_id", "attempts", "dedup_key")
+
+    def __init__(self, id: int, repo: str, method: str, kwargs: dict, chat_id: int | None, user_id: int | None,
+                 attempts: int, dedup_key: str | None):
+        self.id = id
+        self.repo = repo  # name of repo in `JobQueue.repos`
+        self.method = method  # name of repo method, e.g. `push_prompt_to_thread`
+        self.kwargs = kwargs
+        self.chat_id = chat_id  # chat which receives result
+        self.user_id = user_id
+        self.attempts = attempts  # failed attempts so far
+        self.dedup_key = dedup_key
+
+
+class JobQueue:
+    """
+    Durable queue of long requests, e.g. assistant runs, stored in local SQLite database.\n
+    Handlers enqueue jobs and return immediately; a pool of workers executes them against repos
+    and delivers results via `on_result`. Jobs survive restart, failed jobs are retried with backoff.
+    Result is stored before delivery, so failed delivery is retried without asking ChatGPT again.
+    Note that retried `push_*_to_thread` jobs push their message to thread again.
+    With `quota` jobs of users who exhausted it are rejected, and tokens of executed jobs are charged
+    """
+
+    def __init__(self,
+                 repos: Mapping[str, GptChatCompletionRepo | GptAssistantRepo],
+                 on_result: Callable[[Job, GptResponse], Awaitable[Any]],
+                 on_failure: Callable[[Job, str], Awaitable[Any]] | None = None,
+                 path: str = "aigrammy_jobs.sqlite3",
+                 concurrency: int = 4,
+                 max_attempts: int = 3,
+                 retry_delay: float = 5.0,
+                 poll_interval: float = 10.0,
+                 quota: TokenQuota | None = None):
+        """
+        :param repos: mapping of names to repos which execute jobs
+        :param on_result: coroutine function which delivers result, e.g. sends `response.text` to `job.chat_id`
+        :param on_failure: optional coroutine function called with job and error when all attempts failed
+        :param path: path to SQLite database
+        :param concurrency: number of workers, i.e. jobs executed at the same time
+        :param max_attempts: attempts of execution and delivery of job
+        :param retry_delay: delay before the first retry in seconds, doubled for every next one
+        :param poll_interval: maximum seconds between checks of database by idle worker
+        :param quota: optional `aigrammy.quota.TokenQuota`, enforced for jobs with `user_id`
+        """
+        self.repos = repos
+        self.on_result = on_result
+        self.on_failure = on_failure
+        self.path = path
+        self.concurrency = concurrency
+        self.max_attempts = max_attempts
+        self.retry_delay = retry_delay
+        self.poll_interval = poll_interval
+        self.quota = quota
+        self._sqlite = SqliteExecutor("aigrammy-jobs", path, _SCHEMA)
+        self._wakeup = asyncio.Event()
+        self._workers: list[asyncio.Task] = []
+
+    async def start(self) -> None:
+        """ Opens database, requeues jobs interrupted by restart and starts workers """
+        await self._sqlite.run(self._connect)
+        self._workers = [asyncio.create_task(self._work()) for _ in range(self.concurrency)]
+
+    async def close(self) -> None:
+        """ Stops workers. Interrupted jobs are executed again after next `start` """
+        for worker in self._workers:
+            worker.cancel()
+        await asyncio.gather(*self._workers, return_exceptions=True)
+        self._workers = []
+        await self._sqlite.close()
+
+    async def enqueue(self,
+                      repo: str,
+                      method: str,
+                      chat_id: int | None = None,
+                      user_id: int | None = None,
+                      dedup_key: str | None = None,
+                      **kwargs) -> int:
+        """
+        Stores job and wakes up workers.
+        :param repo: name of repo in `repos`
+        :param method: name of public coroutine method of repo, e.g. `ask_text` or `push_prompt_to_thread`
+        :param chat_id: chat which receives result, available in `job.chat_id`
+        :param user_id: user on whose behalf job is executed, e.g. for `aigrammy.ledger.UsageLedger`
+        :param dedup_key: optional key of job, e.g. `f"{chat_id}:{message_id}"`.
+            While job with the same key is not finished, the existing job is returned instead of a new one
+        :param kwargs: JSON serializable arguments of method
+
+        :return: Returns id of job. Raises `GptQuotaExceededException` if user has exhausted `quota`
+        """
+        if not self._allowed(user_id):
+            raise GptQuotaExceededException(f"User {user_id} has exhausted token quota")
+        if repo not in self.repos:
+            raise ValueError(f"Unknown repo `{repo}`")
+        if method.startswith("_") or not callable(getattr(self.repos[repo], method, None)):
+            raise ValueError(f"Repo `{repo}` has no method `{method}`")
+
+        job_id = await self._sqlite.run(self._insert, dedup_key, repo, method, json.dumps(kwargs), chat_id, user_id)
+        self._wakeup.set()
+        return job_id
+
+    async def _work(self) -> None:
+        while True:
+            self._wakeup.clear()
+            try:
+                job, result, next_at = await self._sqlite.run(self._claim, time.time())
+            except Exception as e:
+                logging.warning(f"aigrammy: failed to claim job. Error: {e}")
+                await asyncio.sleep(5)
+                continue
+            if job is None:
+                timeout = self.poll_interval if next_at is None else min(self.poll_interval, next_at - time.time())
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), max(timeout, 0.0))
+                except asyncio.TimeoutError:
+                    pass
+                continue
+
+            try:
+                await self._process(job, result)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logging.exception(f"aigrammy: job {job.id} failed. Error: {e}")
+
+    async def _process(self, job: Job, result: str | None) -> None:
+        if result is None:
+            if not self._allowed(job.user_id):  # quota was exhausted while job waited in queue
+                await self._fail(job, GptQuotaExceededException(f"User {job.user_id} has exhausted token quota"),
+                                 retry=False)
+                return
+            try:
+                with usage_scope(job.user_id, job.chat_id) as scope:
+                    try:
+                        response = await getattr(self.repos[job.repo], job.method)(**job.kwargs)
+                    finally:
+                        if self.quota is not None and job.user_id is not None:
+                            self.quota.charge(job.user_id, scope.tokens)
+            except Exception as e:
+                await self._fail(job, e)
+                return
+            result = json.dumps(response.to_dict())
+            await self._sqlite.run(self._store_result, job.id, result)
+        else:
+            response = GptResponse.from_dict(json.loads(result))
+
+        try:
+            await self.on_result(job, response)
+        except Exception as e:
+            await self._fail(job, e, delivery=True)
+            return
+        await self._sqlite.run(self._delete, job.id)
+
+    def _allowed(self, user_id: int | None) -> bool:
+        return self.quota is None or user_id is None or self.quota.allowed(user_id)
+
+    async def _fail(self, job: Job, error: Exception, delivery: bool = False, retry: bool = True) -> None:
+        job.attempts += 1
+        stage = "delivery" if delivery else "execution"
+        if retry and job.attempts < self.max_attempts:
+            delay = self.retry_delay * 2 ** (job.attempts - 1)
+            logging.warning(f"aigrammy: {stage} of job {job.id} failed, retry {job.attempts}/{self.max_attempts - 1} "
+                            f"in {delay}s. Error: {error}")
+            await self._sqlite.run(self._retry, job.id, "done" if delivery else "queued", time.time() + delay,
+                                   repr(error))
+            self._wakeup.set()
+            return
+
+        logging.warning(f"aigrammy: {stage} of job {job.id} failed after {job.attempts} attempts. Error: {error}")
+        await self._sqlite.run(self._retry, job.id, "failed", time.time(), repr(error))
+        if self.on_failure is not None:
+            await self.on_failure(job, repr(error))
+
+    @property
+    def _db(self) -> sqlite3.Connection | None:
+        return self._sqlite.db
+
+    # region: blocking SQLite operations, executed by `_sqlite`
+    def _connect(self) -> None:
+        db = self._sqlite.connection()
+        with db:
+            db.execute("UPDATE jobs SET status = 'queued' WHERE status = 'running'")
+            db.execute("UPDATE jobs SET status = 'done' WHERE status = 'delivering'")
+
+    def _insert(self, dedup_key: str | None, repo: str, method: str, kwargs: str,
+                chat_id: int | None, user_id: int | None) -> int:
+        try:
+            with self._db:
+                cursor = self._db.execute(
+                    "INSERT INTO jobs (dedup_key, repo, method, kwargs, chat_id, user_id, status, not_before) "
+                    "VALUES (?, ?, ?, ?, ?, ?, 'queued', ?)",
+                    (dedup_key, repo, method, kwargs, chat_id, user_id, time.time()))
+                return cursor.lastrowid
+        except sqlite3.IntegrityError:
+            row = self._db.execute("SELECT id FROM jobs WHERE dedup_key = ? AND status != 'failed'",
+                                   (dedup_key,)).fetchone()
+            return row[0]
+
+    def _claim(self, now: float) -> tuple[Job | None, str | None, float | None]:
+        """ Marks the oldest ready job as taken. Returns job, its stored result, and time of next job if none """
+        with self._db:
+            row = self._db.execute(
+                "SELECT id, repo, method, kwargs, chat_id, user_id, attempts, dedup_key, status, result FROM jobs "
+                "WHERE status IN (?, ?) AND not_before <= ? ORDER BY not_before, id LIMIT 1", (*_READY, now)
+            ).fetchone()
+            if row is None:
+                next_at = self._db.execute("SELECT MIN(not_before) FROM jobs WHERE status IN (?, ?)",
+                                           _READY).fetchone()[0]
+                return None, None, next_at
+
+            job_id, repo, method, kwargs, chat_id, user_id, attempts, dedup_key, status, result = row
+            self._db.execute("UPDATE jobs SET status = ? WHERE id = ?",
+                             ("running" if status == "queued" else "delivering", job_id))
+        return Job(job_id, repo, method, json.loads(kwargs), chat_id, user_id, attempts, dedup_key), result, None
+
+    def _store_result(self, job_id: int, result: str) -> None:
+        with self._db:
+            self._db.execute("UPDATE jobs SET status = 'delivering', result = ? WHERE id = ?", (result, job_id))
+
+    def _retry(self, job_id: int, status: str, not_before: float, error: str) -> None:
+        with self._db:
+            self._db.execute("UPDATE jobs SET status = ?, attempts = attempts + 1, not_before = ?, error = ? "
+                             "WHERE id = ?", (status, not_before, error, job_id))
+
+    def _delete(self, job_id: int) -> None:
+        with self._db:
+            self._db.execute("DELETE FROM jobs WHERE id = ?", (job_id,))
+    # endregion
@@ -0,0 +1,276 @@
+import asyncio
+import logging
+import mmap
+import os
+import struct
+import time
+from array import array
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+from typing import Iterable
+
+from .context import current_scope
+from .metrics import BaseMetrics
+from .types.response import GptResponse
+
+try:
+    import numpy
+except ImportError:  # numpy is optional, without it aggregates are computed by iterating over records
+    numpy = None
+
+METHODS = ("chat.completions", "chat.completions.stream", "assistant.run", "assistant.run.stream", "other")
+FINISH_REASONS = ("stop", "length", "content_filter", "tool_calls", "end", "failed",
+                  "max_prompt_tokens", "max_completion_tokens", "none", "other")
+GROUP_KEYS = ("chat_id", "model", "method", "finish_reason", "day")
+
+# timestamp, chat_id, model, method, finish_reason, prompt_tokens, completion_tokens, cached_tokens, latency
+_RECORD = struct.Struct("<dqHBBIIIf")
+_FIELDS = ("timestamp", "chat_id", "model", "method", "finish_reason",
+           "prompt_tokens", "completion_tokens", "cached_tokens", "latency")
+_TYPECODES = ("d", "q", "H", "B", "B", "I", "I", "I", "f")
+_METHOD_CODES = {method: code for code, method in enumerate(METHODS)}
+_FINISH_CODES = {reason: code for code, reason in enumerate(FINISH_REASONS)}
+_NO_CHAT = -(1 << 63)  # chat_id of responses made outside of `aigrammy.context.usage_scope`
+
+
+class _Columns:
+    """ Pending records in column arrays, so buffered responses cost a few bytes each instead of objects """
+
+    __slots__ = _FIELDS
+
+    def __init__(self):
+        for field, typecode in zip(_FIELDS, _TYPECODES):
+            setattr(self, field, array(typecode))
+
+    def __len__(self) -> int:
+        return len(self.timestamp)
+
+    def append(self, *values) -> None:
+        for field, value in zip(_FIELDS, values):
+            getattr(self, field).append(value)
+
+    def pack(self) -> bytes:
+        buffer = bytearray(_RECORD.size * len(self))
+        for index, values in enumerate(zip(*(getattr(self, field) for field in _FIELDS))):
+            _RECORD.pack_into(buffer, index * _RECORD.size, *values)
+        return bytes(buffer)
+
+
+class UsageLedger(BaseMetrics):
+    """
+    Append-only log of every upstream response in fixed-width binary records.\n
+    Responses are buffered in memory and appended to file in batches off the event loop.
+    Aggregates are computed over memory-mapped file, vectorized with `numpy` when it is installed.
+    Chat of response is taken from `aigrammy.context.usage_scope`, opened by middlewares.
+    Pass it as `metrics` of repos, together with other metrics via `aigrammy.metrics.MetricsGroup`
+    """
+
+    def __init__(self, path: str = "aigrammy_usage.bin", flush_interval: float = 5.0, batch_size: int = 1024):
+        """
+        :param path: path to ledger file. Names of models are stored next to it, in `{path}.models`
+        :param flush_interval: seconds between writes of buffered records
+        :param batch_size: number of buffered records which triggers write before `flush_interval`
+        """
+        self.path = path
+        self.flush_interval = flush_interval
+        self.batch_size = batch_size
+        self._models: list[str] = []
+        self._model_codes: dict[str, int] = {}
+        self._stored_models = 0  # number of model names already written to `{path}.models`
+        self._pending = _Columns()
+        self._full = asyncio.Event()
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="aigrammy-ledger")  # serializes writes
+        self._flush_task: asyncio.Task | None = None
+
+    async def start(self) -> None:
+        """ Loads names of models and starts periodic writes """
+        self._models = await self._run(self._load_models)
+        self._model_codes = {model: code for code, model in enumerate(self._models)}
+        self._stored_models = len(self._models)
+        self._flush_task = asyncio.create_task(self._flush_periodically())
+
+    async def close(self) -> None:
+        if self._flush_task is not None:
+            self._flush_task.cancel()
+            await asyncio.gather(self._flush_task, return_exceptions=True)
+            self._flush_task = None
+        await self.flush()
+        self._executor.shutdown(wait=False)
+
+    def observe_response(self, method: str, model: str, response: GptResponse) -> None:
+        scope = current_scope()
+        chat_id = scope.chat_id if scope is not None and scope.chat_id is not None else _NO_CHAT
+        finish_reason = response.finish_reason if response.finish_reason is not None else "none"
+        self._pending.append(
+            time.time(),
+            chat_id,
+            self._model_code(response.model or model or ""),
+            _METHOD_CODES.get(method, _METHOD_CODES["other"]),
+            _FINISH_CODES.get(finish_reason, _FINISH_CODES["other"]),
+            response.prompt_tokens,
+            response.completion_tokens,
+            response.cached_tokens,
+            response.latency if response.latency is not None else 0.0,
+        )
+        if len(self._pending) >= self.batch_size:
+            self._full.set()
+
+    async def flush(self) -> None:
+        """ Appends buffered records to file """
+        if not len(self._pending):
+            return
+        pending, self._pending = self._pending, _Columns()
+        new_models = self._models[self._stored_models:]
+        self._stored_models = len(self._models)
+        await self._run(self._append, pending, new_models)
+
+    async def aggregate(self,
+                        by: Iterable[str] = ("chat_id", "model", "day"),
+                        since: float | None = None,
+                        until: float | None = None) -> dict[tuple, dict[str, float]]:
+        """
+        Sums usage of records grouped by given keys. Buffered records are written first.
+        :param by: keys of grouping from `GROUP_KEYS`. `day` is UTC date in `YYYY-MM-DD` format,
+            `chat_id` is `None` for responses made outside of middlewares
+        :param since: unix timestamp of the first included record
+        :param until: unix timestamp after which records are excluded
+
+        :return: mapping of group key tuples to sums of `requests`, `prompt_tokens`, `completion_tokens`,
+            `cached_tokens` and `latency`
+        """
+        by = tuple(by)
+        unknown = set(by) - set(GROUP_KEYS)
+        if unknown:
+            raise ValueError(f"Unknown keys of grouping: {', '.join(sorted(unknown))}")
+
+        await self.flush()
+        aggregate = self._aggregate_numpy if numpy is not None else self._aggregate_records
+        return await self._run(aggregate, by, since, until)
+
+    def _model_code(self, model: str) -> int:
+        code = self._model_codes.get(model)
+        if code is None:
+            code = self._model_codes[model] = len(self._models)
+            self._models.append(model)
+        return code
+
+    async def _flush_periodically(self) -> None:
+        while True:
+            try:
+                await asyncio.wait_for(self._full.wait(), timeout=self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._full.clear()
+            try:
+                await self.flush()
+            except Exception as e:
+                logging.warning(f"aigrammy: failed to write usage ledger. Error: {e}")
+
+    async def _run(self, func, *args):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._executor, func, *args)
+
+    def _group_key(self, by: tuple[str, ...], record: tuple) -> tuple:
+        key = []
+        for name in by:
+            if name == "chat_id":
+                key.append(record[1] if record[1] != _NO_CHAT else None)
+            elif name == "model":
+                key.append(self._models[record[2]])
+            elif name == "method":
+                key.append(METHODS[record[3]])
+            elif name == "finish_reason":
+                key.append(FINISH_REASONS[record[4]])
+            else:
+                key.append(datetime.fromtimestamp(record[0], timezone.utc).strftime("%Y-%m-%d"))
+        return tuple(key)
+
+    # region: blocking file operations, executed in `_executor`
+    def _load_models(self) -> list[str]:
+        try:
+            with open(f"{self.path}.models", encoding="utf-8") as file:
+                return file.read().splitlines()
+        except FileNotFoundError:
+            return []
+
+    def _append(self, pending: _Columns, new_models: list[str]) -> None:
+        if new_models:  # names are written before records which refer to them
+            with open(f"{self.path}.models", "a", encoding="utf-8") as file:
+                file.write("".join(f"{model}\n" for model in new_models))
+        with open(self.path, "ab") as file:
+            file.write(pending.pack())
+
+    def _aggregate_records(self, by: tuple[str, ...], since: float | None, until: float | None) -> dict:
+        count = os.path.getsize(self.path) // _RECORD.size if os.path.exists(self.path) else 0
+        if count == 0:
+            return {}
+
+        result = {}
+        with open(self.path, "rb") as file, mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as data, \
+                memoryview(data) as view, view[:count * _RECORD.size] as records:
+            for record in _RECORD.iter_unpack(records):
+                if (since is not None and record[0] < since) or (until is not None and record[0] >= until):
+                    continue
+                sums = result.get(key := self._group_key(by, record))
+                if sums is None:
+                    sums = result[key] = dict.fromkeys(("requests", "prompt_tokens", "completion_tokens",
+                                                        "cached_tokens", "latency"), 0)
+                sums["requests"] += 1
+                sums["prompt_tokens"] += record[5]
+                sums["completion_tokens"] += record[6]
+                sums["cached_tokens"] += record[7]
+                sums["latency"] += record[8]
+        return result
+
+    def _aggregate_numpy(self, by: tuple[str, ...], since: float | None, until: float | None) -> dict:
+        size = os.path.getsize(self.path) if os.path.exists(self.path) else 0
+        count = size // _RECORD.size
+        if count == 0:
+            return {}
+
+        dtype = numpy.dtype(list(zip(_FIELDS, ("<f8", "<i8", "<u2", "u1", "u1", "<u4", "<u4", "<u4", "<f4"))))
+        records = numpy.memmap(self.path, dtype=dtype, mode="r", shape=(count,))
+        mask = numpy.ones(count, dtype=bool)
+        if since is not None:
+            mask &= records["timestamp"] >= since
+        if until is not None:
+            mask &= records["timestamp"] < until
+        records = records[mask]
+        if not len(records):
+            return {}
+
+        columns = []
+        for name in by:
+            if name == "day":
+                columns.append((records["timestamp"] // 86400).astype("<i8"))
+            else:
+                columns.append(records[name].astype("<i8"))
+        if columns:
+            keys, inverse = numpy.unique(numpy.stack(columns, axis=1), axis=0, return_inverse=True)
+            inverse = inverse.reshape(-1)
+        else:
+            keys, inverse = numpy.zeros((1, 0), dtype="<i8"), numpy.zeros(len(records), dtype="<i8")
+
+        groups = len(keys)
+        sums = {
+            "requests": numpy.bincount(inverse, minlength=groups),
+            "prompt_tokens": numpy.bincount(inverse, weights=records["prompt_tokens"], minlength=groups),
+            "completion_tokens": numpy.bincount(inverse, weights=records["completion_tokens"], minlength=groups),
+            "cached_tokens": numpy.bincount(inverse, weights=records["cached_tokens"], minlength=groups),
+            "latency": numpy.bincount(inverse, weights=records["latency"], minlength=groups),
+        }
+
+        result = {}
+        for group, key in enumerate(keys.tolist()):
+            record = [0.0, _NO_CHAT, 0, 0, 0]
+            for name, value in zip(by, key):
+                if name == "day":
+                    record[0] = value * 86400
+                else:
+                    record[_FIELDS.index(name)] = value
+            result[self._group_key(by, tuple(record))] = {
+                name: int(values[group]) if name != "latency" else float(values[group])
+                for name, values in sums.items()
+            }
+        return result
+    # endregion
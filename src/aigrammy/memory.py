@@ -0,0 +1,130 @@
+import time
+from array import array
+from collections import OrderedDict
+from typing import Callable
+
+from .tokens import estimate_message_tokens
+
+_ROLES = ("user", "assistant")
+_USER, _ASSISTANT = 0, 1
+
+
+class ChatHistory:
+    """ Compact history of one chat. Roles and token counts are stored in arrays instead of dicts """
+
+    __slots__ = ("roles", "contents", "tokens", "total_tokens", "last_used")
+
+    def __init__(self):
+        self.roles = array('B')
+        self.contents: list[str] = []
+        self.tokens = array('I')
+        self.total_tokens = 0
+        self.last_used = time.monotonic()
+
+    def __len__(self) -> int:
+        return len(self.contents)
+
+    def append(self, role: int, content: str, tokens: int) -> None:
+        self.roles.append(role)
+        self.contents.append(content)
+        self.tokens.append(tokens)
+        self.total_tokens += tokens
+
+    def trim(self, max_tokens: int) -> None:
+        """ Drops the oldest messages until history fits into `max_tokens`. History always starts with user message """
+        drop = 0
+        total = self.total_tokens
+        while drop < len(self.contents) and (total > max_tokens or self.roles[drop] != _USER):
+            total -= self.tokens[drop]
+            drop += 1
+
+        if drop:
+            del self.roles[:drop]
+            del self.contents[:drop]
+            del self.tokens[:drop]
+            self.total_tokens = total
+
+    def messages(self) -> list[dict]:
+        return [{"role": _ROLES[role], "content": content} for role, content in zip(self.roles, self.contents)]
+
+
+class ConversationStore:
+    """
+    In-memory conversation history of chats, keyed by chat id.\n
+    History of each chat is trimmed to `max_history_tokens` before it is sent,
+    idle chats are evicted when `max_chats` is exceeded or after `idle_ttl` seconds.
+    """
+
+    def __init__(self,
+                 max_history_tokens: int = 2000,
+                 max_chats: int = 10000,
+                 idle_ttl: float | None = 24 * 60 * 60,
+                 token_counter: Callable[[str], int] | None = None):
+        """
+        :param max_history_tokens: token budget of history sent with each request
+        :param max_chats: maximum number of stored chats. Least recently used chat is evicted first
+        :param idle_ttl: seconds after which idle chat is evicted, `None` - evicted only by `max_chats`
+        :param token_counter: callable which counts tokens of text. Rough estimation is used by default
+        """
+        self.max_history_tokens = max_history_tokens
+        self.max_chats = max_chats
+        self.idle_ttl = idle_ttl
+        self.token_counter = token_counter or estimate_message_tokens
+        self._chats: OrderedDict[int, ChatHistory] = OrderedDict()
+
+    def __len__(self) -> int:
+        return len(self._chats)
+
+    def __contains__(self, chat_id: int) -> bool:
+        return chat_id in self._chats
+
+    def messages(self, chat_id: int) -> list[dict]:
+        """ Returns trimmed history of chat in OpenAI `messages` format """
+        history = self._chats.get(chat_id)
+        if history is None:
+            return []
+        if self.idle_ttl is not None and time.monotonic() - history.last_used > self.idle_ttl:
+            del self._chats[chat_id]
+            return []
+
+        history.trim(self.max_history_tokens)
+        return history.messages()
+
+    def add_exchange(self, chat_id: int, prompt: str, answer: str) -> None:
+        """ Stores user prompt and assistant answer in history of chat """
+        history = self._chats.get(chat_id)
+        if history is None:
+            history = self._chats[chat_id] = ChatHistory()
+        else:
+            self._chats.move_to_end(chat_id)
+
+        history.append(_USER, prompt, self.token_counter(prompt))
+        history.append(_ASSISTANT, answer, self.token_counter(answer))
+        history.last_used = time.monotonic()
+        history.trim(self.max_history_tokens)
+        self._evict()
+
+    def clear(self, chat_id: int) -> None:
+        """ Forgets history of chat, e.g. on `/reset` command """
+        self._chats.pop(chat_id, None)
+
+    def evict_idle(self) -> int:
+        """ Removes chats idle for longer than `idle_ttl`. Returns number of removed chats """
+        if self.idle_ttl is None:
+            return 0
+
+        deadline = time.monotonic() - self.idle_ttl
+        removed = 0
+        # chats are ordered by last use, so the oldest ones are in front
+        while self._chats:
+            chat_id, history = next(iter(self._chats.items()))
+            if history.last_used > deadline:
+                break
+            del self._chats[chat_id]
+            removed += 1
+        return removed
+
+    def _evict(self) -> None:
+        self.evict_idle()
+        while len(self._chats) > self.max_chats:
+            self._chats.popitem(last=False)
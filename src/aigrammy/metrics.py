@@ -0,0 +1,169 @@
+import bisect
+from contextlib import ExitStack, contextmanager, nullcontext
+from typing import Iterator
+
+from .types.response import GptResponse
+
+DEFAULT_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 20.0, 30.0, 60.0, 120.0)
+
+
+class BaseMetrics:
+    """
+    Interface of instrumentation hooks called by repos around every upstream call.\n
+    All hooks do nothing by default, override only the ones you need.
+    `method` is kind of call: `chat.completions`, `chat.completions.stream`, `assistant.run`, `assistant.run.stream`
+    """
+
+    def observe_queue_wait(self, method: str, seconds: float) -> None:
+        """ Time spent waiting for rate limiter before request was sent """
+
+    def observe_time_to_first_token(self, method: str, model: str, seconds: float) -> None:
+        """ Time from sending streamed request to its first text delta """
+
+    def observe_response(self, method: str, model: str, response: GptResponse) -> None:
+        """ Finished call: latency, token usage and finish reason are taken from `response` """
+
+    def count_error(self, method: str, model: str, error: BaseException) -> None:
+        """ Failed call """
+
+    def span(self, name: str, **attributes):
+        """ Context manager wrapping upstream call, e.g. tracing span """
+        return nullcontext()
+
+
+class MetricsGroup(BaseMetrics):
+    """ Calls hooks of several metrics, e.g. `PrometheusMetrics` and `aigrammy.ledger.UsageLedger` """
+
+    def __init__(self, *metrics: BaseMetrics):
+        self.metrics = metrics
+
+    def observe_queue_wait(self, method: str, seconds: float) -> None:
+        for metrics in self.metrics:
+            metrics.observe_queue_wait(method, seconds)
+
+    def observe_time_to_first_token(self, method: str, model: str, seconds: float) -> None:
+        for metrics in self.metrics:
+            metrics.observe_time_to_first_token(method, model, seconds)
+
+    def observe_response(self, method: str, model: str, response: GptResponse) -> None:
+        for metrics in self.metrics:
+            metrics.observe_response(method, model, response)
+
+    def count_error(self, method: str, model: str, error: BaseException) -> None:
+        for metrics in self.metrics:
+            metrics.count_error(method, model, error)
+
+    @contextmanager
+    def span(self, name: str, **attributes) -> Iterator:
+        with ExitStack() as stack:
+            for metrics in self.metrics:
+                stack.enter_context(metrics.span(name, **attributes))
+            yield
+
+
+class _Histogram:
+    __slots__ = ("counts", "total", "count")
+
+    def __init__(self, size: int):
+        self.counts = [0] * size
+        self.total = 0.0
+        self.count = 0
+
+    def observe(self, buckets: tuple[float, ...], value: float) -> None:
+        index = bisect.bisect_left(buckets, value)
+        if index < len(self.counts):
+            self.counts[index] += 1
+        self.total += value
+        self.count += 1
+
+
+class PrometheusMetrics(BaseMetrics):
+    """
+    Collects metrics in memory and renders them in Prometheus text format via `render()`.\n
+    Pass OpenTelemetry `tracer` to additionally wrap every upstream call in a span.
+    """
+
+    def __init__(self, namespace: str = "aigrammy", buckets: tuple[float, ...] = DEFAULT_BUCKETS, tracer=None):
+        """
+        :param namespace: prefix of metric names
+        :param buckets: upper bounds of latency histogram buckets in seconds
+        :param tracer: optional `opentelemetry.trace.Tracer`
+        """
+        self.namespace = namespace
+        self.buckets = tuple(sorted(buckets))
+        self.tracer = tracer
+        self._histograms: dict[tuple[str, tuple], _Histogram] = {}
+        self._counters: dict[tuple[str, tuple], float] = {}
+
+    def observe_queue_wait(self, method: str, seconds: float) -> None:
+        self._observe("queue_wait_seconds", (("method", method),), seconds)
+
+    def observe_time_to_first_token(self, method: str, model: str, seconds: float) -> None:
+        self._observe("time_to_first_token_seconds", (("method", method), ("model", model)), seconds)
+
+    def observe_response(self, method: str, model: str, response: GptResponse) -> None:
+        labels = (("method", method), ("model", model))
+        if response.latency is not None:
+            self._observe("request_latency_seconds", labels, response.latency)
+        self._increment("prompt_tokens_total", labels, response.prompt_tokens)
+        self._increment("completion_tokens_total", labels, response.completion_tokens)
+        self._increment("cached_prompt_tokens_total", labels, response.cached_tokens)
+        self._increment("finish_reasons_total", labels + (("reason", str(response.finish_reason)),))
+
+    def count_error(self, method: str, model: str, error: BaseException) -> None:
+        self._increment("errors_total", (("method", method), ("model", model), ("error", type(error).__name__)))
+
+    def span(self, name: str, **attributes):
+        if self.tracer is None:
+            return nullcontext()
+        return self._span(name, attributes)
+
+    @contextmanager
+    def _span(self, name: str, attributes: dict) -> Iterator:
+        with self.tracer.start_as_current_span(f"{self.namespace}.{name}", attributes=attributes) as span:
+            yield span
+
+    def render(self) -> str:
+        """ Returns all metrics in Prometheus text exposition format """
+        lines = []
+        described = set()
+        for (name, labels), value in sorted(self._counters.items()):
+            full_name = f"{self.namespace}_{name}"
+            if full_name not in described:
+                lines.append(f"# TYPE {full_name} counter")
+                described.add(full_name)
+            lines.append(f"{full_name}{_format_labels(labels)} {value}")
+
+        for (name, labels), histogram in sorted(self._histograms.items(), key=lambda item: item[0]):
+            full_name = f"{self.namespace}_{name}"
+            if full_name not in described:
+                lines.append(f"# TYPE {full_name} histogram")
+                described.add(full_name)
+            cumulative = 0
+            for bound, count in zip(self.buckets, histogram.counts):
+                cumulative += count
+                lines.append(f"{full_name}_bucket{_format_labels(labels + (('le', repr(bound)),))} {cumulative}")
+            lines.append(f"{full_name}_bucket{_format_labels(labels + (('le', '+Inf'),))} {histogram.count}")
+            lines.append(f"{full_name}_sum{_format_labels(labels)} {histogram.total}")
+            lines.append(f"{full_name}_count{_format_labels(labels)} {histogram.count}")
+        return "\n".join(lines) + "\n"
+
+    def _observe(self, name: str, labels: tuple, value: float) -> None:
+        histogram = self._histograms.get((name, labels))
+        if histogram is None:
+            histogram = self._histograms[(name, labels)] = _Histogram(len(self.buckets))
+        histogram.observe(self.buckets, value)
+
+    def _increment(self, name: str, labels: tuple, value: float = 1) -> None:
+        self._counters[(name, labels)] = self._counters.get((name, labels), 0) + value
+
+
+def _format_labels(labels: tuple) -> str:
+    if not labels:
+        return ""
+    escaped = (f'{key}="{_escape(value)}"' for key, value in labels)
+    return "{" + ",".join(escaped) + "}"
+
+
+def _escape(value: str) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
@@ -1,8 +1,15 @@
-from typing import Callable, Dict, Any, Awaitable
+import asyncio
+import logging
+from typing import Callable, Dict, Any, Awaitable, Hashable
 
 from aiogram import BaseMiddleware
+from aiogram.dispatcher.flags import get_flag
 from aiogram.types import Message, TelegramObject
 
+from .context import current_scope, deadline_scope, usage_scope
+from .exceptions import GptQueueFullException, GptTimeoutException
+from .quota import TokenQuota
+from .scheduler import FairScheduler
 from .types.response import GptResponse
 from .types.chat_completion import GptChatCompletionRepo
 from .types.assistant import GptAssistantRepo
@@ -20,7 +27,7 @@ class GptChatCompletionMiddleware(BaseMiddleware):
         data: Dict[str, Any],
     ) -> Any:
         data["gpt"] = self.client  # link client to middleware, so we can access it inside handlers;
-        return await handler(event, data)
+        return await _handle_in_scope(handler, event, data)
 
 
 class GptAssistantMiddleware(BaseMiddleware):
@@ -34,7 +41,249 @@ class GptAssistantMiddleware(BaseMiddleware):
             data: Dict[str, Any]
             ) -> Any:
         data["assistant"] = self.client
+        return await _handle_in_scope(handler, event, data)
+
+
+class GptRegistryMiddleware(BaseMiddleware):
+    def __init__(self, repos: Dict[str, GptChatCompletionRepo | GptAssistantRepo]):
+        """
+        Injects multiple named repos, e.g. several assistants or repos with different clients.
+        :param repos: mapping of names to repos. Each repo is accessible inside handlers by its name
+        """
+        self.repos = repos
+
+    async def __call__(
+            self,
+            handler: Callable[[TelegramObject, Dict[str, Any]], Awaitable[Any]],
+            event: TelegramObject,
+            data: Dict[str, Any]
+            ) -> Any:
+        data.update(self.repos)
+        return await _handle_in_scope(handler, event, data)
+
+
+class TokenQuotaMiddleware(BaseMiddleware):
+    def __init__(self,
+                 quota: TokenQuota,
+                 on_reject: Callable[[TelegramObject, Dict[str, Any]], Awaitable[Any]] | None = None):
+        """
+        Enforces per-user token quota. Updates of users who exhausted their quota do not reach the handler,
+        tokens of all upstream calls made while handling update are charged to its user.
+        Register it before repo middlewares, e.g. as outer middleware.
+        :param quota: instance of `aigrammy.quota.TokenQuota`
+        :param on_reject: optional coroutine function called instead of handler for rejected updates,
+            e.g. to answer user that quota is exhausted
+        """
+        self.quota = quota
+        self.on_reject = on_reject
+
+    async def __call__(
+            self,
+            handler: Callable[[TelegramObject, Dict[str, Any]], Awaitable[Any]],
+            event: TelegramObject,
+            data: Dict[str, Any]
+            ) -> Any:
+        user = data.get("event_from_user")
+        if user is None:
+            return await handler(event, data)
+
+        if not self.quota.allowed(user.id):
+            if self.on_reject is not None:
+                return await self.on_reject(event, data)
+            return None
+
+        chat = data.get("event_chat")
+        with usage_scope(user.id, chat.id if chat is not None else None) as scope:
+            try:
+                return await handler(event, data)
+            finally:
+                self.quota.charge(user.id, scope.tokens)
+
+
+class SchedulerMiddleware(BaseMiddleware):
+    def __init__(self,
+                 scheduler: FairScheduler,
+                 priority: Callable[[TelegramObject, Dict[str, Any]], int] | None = None,
+                 on_queued: Callable[[TelegramObject, Dict[str, Any], int], Awaitable[Any]] | None = None,
+                 on_rejected: Callable[[TelegramObject, Dict[str, Any]], Awaitable[Any]] | None = None):
+        """
+        Runs handlers through `aigrammy.scheduler.FairScheduler`, so they wait for their turn under load.
+        :param scheduler: instance of `FairScheduler`
+        :param priority: optional function which returns priority class of update, e.g. `0` for paying users.
+            All updates have priority `0` by default
+        :param on_queued: optional coroutine function called when update has to wait, with its place in queue,
+            e.g. to answer "busy, you are #N in queue"
+        :param on_rejected: optional coroutine function called instead of handler when queue is full
+        """
+        self.scheduler = scheduler
+        self.priority = priority
+        self.on_queued = on_queued
+        self.on_rejected = on_rejected
+
+    async def __call__(
+            self,
+            handler: Callable[[TelegramObject, Dict[str, Any]], Awaitable[Any]],
+            event: TelegramObject,
+            data: Dict[str, Any]
+            ) -> Any:
+        chat, user = data.get("event_chat"), data.get("event_from_user")
+        chat_id = chat.id if chat is not None else user.id if user is not None else None
+        priority = self.priority(event, data) if self.priority is not None else 0
+
+        position = self.scheduler.position(chat_id, priority)
+        if position and self.on_queued is not None and not self.scheduler.full(chat_id, priority):
+            await self.on_queued(event, data, position)
+
+        try:
+            await self.scheduler.acquire(chat_id, priority)
+        except GptQueueFullException:
+            if self.on_rejected is not None:
+                return await self.on_rejected(event, data)
+            return None
+
+        try:
+            return await handler(event, data)
+        finally:
+            self.scheduler.release()
+
+
+class SupersedeMiddleware(BaseMiddleware):
+    def __init__(self, deadline: float | None = None):
+        """
+        Cancels handler of chat, when a newer update of the same chat arrives, so the outdated answer is not paid for.
+        Cancellation stops `chat.completions` request and cancels assistant run via `runs.cancel`.
+        Opt-in per handler with flag: `flags={"supersede": True}`, or `flags={"supersede": {"deadline": 30}}`.
+        Deadline is propagated to repos, which stop waiting (and cancel assistant runs) when it is reached.
+        Register it as inner middleware, since flags are known only after handler is resolved.
+        :param deadline: default deadline of flagged handlers in seconds, `None` - no deadline
+        """
+        self.deadline = deadline
+        self._running: dict[int, asyncio.Task] = {}
+        self._superseded: set[asyncio.Task] = set()
+
+    async def __call__(
+            self,
+            handler: Callable[[TelegramObject, Dict[str, Any]], Awaitable[Any]],
+            event: TelegramObject,
+            data: Dict[str, Any]
+            ) -> Any:
+        flag = get_flag(data, "supersede")
+        chat = data.get("event_chat")
+        if not flag or chat is None:
+            return await handler(event, data)
+
+        deadline = flag.get("deadline", self.deadline) if isinstance(flag, dict) else self.deadline
+        # handler runs in its own task, so superseding or deadline cancels it without cancelling the dispatcher
+        task = asyncio.ensure_future(self._handle(handler, event, data, deadline))
+        previous = self._running.get(chat.id)
+        if previous is not None and not previous.done():
+            self._superseded.add(previous)
+            previous.cancel()
+        self._running[chat.id] = task
+
+        try:
+            return await asyncio.wait_for(task, deadline)
+        except asyncio.CancelledError:
+            if task not in self._superseded:
+                raise
+            logging.info(f"aigrammy: handler of chat {chat.id} was superseded by a newer update")
+            return None
+        except asyncio.TimeoutError:
+            if not task.cancelled():  # raised by handler itself
+                raise
+            raise GptTimeoutException(f"Handler of chat {chat.id} was not finished within {deadline} seconds!")
+        finally:
+            self._superseded.discard(task)
+            if self._running.get(chat.id) is task:
+                del self._running[chat.id]
+
+    @staticmethod
+    async def _handle(handler: Callable[[TelegramObject, Dict[str, Any]], Awaitable[Any]],
+                      event: TelegramObject,
+                      data: Dict[str, Any],
+                      deadline: float | None) -> Any:
+        with deadline_scope(deadline):
+            return await handler(event, data)
+
+
+class _Burst:
+    __slots__ = ("messages", "updated")
+
+    def __init__(self, message: Message):
+        self.messages = [message]
+        self.updated = asyncio.Event()
+
+
+class MessageBurstMiddleware(BaseMiddleware):
+    def __init__(self, window: float = 1.0, max_wait: float = 5.0, max_messages: int = 10):
+        """
+        Collects messages sent in quick succession into one handler call. Messages of the same user in chat
+        (or of the same album, by `media_group_id`) arriving within `window` seconds of each other are buffered,
+        the handler is called once, with all of them in `data["messages"]`, e.g. for
+        `GptChatCompletionRepo.ask_telegram_messages`. Other updates of the burst do not reach the handler.
+        Requires updates to be handled concurrently, as aiogram polling does by default.
+        :param window: seconds of silence after which burst is handled
+        :param max_wait: maximum seconds between the first message of burst and its handling
+        :param max_messages: maximum number of messages in burst, the next message starts a new one
+        """
+        self.window = window
+        self.max_wait = max_wait
+        self.max_messages = max_messages
+        self._bursts: dict[Hashable, _Burst] = {}
+
+    async def __call__(
+            self,
+            handler: Callable[[TelegramObject, Dict[str, Any]], Awaitable[Any]],
+            event: TelegramObject,
+            data: Dict[str, Any]
+            ) -> Any:
+        if not isinstance(event, Message):
+            return await handler(event, data)
+
+        if event.media_group_id is not None:
+            key = (event.chat.id, event.media_group_id)
+        else:
+            key = (event.chat.id, event.from_user.id if event.from_user is not None else None)
+
+        burst = self._bursts.get(key)
+        if burst is not None and len(burst.messages) < self.max_messages:
+            burst.messages.append(event)
+            burst.updated.set()
+            return None  # handled together with the first message of burst
+
+        burst = self._bursts[key] = _Burst(event)
+        try:
+            await self._wait_for_silence(burst)
+        finally:
+            if self._bursts.get(key) is burst:
+                del self._bursts[key]
+
+        data["messages"] = sorted(burst.messages, key=lambda message: message.message_id)
         return await handler(event, data)
 
+    async def _wait_for_silence(self, burst: _Burst) -> None:
+        loop = asyncio.get_running_loop()
+        give_up_at = loop.time() + self.max_wait
+        while len(burst.messages) < self.max_messages:
+            timeout = min(self.window, give_up_at - loop.time())
+            if timeout <= 0:
+                return
+            burst.updated.clear()
+            try:
+                await asyncio.wait_for(burst.updated.wait(), timeout)
+            except asyncio.TimeoutError:
+                return
 
-# todo: multiple assistants with unique names
\ No newline at end of file
+
+async def _handle_in_scope(
+        handler: Callable[[TelegramObject, Dict[str, Any]], Awaitable[Any]],
+        event: TelegramObject,
+        data: Dict[str, Any]
+        ) -> Any:
+    """ Opens `aigrammy.context.usage_scope` of update, unless outer middleware (e.g. quota) has opened one """
+    if current_scope() is not None:
+        return await handler(event, data)
+
+    user, chat = data.get("event_from_user"), data.get("event_chat")
+    with usage_scope(user.id if user is not None else None, chat.id if chat is not None else None):
+        return await handler(event, data)
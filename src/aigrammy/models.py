@@ -4,6 +4,7 @@ class GPTModel:
 
     four = "gpt-4"
     four_omni = "gpt-4o"
+    four_omni_mini = "gpt-4o-mini"
     four_turbo = "gpt-4-turbo"
 
 
@@ -11,3 +12,15 @@ class DALL_E:
     dall_e_3 = "dall-e-3"
     dall_e_2 = "dall-e-2"
 
+
+# context windows of models in tokens, used by `aigrammy.tokens.TokenEstimator`
+# dated snapshots, e.g. `gpt-4o-2024-08-06`, are matched by the longest prefix
+CONTEXT_WINDOWS = {
+    "gpt-3.5-turbo": 16385,
+    GPTModel.three_turbo_0125: 16385,
+    GPTModel.three_turbo_1106: 16385,
+    GPTModel.four: 8192,
+    GPTModel.four_omni: 128000,
+    GPTModel.four_omni_mini: 128000,
+    GPTModel.four_turbo: 128000,
+}
@@ -0,0 +1,147 @@
+import logging
+import time
+from collections import OrderedDict
+from typing import Mapping
+
+from openai import AsyncOpenAI
+
+from .ratelimit import parse_reset_duration
+
+
+class PoolMember:
+    """ Client of `ClientPool` with its health and rate limit headroom """
+
+    __slots__ = ("name", "client", "headroom", "latency", "failures", "ejected_until", "in_flight")
+
+    def __init__(self, name: str, client: AsyncOpenAI):
+        self.name = name
+        self.client = client
+        self.headroom = 1.0  # share of rate limit left, from `x-ratelimit-*` headers
+        self.latency: float | None = None  # moving average of latency in seconds
+        self.failures = 0  # consecutive failures
+        self.ejected_until = 0.0
+        self.in_flight = 0
+
+    @property
+    def healthy(self) -> bool:
+        return self.ejected_until <= time.monotonic()
+
+    def score(self) -> float:
+        latency = self.latency if self.latency is not None else 1.0
+        return self.headroom / (max(latency, 0.001) * (self.in_flight + 1))
+
+
+class ClientPool:
+    """
+    Pool of `AsyncOpenAI` clients with different keys, organizations or base urls.\n
+    Requests are balanced by remaining rate limit headroom, observed latency and requests in flight.
+    Members failing `failure_threshold` times in a row, or answering `429`, are ejected for a while.
+    Pass it to repos instead of `AsyncOpenAI`.
+    """
+
+    def __init__(self,
+                 clients: list[AsyncOpenAI] | Mapping[str, AsyncOpenAI],
+                 failure_threshold: int = 3,
+                 ejection_time: float = 30.0,
+                 latency_alpha: float = 0.2,
+                 max_thread_affinity: int = 100000):
+        """
+        :param clients: list of clients, or mapping of names to clients
+        :param failure_threshold: consecutive failures after which member is ejected
+        :param ejection_time: seconds of ejection after failures
+        :param latency_alpha: weight of the newest latency in moving average
+        :param max_thread_affinity: number of remembered assistant threads bound to members
+        """
+        if not isinstance(clients, Mapping):
+            clients = {str(index): client for index, client in enumerate(clients)}
+        if not clients:
+            raise ValueError("ClientPool requires at least one client")
+
+        self.members = [PoolMember(name, client) for name, client in clients.items()]
+        self.failure_threshold = failure_threshold
+        self.ejection_time = ejection_time
+        self.latency_alpha = latency_alpha
+        self.max_thread_affinity = max_thread_affinity
+        self._threads: OrderedDict[str, PoolMember] = OrderedDict()
+
+    def pick(self) -> PoolMember:
+        """ Returns the best healthy member, or the one which returns the soonest if all are ejected """
+        healthy = [member for member in self.members if member.healthy]
+        if not healthy:
+            return min(self.members, key=lambda member: member.ejected_until)
+        return max(healthy, key=PoolMember.score)
+
+    def report_success(self, member: PoolMember, latency: float, headers: Mapping[str, str] | None = None) -> None:
+        member.failures = 0
+        if member.latency is None:
+            member.latency = latency
+        else:
+            member.latency += self.latency_alpha * (latency - member.latency)
+        if headers is not None:
+            member.headroom = _headroom(headers)
+
+    def report_failure(self, member: PoolMember, error: Exception, headers: Mapping[str, str] | None = None) -> None:
+        member.failures += 1
+        if headers is not None:
+            member.headroom = _headroom(headers)
+
+        retry_after = None
+        if headers is not None:
+            retry_after = parse_reset_duration(headers.get("retry-after-ms"))
+            if retry_after is not None:
+                retry_after /= 1000
+            else:
+                retry_after = parse_reset_duration(headers.get("retry-after"))
+        if retry_after is not None:
+            member.ejected_until = time.monotonic() + retry_after
+        elif member.failures >= self.failure_threshold:
+            member.ejected_until = time.monotonic() + self.ejection_time
+            logging.warning(f"aigrammy: client `{member.name}` ejected from pool for {self.ejection_time}s. "
+                            f"Error: {error}")
+
+    def member(self, name: str) -> PoolMember | None:
+        """ Returns member with given name, `None` if pool has no such member """
+        for member in self.members:
+            if member.name == name:
+                return member
+        return None
+
+    def bind_thread(self, thread_id: str, member: PoolMember | str) -> None:
+        """
+        Remembers member (or name of member) which owns assistant thread, since threads exist only within
+        one organization. Persist `owner(thread_id).name` with thread and bind it again after restart
+        """
+        if isinstance(member, str):
+            name, member = member, self.member(member)
+            if member is None:
+                logging.warning(f"aigrammy: owner `{name}` of thread {thread_id} is not in pool")
+                return
+        self._threads[thread_id] = member
+        self._threads.move_to_end(thread_id)
+        while len(self._threads) > self.max_thread_affinity:
+            self._threads.popitem(last=False)
+
+    def owner(self, thread_id: str) -> PoolMember | None:
+        """ Returns member bound to thread, `None` if thread is unknown """
+        return self._threads.get(thread_id)
+
+    def member_for_thread(self, thread_id: str) -> PoolMember:
+        """ Returns member which owns thread. Unknown threads are served by the first member """
+        member = self._threads.get(thread_id)
+        if member is None:
+            logging.warning(f"aigrammy: owner of thread {thread_id} is unknown, it is served by the first client")
+            return self.members[0]
+        return member
+
+
+def _headroom(headers: Mapping[str, str]) -> float:
+    ratios = []
+    for kind in ("requests", "tokens"):
+        try:
+            limit = float(headers[f"x-ratelimit-limit-{kind}"])
+            remaining = float(headers[f"x-ratelimit-remaining-{kind}"])
+        except (KeyError, ValueError):
+            continue
+        if limit > 0:
+            ratios.append(remaining / limit)
+    return min(ratios) if ratios else 1.0
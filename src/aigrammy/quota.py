@@ -0,0 +1,190 @@
+import asyncio
+import logging
+import sqlite3
+import time
+from array import array
+
+from .sqlite import SqliteExecutor
+
+_MINUTE_BUCKET = 300  # hourly window is made of 12 buckets of 5 minutes
+_HOUR_BUCKET = 3600  # daily window is made of 24 buckets of 1 hour
+_MINUTE_BUCKETS = 3600 // _MINUTE_BUCKET
+_HOUR_BUCKETS = 24
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS user_usage (
+    user_id INTEGER PRIMARY KEY,
+    minute INTEGER NOT NULL,
+    hour INTEGER NOT NULL,
+    minutes BLOB NOT NULL,
+    hours BLOB NOT NULL
+);
+"""
+
+
+class UserUsage:
+    """
+    Sliding hourly and daily token counters of one user.\n
+    Counters are rings of buckets in arrays, expired buckets are dropped lazily when user is touched
+    """
+
+    __slots__ = ("minutes", "hours", "minute", "hour", "hourly", "daily")
+
+    def __init__(self):
+        self.minutes = array('Q', bytes(8 * _MINUTE_BUCKETS))
+        self.hours = array('Q', bytes(8 * _HOUR_BUCKETS))
+        self.minute = 0  # number of the last touched 5 minute bucket since epoch
+        self.hour = 0  # number of the last touched hour bucket since epoch
+        self.hourly = 0  # sum of `minutes`
+        self.daily = 0  # sum of `hours`
+
+    def advance(self, now: float) -> None:
+        """ Drops buckets which left the windows by `now` """
+        minute = int(now // _MINUTE_BUCKET)
+        for step in range(1, min(minute - self.minute, _MINUTE_BUCKETS) + 1):
+            index = (self.minute + step) % _MINUTE_BUCKETS
+            self.hourly -= self.minutes[index]
+            self.minutes[index] = 0
+        self.minute = max(self.minute, minute)
+
+        hour = int(now // _HOUR_BUCKET)
+        for step in range(1, min(hour - self.hour, _HOUR_BUCKETS) + 1):
+            index = (self.hour + step) % _HOUR_BUCKETS
+            self.daily -= self.hours[index]
+            self.hours[index] = 0
+        self.hour = max(self.hour, hour)
+
+    def add(self, tokens: int, now: float) -> None:
+        self.advance(now)
+        self.minutes[self.minute % _MINUTE_BUCKETS] += tokens
+        self.hours[self.hour % _HOUR_BUCKETS] += tokens
+        self.hourly += tokens
+        self.daily += tokens
+
+
+class TokenQuota:
+    """
+    Per-user token quota with sliding hourly and daily windows.\n
+    Counters live in memory, so checks are cheap enough for every update; changed counters are flushed
+    to local SQLite database every `flush_interval` seconds, so restart does not reset quotas.
+    Use it with `aigrammy.middleware.TokenQuotaMiddleware`
+    """
+
+    def __init__(self,
+                 hourly_limit: int | None = None,
+                 daily_limit: int | None = None,
+                 path: str | None = "aigrammy_quota.sqlite3",
+                 flush_interval: float = 30.0):
+        """
+        :param hourly_limit: tokens which user can consume within any hour, `None` - unlimited
+        :param daily_limit: tokens which user can consume within any 24 hours, `None` - unlimited
+        :param path: path to SQLite database, `None` - counters are kept only in memory
+        :param flush_interval: seconds between flushes of changed counters to database and evictions of idle users
+        """
+        self.hourly_limit = hourly_limit
+        self.daily_limit = daily_limit
+        self.path = path
+        self.flush_interval = flush_interval
+        self._users: dict[int, UserUsage] = {}
+        self._dirty: set[int] = set()
+        self._sqlite = SqliteExecutor("aigrammy-quota", path, _SCHEMA)
+        self._flush_task: asyncio.Task | None = None
+
+    async def start(self) -> None:
+        """ Opens database, restores counters of the last day and starts periodic flush and eviction of idle users """
+        if self.path is not None:
+            await self._sqlite.connect()
+            for user_id, usage in await self._sqlite.run(self._load, int(time.time() // _HOUR_BUCKET) - _HOUR_BUCKETS):
+                self._users.setdefault(user_id, usage)
+        self._flush_task = asyncio.create_task(self._flush_periodically())
+
+    async def close(self) -> None:
+        if self._flush_task is not None:
+            self._flush_task.cancel()
+            await asyncio.gather(self._flush_task, return_exceptions=True)
+            self._flush_task = None
+        await self.flush()
+        await self._sqlite.close()
+
+    def limits(self, user_id: int) -> tuple[int | None, int | None]:
+        """ Returns hourly and daily limits of user. Override it to give users different quotas """
+        return self.hourly_limit, self.daily_limit
+
+    def usage(self, user_id: int) -> tuple[int, int]:
+        """ Returns tokens consumed by user within the last hour and the last day """
+        usage = self._users.get(user_id)
+        if usage is None:
+            return 0, 0
+        usage.advance(time.time())
+        return usage.hourly, usage.daily
+
+    def allowed(self, user_id: int) -> bool:
+        """ Returns `False` if user has exhausted any of their limits """
+        hourly_limit, daily_limit = self.limits(user_id)
+        if hourly_limit is None and daily_limit is None:
+            return True
+        hourly, daily = self.usage(user_id)
+        return (hourly_limit is None or hourly < hourly_limit) and (daily_limit is None or daily < daily_limit)
+
+    def charge(self, user_id: int, tokens: int) -> None:
+        """ Adds consumed tokens to counters of user """
+        if tokens <= 0:
+            return
+        usage = self._users.get(user_id)
+        if usage is None:
+            usage = self._users[user_id] = UserUsage()
+        usage.add(tokens, time.time())
+        if self.path is not None:
+            self._dirty.add(user_id)
+
+    async def flush(self) -> None:
+        """ Writes changed counters to database """
+        if self._db is None or not self._dirty:
+            return
+        dirty, self._dirty = self._dirty, set()
+        rows = []
+        for user_id in dirty:
+            usage = self._users[user_id]
+            rows.append((user_id, usage.minute, usage.hour, usage.minutes.tobytes(), usage.hours.tobytes()))
+        await self._sqlite.run(self._store, rows)
+
+    async def _flush_periodically(self) -> None:
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            try:
+                await self.flush()
+            except Exception as e:
+                logging.warning(f"aigrammy: failed to flush token quota counters. Error: {e}")
+            self._evict_idle()
+
+    def _evict_idle(self) -> None:
+        """ Forgets users without usage within the last day, their counters are empty anyway """
+        hour = int(time.time() // _HOUR_BUCKET)
+        idle = [user_id for user_id, usage in self._users.items()
+                if hour - usage.hour >= _HOUR_BUCKETS and user_id not in self._dirty]
+        for user_id in idle:
+            del self._users[user_id]
+
+    @property
+    def _db(self) -> sqlite3.Connection | None:
+        return self._sqlite.db
+
+    # region: blocking SQLite operations, executed by `_sqlite`
+    def _load(self, since_hour: int) -> list[tuple[int, UserUsage]]:
+        loaded = []
+        rows = self._db.execute("SELECT user_id, minute, hour, minutes, hours FROM user_usage WHERE hour > ?",
+                                (since_hour,))
+        for user_id, minute, hour, minutes, hours in rows:
+            usage = UserUsage()
+            usage.minute, usage.hour = minute, hour
+            usage.minutes = array('Q', minutes)
+            usage.hours = array('Q', hours)
+            usage.hourly, usage.daily = sum(usage.minutes), sum(usage.hours)
+            loaded.append((user_id, usage))
+        return loaded
+
+    def _store(self, rows: list[tuple]) -> None:
+        with self._db:
+            self._db.executemany("INSERT OR REPLACE INTO user_usage (user_id, minute, hour, minutes, hours) "
+                                 "VALUES (?, ?, ?, ?, ?)", rows)
+    # endregion
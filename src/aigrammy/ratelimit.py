@@ -0,0 +1,219 @@
+import asyncio
+import logging
+import re
+import time
+from contextlib import asynccontextmanager
+from typing import AsyncIterator, Mapping
+
+from .state import BaseStateBackend
+
+_DURATION_PART = re.compile(r"(\d+(?:\.\d+)?)(ms|s|m|h)")
+_DURATION_UNITS = {"ms": 0.001, "s": 1.0, "m": 60.0, "h": 3600.0}
+
+
+def parse_reset_duration(value: str | None) -> float | None:
+    """ Parses OpenAI reset durations such as `20ms`, `1s`, `6m0s` to seconds """
+    if not value:
+        return None
+    try:
+        return float(value)
+    except ValueError:
+        pass
+
+    parts = _DURATION_PART.findall(value)
+    if not parts:
+        return None
+    return sum(float(amount) * _DURATION_UNITS[unit] for amount, unit in parts)
+
+
+class _TokenBucket:
+    __slots__ = ("capacity", "rate", "level", "updated_at")
+
+    def __init__(self, per_minute: int):
+        self.capacity = float(per_minute)
+        self.rate = per_minute / 60.0
+        self.level = float(per_minute)
+        self.updated_at = time.monotonic()
+
+    def refill(self, now: float) -> None:
+        self.level = min(self.capacity, self.level + (now - self.updated_at) * self.rate)
+        self.updated_at = now
+
+    def delay(self, amount: float, now: float) -> float:
+        """ Seconds to wait until `amount` is available """
+        self.refill(now)
+        amount = min(amount, self.capacity)
+        if self.level >= amount:
+            return 0.0
+        return (amount - self.level) / self.rate
+
+
+class RateLimitPermit:
+    """ Permit given by `RateLimiter.acquire`. Reconcile it with actual usage when response arrives """
+
+    def __init__(self, limiter: "RateLimiter", estimated_tokens: int, window: int | None = None):
+        self._limiter = limiter
+        self.estimated_tokens = estimated_tokens
+        self._window = window  # shared window in which tokens were reserved
+
+    def reconcile(self, actual_tokens: int) -> None:
+        """ Refunds overestimated tokens or charges underestimated ones """
+        if self._limiter._tokens is not None:
+            self._limiter._tokens.level += self.estimated_tokens - actual_tokens
+        if self._window is not None:
+            self._limiter._reconcile_shared(self._window, actual_tokens - self.estimated_tokens)
+        self.estimated_tokens = actual_tokens
+
+
+class RateLimiter:
+    """
+    Shared limiter of requests-per-minute, tokens-per-minute and concurrent requests.\n
+    Waiting callers are served in FIFO order. Limits are adapted to `x-ratelimit-*` headers
+    and `Retry-After` of OpenAI responses.
+    Share one instance between all repos which use the same API key.
+    With `state` backend, processes of the bot additionally share RPM and TPM budget in one-minute windows
+    (pauses after `429` stay per process).
+    """
+
+    def __init__(self,
+                 requests_per_minute: int | None = None,
+                 tokens_per_minute: int | None = None,
+                 max_concurrency: int | None = None,
+                 state: BaseStateBackend | None = None,
+                 name: str = "default"):
+        """
+        :param requests_per_minute: RPM limit of your account, `None` - unlimited
+        :param tokens_per_minute: TPM limit of your account, `None` - unlimited
+        :param max_concurrency: maximum number of requests in flight (per process), `None` - unlimited
+        :param state: optional shared `aigrammy.state` backend, e.g. `RedisStateBackend`
+        :param name: name of limited account in `state`, limiters with the same name share budget
+        """
+        self.requests_per_minute = requests_per_minute
+        self.tokens_per_minute = tokens_per_minute
+        self.state = state
+        self._prefix = f"aigrammy:ratelimit:{name}:"
+        self._reconciliations: set[asyncio.Task] = set()
+        self._requests = _TokenBucket(requests_per_minute) if requests_per_minute else None
+        self._tokens = _TokenBucket(tokens_per_minute) if tokens_per_minute else None
+        self._semaphore = asyncio.Semaphore(max_concurrency) if max_concurrency else None
+        self._queue = asyncio.Lock()  # `asyncio.Lock` wakes waiters in FIFO order
+        self._paused_until = 0.0
+        self.waiting = 0
+
+    @asynccontextmanager
+    async def acquire(self, estimated_tokens: int = 0) -> AsyncIterator[RateLimitPermit]:
+        """
+        Waits for budget of one request with given estimated tokens and a free concurrency slot.
+        :param estimated_tokens: prompt tokens plus `max_tokens` of request
+        """
+        self.waiting += 1
+        try:
+            async with self._queue:  # only head of the queue waits for budget
+                await self._wait_for_budget(estimated_tokens)
+                window = await self._reserve_shared(estimated_tokens) if self.state is not None else None
+                if self._semaphore is not None:
+                    await self._semaphore.acquire()
+        finally:
+            self.waiting -= 1
+
+        try:
+            yield RateLimitPermit(self, estimated_tokens, window)
+        finally:
+            if self._semaphore is not None:
+                self._semaphore.release()
+
+    async def _wait_for_budget(self, estimated_tokens: int) -> None:
+        while True:
+            now = time.monotonic()
+            delay = max(self._paused_until - now, 0.0)
+            if self._requests is not None:
+                delay = max(delay, self._requests.delay(1, now))
+            if self._tokens is not None:
+                delay = max(delay, self._tokens.delay(estimated_tokens, now))
+            if delay <= 0:
+                break
+            await asyncio.sleep(delay)
+
+        if self._requests is not None:
+            self._requests.level -= 1
+        if self._tokens is not None:
+            self._tokens.level -= estimated_tokens
+
+    async def _reserve_shared(self, estimated_tokens: int) -> int | None:
+        """ Reserves budget in current one-minute window of `state`, waiting for next window if it is spent """
+        while True:
+            window = int(time.time() // 60)
+            amounts, limits = {}, []
+            if self.requests_per_minute:
+                amounts[f"{self._prefix}{window}:requests"] = 1
+                limits.append(self.requests_per_minute)
+            if self.tokens_per_minute:
+                amounts[f"{self._prefix}{window}:tokens"] = min(estimated_tokens, self.tokens_per_minute)
+                limits.append(self.tokens_per_minute)
+            if not amounts:
+                return None
+
+            counts = await self.state.incr_many(amounts, ttl=120)
+            if all(count <= limit for count, limit in zip(counts, limits)):
+                return window
+            # refund reservation and wait for the next window
+            await self.state.incr_many({key: -amount for key, amount in amounts.items()}, ttl=120)
+            await asyncio.sleep(max((window + 1) * 60 - time.time(), 0.01))
+
+    def _reconcile_shared(self, window: int, delta: int) -> None:
+        if not delta or not self.tokens_per_minute or window != int(time.time() // 60):
+            return  # past windows do not matter anymore
+        task = asyncio.ensure_future(self.state.incr_many({f"{self._prefix}{window}:tokens": delta}, ttl=120))
+        self._reconciliations.add(task)
+        task.add_done_callback(self._reconciled)
+
+    def _reconciled(self, task: asyncio.Task) -> None:
+        self._reconciliations.discard(task)
+        if not task.cancelled() and task.exception() is not None:
+            logging.warning(f"aigrammy: failed to reconcile shared rate limit. Error: {task.exception()}")
+
+    def pause(self, seconds: float) -> None:
+        """ Stops serving new requests for given number of seconds """
+        self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+
+    async def wait_resumed(self) -> None:
+        """ Waits until pause, set by `pause` or `Retry-After`, is over """
+        delay = self._paused_until - time.monotonic()
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+    def update_from_headers(self, headers: Mapping[str, str], rate_limited: bool = False) -> None:
+        """
+        Adapts limiter to rate limit headers of OpenAI response.
+        :param headers: response headers
+        :param rate_limited: `True` if response is `429 Too Many Requests`
+        """
+        now = time.monotonic()
+        self._sync_bucket(self._requests, headers.get("x-ratelimit-remaining-requests"), now)
+        self._sync_bucket(self._tokens, headers.get("x-ratelimit-remaining-tokens"), now)
+
+        if not rate_limited:
+            return
+
+        retry_after = parse_reset_duration(headers.get("retry-after-ms"))
+        if retry_after is not None:
+            retry_after /= 1000
+        else:
+            retry_after = parse_reset_duration(headers.get("retry-after"))
+        if retry_after is None:
+            retry_after = max(parse_reset_duration(headers.get("x-ratelimit-reset-requests")) or 0.0,
+                              parse_reset_duration(headers.get("x-ratelimit-reset-tokens")) or 0.0,
+                              1.0)
+        self.pause(retry_after)
+
+    @staticmethod
+    def _sync_bucket(bucket: _TokenBucket | None, remaining: str | None, now: float) -> None:
+        """ Slows down when server reports less budget than expected """
+        if bucket is None or remaining is None:
+            return
+        try:
+            remaining = float(remaining)
+        except ValueError:
+            return
+        bucket.refill(now)
+        bucket.level = min(bucket.level, remaining)
@@ -0,0 +1,113 @@
+import asyncio
+from collections import OrderedDict, deque
+from contextlib import asynccontextmanager
+from typing import AsyncIterator, Hashable
+
+from .exceptions import GptQueueFullException
+
+
+class FairScheduler:
+    """
+    Limits number of concurrently handled requests and orders waiting ones.\n
+    Waiting requests of a higher priority class (lower number) always go first, within a class chats
+    take turns (round-robin), so one busy chat can not starve others. Queues are bounded.
+    Use it with `aigrammy.middleware.SchedulerMiddleware`, or directly via `async with scheduler.slot(...)`
+    """
+
+    def __init__(self,
+                 max_concurrency: int = 10,
+                 priorities: int = 2,
+                 max_queue: int = 1000,
+                 max_queue_per_chat: int = 10):
+        """
+        :param max_concurrency: number of requests handled at the same time
+        :param priorities: number of priority classes. `0` is the highest priority
+        :param max_queue: maximum number of waiting requests of all chats
+        :param max_queue_per_chat: maximum number of waiting requests of one chat
+        """
+        self.max_concurrency = max_concurrency
+        self.max_queue = max_queue
+        self.max_queue_per_chat = max_queue_per_chat
+        self.active = 0
+        self.waiting = 0
+        # per priority class: chats in order of their turn, each with its waiters in order of arrival
+        self._queues: list[OrderedDict[Hashable, deque[asyncio.Future]]] = [OrderedDict() for _ in range(priorities)]
+
+    def position(self, chat_id: Hashable, priority: int = 0) -> int:
+        """ Returns place in queue which request of given chat would take if it was queued now, `0` - no waiting """
+        if self.active < self.max_concurrency and not self.waiting:
+            return 0
+        priority = self._priority(priority)
+        ahead = sum(len(waiters) for queue in self._queues[:priority] for waiters in queue.values())
+        queue = self._queues[priority]
+        own = len(queue.get(chat_id, ()))
+        # round-robin serves every other chat at most `own + 1` times before the new request
+        ahead += sum(min(len(waiters), own + 1) for chat, waiters in queue.items() if chat != chat_id)
+        return ahead + own + 1
+
+    def full(self, chat_id: Hashable, priority: int = 0) -> bool:
+        """ Returns `True` if request of given chat can not be queued now """
+        waiters = self._queues[self._priority(priority)].get(chat_id)
+        return self.waiting >= self.max_queue or (waiters is not None and len(waiters) >= self.max_queue_per_chat)
+
+    @asynccontextmanager
+    async def slot(self, chat_id: Hashable, priority: int = 0) -> AsyncIterator[None]:
+        """ Waits for turn of request and holds a slot while the block is executed """
+        await self.acquire(chat_id, priority)
+        try:
+            yield
+        finally:
+            self.release()
+
+    async def acquire(self, chat_id: Hashable, priority: int = 0) -> None:
+        """ Waits for turn of request. Raises `GptQueueFullException` if it can not be queued """
+        if self.active < self.max_concurrency and not self.waiting:
+            self.active += 1
+            return
+
+        if self.full(chat_id, priority):
+            raise GptQueueFullException(f"Queue of scheduler is full, chat `{chat_id}` can not be queued!")
+
+        queue = self._queues[self._priority(priority)]
+        waiters = queue.get(chat_id)
+        if waiters is None:
+            waiters = queue[chat_id] = deque()
+        future = asyncio.get_running_loop().create_future()
+        waiters.append(future)
+        self.waiting += 1
+        try:
+            await future
+        except asyncio.CancelledError:
+            if future.done() and not future.cancelled():  # slot was handed over just before cancellation
+                self.release()
+            else:
+                self._discard(queue, chat_id, future)
+            raise
+
+    def release(self) -> None:
+        """ Hands slot over to the next waiting request, or frees it """
+        for queue in self._queues:
+            while queue:
+                chat_id, waiters = next(iter(queue.items()))
+                future = waiters.popleft()
+                if waiters:
+                    queue.move_to_end(chat_id)  # chat waits for its next turn behind other chats
+                else:
+                    del queue[chat_id]
+                self.waiting -= 1
+                if not future.cancelled():
+                    future.set_result(None)
+                    return
+        self.active -= 1
+
+    def _discard(self, queue: OrderedDict, chat_id: Hashable, future: asyncio.Future) -> None:
+        waiters = queue.get(chat_id)
+        if waiters is None or future not in waiters:
+            return  # already skipped by `release`
+        waiters.remove(future)
+        self.waiting -= 1
+        if not waiters:
+            del queue[chat_id]
+
+    def _priority(self, priority: int) -> int:
+        return min(max(priority, 0), len(self._queues) - 1)
@@ -0,0 +1,203 @@
+import asyncio
+import json
+import logging
+import os
+import time
+from hashlib import sha256
+
+from openai import AsyncOpenAI
+
+from .types.response import GptResponse
+
+try:
+    import numpy
+except ImportError:  # numpy is required only by `SemanticCache`
+    numpy = None
+
+
+class _EmbeddingBatcher:
+    """ Collects texts of concurrent lookups for `window` seconds and embeds them in one call """
+
+    def __init__(self, client: AsyncOpenAI, model: str, dimensions: int | None, window: float, max_batch: int):
+        self.client = client
+        self.model = model
+        self.dimensions = dimensions
+        self.window = window
+        self.max_batch = max_batch
+        self._texts: list[str] = []
+        self._futures: list[asyncio.Future] = []
+        self._flush_handle: asyncio.TimerHandle | None = None
+        self._requests: set[asyncio.Task] = set()
+
+    async def embed(self, text: str):
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self._texts.append(text)
+        self._futures.append(future)
+        if len(self._texts) >= self.max_batch:
+            self._flush()
+        elif self._flush_handle is None:
+            self._flush_handle = loop.call_later(self.window, self._flush)
+        return await future
+
+    def _flush(self) -> None:
+        if self._flush_handle is not None:
+            self._flush_handle.cancel()
+            self._flush_handle = None
+        texts, futures = self._texts, self._futures
+        self._texts, self._futures = [], []
+        task = asyncio.ensure_future(self._request(texts, futures))
+        self._requests.add(task)
+        task.add_done_callback(self._requested)
+
+    def _requested(self, task: asyncio.Task) -> None:
+        self._requests.discard(task)
+        if not task.cancelled() and task.exception() is not None:
+            logging.warning(f"aigrammy: failed to embed prompts of semantic cache. Error: {task.exception()}")
+
+    async def _request(self, texts: list[str], futures: list[asyncio.Future]) -> None:
+        kwargs = {"dimensions": self.dimensions} if self.dimensions is not None else {}
+        try:
+            response = await self.client.embeddings.create(model=self.model, input=texts, **kwargs)
+        except Exception as e:
+            for future in futures:
+                if not future.done():
+                    future.set_exception(e)
+            return
+
+        for item in response.data:
+            future = futures[item.index]
+            if not future.done():
+                future.set_result(_normalized(item.embedding))
+
+
+class SemanticCache:
+    """
+    Cache of answers to similar prompts, e.g. paraphrased FAQ questions.\n
+    Prompts are embedded (concurrent lookups share one embeddings call) and searched in in-memory
+    `numpy` index by cosine similarity. Answers are returned only for requests with the same model,
+    system prompt and `max_tokens`. Least recently used entries are evicted when index is full.
+    With `path` the index is persisted by `save()`: vectors and answers are written together into one file.
+    Requires `numpy`. Pass it to `GptChatCompletionRepo(semantic_cache=...)`
+    """
+
+    def __init__(self,
+                 client: AsyncOpenAI,
+                 model: str = "text-embedding-3-small",
+                 threshold: float = 0.92,
+                 max_entries: int = 10000,
+                 dimensions: int | None = None,
+                 path: str | None = None,
+                 batch_window: float = 0.005,
+                 max_batch: int = 64):
+        """
+        :param client: instance of `AsyncOpenAI` used for embeddings
+        :param model: embedding model
+        :param threshold: minimal cosine similarity of prompts, from 0 to 1. Higher is stricter
+        :param max_entries: maximum number of stored answers
+        :param dimensions: optional number of dimensions of embeddings, lower is faster and smaller
+        :param path: optional path to file of persisted index, loaded on creation
+        :param batch_window: seconds during which concurrent lookups are collected into one embeddings call
+        :param max_batch: maximum number of texts in one embeddings call
+        """
+        if numpy is None:
+            raise ImportError("SemanticCache requires `numpy`, install it with `pip install numpy`")
+
+        self.threshold = threshold
+        self.max_entries = max_entries
+        self.path = path
+        self.hits = 0
+        self.misses = 0
+        self._batcher = _EmbeddingBatcher(client, model, dimensions, batch_window, max_batch)
+        self._vectors = None  # (max_entries, dimensions) array, allocated on the first embedding
+        self._scopes = numpy.zeros(max_entries, dtype=numpy.int64)
+        self._last_used = numpy.zeros(max_entries, dtype=numpy.float64)
+        self._responses: list[GptResponse | None] = [None] * max_entries
+        self._size = 0
+        if path is not None and os.path.exists(path):
+            self._load()
+
+    def __len__(self) -> int:
+        return self._size
+
+    async def lookup(self, scope: str, prompt: str) -> tuple[GptResponse | None, object]:
+        """
+        Searches answer of similar prompt within scope, e.g. key of model and system prompt.
+        :return: Returns stored response or `None`, and embedding of prompt to pass to `store`
+        """
+        embedding = await self._batcher.embed(prompt)
+        if self._vectors is None or self._size == 0:
+            self.misses += 1
+            return None, embedding
+
+        scope_id = _scope_id(scope)
+        similarities = self._vectors[:self._size] @ embedding
+        similarities[self._scopes[:self._size] != scope_id] = -1.0
+        index = int(numpy.argmax(similarities))
+        if similarities[index] < self.threshold or self._responses[index] is None:
+            self.misses += 1
+            return None, embedding
+
+        self._last_used[index] = time.monotonic()
+        self.hits += 1
+        return self._responses[index], embedding
+
+    def store(self, scope: str, embedding, response: GptResponse) -> None:
+        """ Stores answer of prompt with given embedding, evicting the least recently used one if index is full """
+        embedding = _normalized(embedding)
+        if self._vectors is None:
+            self._vectors = numpy.zeros((self.max_entries, len(embedding)), dtype=numpy.float32)
+
+        if self._size < self.max_entries:
+            index = self._size
+            self._size += 1
+        else:
+            index = int(numpy.argmin(self._last_used))
+
+        self._vectors[index] = embedding
+        self._scopes[index] = _scope_id(scope)
+        self._last_used[index] = time.monotonic()
+        self._responses[index] = response
+
+    def save(self) -> None:
+        """
+        Writes index to `path`, replacing the previous file atomically, so vectors never run ahead of answers.
+        Blocking, call it on shutdown or periodically
+        """
+        if self.path is None or self._vectors is None:
+            return
+        meta = {
+            "responses": [response.to_dict() if response is not None else None
+                          for response in self._responses[:self._size]],
+        }
+        with open(f"{self.path}.tmp", "wb") as file:
+            numpy.savez(file, vectors=self._vectors[:self._size], scopes=self._scopes[:self._size],
+                        meta=numpy.array(json.dumps(meta)))
+        os.replace(f"{self.path}.tmp", self.path)
+
+    def _load(self) -> None:
+        try:
+            with numpy.load(self.path) as data:
+                vectors, scopes, meta = data["vectors"], data["scopes"], json.loads(str(data["meta"]))
+        except (OSError, ValueError, KeyError) as e:
+            logging.warning(f"aigrammy: semantic cache `{self.path}` can not be loaded, it is recreated. Error: {e}")
+            return
+
+        self._size = min(len(vectors), self.max_entries)
+        self._vectors = numpy.zeros((self.max_entries, vectors.shape[1]), dtype=numpy.float32)
+        self._vectors[:self._size] = vectors[:self._size]
+        self._scopes[:self._size] = scopes[:self._size]
+        self._responses[:self._size] = [GptResponse.from_dict(data) if data is not None else None
+                                        for data in meta["responses"][:self._size]]
+
+
+def _normalized(embedding):
+    """ Scales embedding to unit length, so dot product is cosine similarity regardless of embedding model """
+    vector = numpy.asarray(embedding, dtype=numpy.float32)
+    norm = numpy.linalg.norm(vector)
+    return vector / norm if norm > 0 else vector
+
+
+def _scope_id(scope: str) -> int:
+    """ Compact id of scope, so scopes of index entries are compared in vectorized way """
+    return int.from_bytes(sha256(scope.encode("utf-8")).digest()[:8], "little", signed=True)
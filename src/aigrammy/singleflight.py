@@ -0,0 +1,51 @@
+import asyncio
+from typing import Any, Awaitable, Callable
+
+
+class _Call:
+    __slots__ = ("task", "waiters")
+
+    def __init__(self, task: asyncio.Task):
+        self.task = task
+        self.waiters = 0
+
+
+class SingleFlight:
+    """
+    Deduplicates concurrent identical calls.\n
+    While a call for given key is in flight, other callers with the same key await its result
+    instead of starting a new one. Call is cancelled only when every waiter went away.
+    """
+
+    def __init__(self):
+        self._calls: dict[str, _Call] = {}
+
+    def __len__(self) -> int:
+        return len(self._calls)
+
+    async def do(self, key: str, factory: Callable[[], Awaitable[Any]]) -> Any:
+        """
+        :param key: key of the call, e.g. from `aigrammy.cache.make_cache_key`
+        :param factory: callable which creates awaitable of the actual call. Called only by the first caller
+
+        :return: Result of shared call
+        """
+        call = self._calls.get(key)
+        if call is None:
+            call = _Call(asyncio.ensure_future(factory()))
+            self._calls[key] = call
+            call.task.add_done_callback(lambda _: self._forget(key, call))
+
+        call.waiters += 1
+        try:
+            # shield, so cancellation of one waiter does not cancel the call for others
+            return await asyncio.shield(call.task)
+        finally:
+            call.waiters -= 1
+            if call.waiters == 0 and not call.task.done():
+                self._forget(key, call)
+                call.task.cancel()
+
+    def _forget(self, key: str, call: _Call) -> None:
+        if self._calls.get(key) is call:
+            del self._calls[key]
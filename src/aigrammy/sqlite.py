@@ -0,0 +1,47 @@
+import asyncio
+import sqlite3
+from concurrent.futures import ThreadPoolExecutor
+
+
+class SqliteExecutor:
+    """
+    SQLite connection owned by a dedicated thread, so blocking operations are serialized and do not block
+    event loop. Used by SQLite-backed components, e.g. `aigrammy.jobs.JobQueue` and `aigrammy.quota.TokenQuota`
+    """
+
+    def __init__(self, name: str, path: str | None, schema: str = "", **connect_kwargs):
+        """
+        :param name: name of thread, e.g. `aigrammy-jobs`
+        :param path: path to SQLite database, `None` if owner keeps its data only in memory
+        :param schema: SQL script executed when connection is opened
+        :param connect_kwargs: additional arguments of `sqlite3.connect`
+        """
+        self.path = path
+        self.schema = schema
+        self.connect_kwargs = connect_kwargs
+        self.db: sqlite3.Connection | None = None
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix=name)
+
+    async def run(self, func, *args):
+        """ Executes blocking function in the thread of executor """
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._executor, func, *args)
+
+    async def connect(self) -> sqlite3.Connection:
+        return await self.run(self.connection)
+
+    async def close(self) -> None:
+        if self.db is not None:
+            await self.run(self.db.close)
+            self.db = None
+        self._executor.shutdown(wait=False)
+
+    def connection(self) -> sqlite3.Connection:
+        """ Returns connection, opening it on the first call. Blocking, call it only in the thread of executor """
+        if self.db is None:
+            db = sqlite3.connect(self.path, check_same_thread=False, **self.connect_kwargs)
+            db.execute("PRAGMA journal_mode=WAL")
+            if self.schema:
+                db.executescript(self.schema)
+            self.db = db
+        return self.db
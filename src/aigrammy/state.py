@@ -0,0 +1,336 @@
+import asyncio
+import sqlite3
+import time
+from abc import ABC, abstractmethod
+from collections import deque
+from typing import Mapping, Sequence
+
+from .sqlite import SqliteExecutor
+
+_STATE_SCHEMA = """
+CREATE TABLE IF NOT EXISTS state (key TEXT PRIMARY KEY, value BLOB NOT NULL, expires_at REAL NOT NULL);
+"""
+
+
+class BaseStateBackend(ABC):
+    """
+    Interface of key-value state shared between processes or hosts, used by
+    `aigrammy.cache.StateCache`, `aigrammy.threads.ThreadRegistry` and `aigrammy.ratelimit.RateLimiter`.\n
+    Values are bytes, counters of `incr_many` are stored as decimal numbers. Batch methods are
+    a single round trip, implement them with pipelining when backend supports it.
+    """
+
+    @abstractmethod
+    async def get_many(self, keys: Sequence[str]) -> list[bytes | None]:
+        """ Returns values of keys, `None` for missing or expired ones """
+
+    @abstractmethod
+    async def set_many(self, items: Mapping[str, bytes], ttl: float | None = None) -> None:
+        """ Stores values, `ttl` is lifetime in seconds, `None` - forever """
+
+    @abstractmethod
+    async def set_if_absent(self, key: str, value: bytes, ttl: float | None = None) -> bool:
+        """ Stores value only if key is missing. Returns `True` if value was stored """
+
+    @abstractmethod
+    async def incr_many(self, amounts: Mapping[str, int], ttl: float | None = None) -> list[int]:
+        """ Increments counters (missing ones start from zero) and returns their new values """
+
+    @abstractmethod
+    async def delete(self, key: str) -> None:
+        """ Removes key """
+
+    async def get(self, key: str) -> bytes | None:
+        return (await self.get_many([key]))[0]
+
+    async def set(self, key: str, value: bytes, ttl: float | None = None) -> None:
+        await self.set_many({key: value}, ttl)
+
+    async def close(self) -> None:
+        """ Releases connections and files of backend """
+
+
+class InMemoryStateBackend(BaseStateBackend):
+    """ State of current process only. Default for single-process bots and tests """
+
+    def __init__(self):
+        self._data: dict[str, tuple[bytes, float]] = {}
+
+    async def get_many(self, keys: Sequence[str]) -> list[bytes | None]:
+        return [self._get(key) for key in keys]
+
+    async def set_many(self, items: Mapping[str, bytes], ttl: float | None = None) -> None:
+        expires_at = _expires_at(ttl)
+        for key, value in items.items():
+            self._data[key] = (value, expires_at)
+
+    async def set_if_absent(self, key: str, value: bytes, ttl: float | None = None) -> bool:
+        if self._get(key) is not None:
+            return False
+        self._data[key] = (value, _expires_at(ttl))
+        return True
+
+    async def incr_many(self, amounts: Mapping[str, int], ttl: float | None = None) -> list[int]:
+        result = []
+        for key, amount in amounts.items():
+            value = int(self._get(key) or 0) + amount
+            self._data[key] = (str(value).encode(), _expires_at(ttl))
+            result.append(value)
+        return result
+
+    async def delete(self, key: str) -> None:
+        self._data.pop(key, None)
+
+    def _get(self, key: str) -> bytes | None:
+        item = self._data.get(key)
+        if item is None:
+            return None
+        if item[1] < time.time():
+            del self._data[key]
+            return None
+        return item[0]
+
+
+class SQLiteStateBackend(BaseStateBackend):
+    """
+    State shared by processes of one host via SQLite database in WAL mode.\n
+    Operations are executed in a dedicated thread, so they do not block event loop.
+    """
+
+    def __init__(self, path: str = "aigrammy_state.sqlite3", purge_interval: float = 60.0):
+        """
+        :param path: path to SQLite database, the same for all processes
+        :param purge_interval: seconds between removals of expired keys
+        """
+        self.path = path
+        self.purge_interval = purge_interval
+        # autocommit mode, transactions are opened explicitly with `BEGIN IMMEDIATE` to lock against other processes
+        self._sqlite = SqliteExecutor("aigrammy-state", path, _STATE_SCHEMA, isolation_level=None, timeout=10)
+        self._purged_at = time.time()
+
+    async def get_many(self, keys: Sequence[str]) -> list[bytes | None]:
+        return await self._sqlite.run(self._get_many, list(keys))
+
+    async def set_many(self, items: Mapping[str, bytes], ttl: float | None = None) -> None:
+        await self._sqlite.run(self._set_many, dict(items), _expires_at(ttl))
+
+    async def set_if_absent(self, key: str, value: bytes, ttl: float | None = None) -> bool:
+        return await self._sqlite.run(self._set_if_absent, key, value, _expires_at(ttl))
+
+    async def incr_many(self, amounts: Mapping[str, int], ttl: float | None = None) -> list[int]:
+        return await self._sqlite.run(self._incr_many, dict(amounts), _expires_at(ttl))
+
+    async def delete(self, key: str) -> None:
+        await self._sqlite.run(self._delete, key)
+
+    async def close(self) -> None:
+        await self._sqlite.close()
+
+    # region: blocking SQLite operations, executed by `_sqlite`
+    def _get_many(self, keys: list[str]) -> list[bytes | None]:
+        db = self._sqlite.connection()
+        placeholders = ",".join("?" * len(keys))
+        rows = dict(db.execute(f"SELECT key, value FROM state WHERE key IN ({placeholders}) AND expires_at >= ?",
+                               (*keys, time.time())).fetchall())
+        return [rows.get(key) for key in keys]
+
+    def _set_many(self, items: dict[str, bytes], expires_at: float) -> None:
+        db = self._sqlite.connection()
+        db.execute("BEGIN IMMEDIATE")
+        try:
+            db.executemany("INSERT OR REPLACE INTO state (key, value, expires_at) VALUES (?, ?, ?)",
+                           [(key, value, expires_at) for key, value in items.items()])
+            self._purge(db)
+            db.execute("COMMIT")
+        except BaseException:
+            db.execute("ROLLBACK")
+            raise
+
+    def _set_if_absent(self, key: str, value: bytes, expires_at: float) -> bool:
+        db = self._sqlite.connection()
+        db.execute("BEGIN IMMEDIATE")
+        try:
+            db.execute("DELETE FROM state WHERE key = ? AND expires_at < ?", (key, time.time()))
+            cursor = db.execute("INSERT OR IGNORE INTO state (key, value, expires_at) VALUES (?, ?, ?)",
+                                (key, value, expires_at))
+            db.execute("COMMIT")
+        except BaseException:
+            db.execute("ROLLBACK")
+            raise
+        return cursor.rowcount == 1
+
+    def _incr_many(self, amounts: dict[str, int], expires_at: float) -> list[int]:
+        db = self._sqlite.connection()
+        now = time.time()
+        result = []
+        db.execute("BEGIN IMMEDIATE")
+        try:
+            for key, amount in amounts.items():
+                row = db.execute("SELECT value FROM state WHERE key = ? AND expires_at >= ?", (key, now)).fetchone()
+                value = int(row[0] if row else 0) + amount
+                db.execute("INSERT OR REPLACE INTO state (key, value, expires_at) VALUES (?, ?, ?)",
+                           (key, str(value).encode(), expires_at))
+                result.append(value)
+            db.execute("COMMIT")
+        except BaseException:
+            db.execute("ROLLBACK")
+            raise
+        return result
+
+    def _delete(self, key: str) -> None:
+        self._sqlite.connection().execute("DELETE FROM state WHERE key = ?", (key,))
+
+    def _purge(self, db: sqlite3.Connection) -> None:
+        now = time.time()
+        if now - self._purged_at >= self.purge_interval:
+            db.execute("DELETE FROM state WHERE expires_at < ?", (now,))
+            self._purged_at = now
+    # endregion
+
+
+class RedisError(Exception):
+    """ Error reply of Redis server """
+
+
+class RedisStateBackend(BaseStateBackend):
+    """
+    State shared by processes and hosts via Redis (or any server speaking its protocol).\n
+    Uses one connection with pipelining: commands of concurrent callers are written without waiting
+    for replies, and batch methods are sent as one pipeline, so every call costs one round trip.
+    """
+
+    def __init__(self, host: str = "127.0.0.1", port: int = 6379, db: int = 0, password: str | None = None):
+        """
+        :param host: host of Redis server
+        :param port: port of Redis server
+        :param db: number of Redis database
+        :param password: optional password of Redis server
+        """
+        self.host = host
+        self.port = port
+        self.db = db
+        self.password = password
+        self._reader: asyncio.StreamReader | None = None
+        self._writer: asyncio.StreamWriter | None = None
+        self._pending: deque[asyncio.Future] = deque()
+        self._read_task: asyncio.Task | None = None
+        self._connect_lock = asyncio.Lock()
+
+    async def execute(self, *commands: Sequence) -> list:
+        """ Sends commands as one pipeline and returns their replies. Error replies are raised as `RedisError` """
+        if self._writer is None:
+            await self._connect()
+
+        loop = asyncio.get_running_loop()
+        futures = [loop.create_future() for _ in commands]
+        self._pending.extend(futures)  # replies arrive in order of commands, no await between queueing and write
+        self._writer.write(b"".join(_encode(command) for command in commands))
+        await self._writer.drain()
+        return list(await asyncio.gather(*futures))
+
+    async def get_many(self, keys: Sequence[str]) -> list[bytes | None]:
+        return (await self.execute(("MGET", *keys)))[0]
+
+    async def set_many(self, items: Mapping[str, bytes], ttl: float | None = None) -> None:
+        await self.execute(*(("SET", key, value, *_px(ttl)) for key, value in items.items()))
+
+    async def set_if_absent(self, key: str, value: bytes, ttl: float | None = None) -> bool:
+        return (await self.execute(("SET", key, value, "NX", *_px(ttl))))[0] is not None
+
+    async def incr_many(self, amounts: Mapping[str, int], ttl: float | None = None) -> list[int]:
+        commands = []
+        for key, amount in amounts.items():
+            commands.append(("INCRBY", key, amount))
+            if ttl is not None:
+                commands.append(("PEXPIRE", key, int(ttl * 1000)))
+        replies = await self.execute(*commands)
+        return replies[::2] if ttl is not None else replies
+
+    async def delete(self, key: str) -> None:
+        await self.execute(("DEL", key))
+
+    async def close(self) -> None:
+        if self._read_task is not None:
+            self._read_task.cancel()
+            await asyncio.gather(self._read_task, return_exceptions=True)
+        self._disconnect(ConnectionError("Redis backend is closed"))
+
+    async def _connect(self) -> None:
+        async with self._connect_lock:
+            if self._writer is not None:
+                return
+            self._reader, self._writer = await asyncio.open_connection(self.host, self.port)
+            self._read_task = asyncio.create_task(self._read_replies(self._reader))
+            commands = []
+            if self.password is not None:
+                commands.append(("AUTH", self.password))
+            if self.db:
+                commands.append(("SELECT", self.db))
+            if commands:
+                await self.execute(*commands)
+
+    async def _read_replies(self, reader: asyncio.StreamReader) -> None:
+        try:
+            while True:
+                reply = await _read_reply(reader)
+                future = self._pending.popleft()
+                if future.done():
+                    continue
+                if isinstance(reply, RedisError):
+                    future.set_exception(reply)
+                else:
+                    future.set_result(reply)
+        except (ConnectionError, asyncio.IncompleteReadError) as e:
+            self._disconnect(ConnectionError(f"Connection to Redis was lost: {e}"))
+
+    def _disconnect(self, error: Exception) -> None:
+        """ Fails commands waiting for replies, the next command opens a new connection """
+        if self._writer is not None:
+            self._writer.close()
+        self._reader = self._writer = self._read_task = None
+        while self._pending:
+            future = self._pending.popleft()
+            if not future.done():
+                future.set_exception(error)
+
+
+def _encode(command: Sequence) -> bytes:
+    """ Encodes command as RESP array of bulk strings """
+    parts = [b"*%d\r\n" % len(command)]
+    for argument in command:
+        if isinstance(argument, str):
+            argument = argument.encode("utf-8")
+        elif isinstance(argument, int):
+            argument = str(argument).encode()
+        parts.append(b"$%d\r\n%s\r\n" % (len(argument), argument))
+    return b"".join(parts)
+
+
+async def _read_reply(reader: asyncio.StreamReader):
+    line = await reader.readuntil(b"\r\n")
+    kind, payload = line[:1], line[1:-2]
+    if kind == b"+":
+        return payload.decode()
+    if kind == b"-":
+        return RedisError(payload.decode())
+    if kind == b":":
+        return int(payload)
+    if kind == b"$":
+        length = int(payload)
+        if length < 0:
+            return None
+        return (await reader.readexactly(length + 2))[:-2]
+    if kind == b"*":
+        length = int(payload)
+        if length < 0:
+            return None
+        return [await _read_reply(reader) for _ in range(length)]
+    raise ConnectionError(f"Unexpected reply of Redis: {line!r}")
+
+
+def _px(ttl: float | None) -> tuple:
+    return ("PX", max(int(ttl * 1000), 1)) if ttl is not None else ()
+
+
+def _expires_at(ttl: float | None) -> float:
+    return time.time() + ttl if ttl is not None else float("inf")
@@ -0,0 +1,70 @@
+import asyncio
+import logging
+import time
+
+from aiogram.exceptions import TelegramBadRequest, TelegramRetryAfter
+from aiogram.types import Message
+
+from .types.response import GptResponse
+from .types.stream import GptStream
+
+TELEGRAM_MESSAGE_LIMIT = 4096
+
+
+async def stream_to_message(
+        stream: GptStream,
+        message: Message,
+        edit_interval: float = 1.0,
+        min_delta_chars: int = 16,
+        cursor: str = " ▌",
+        parse_mode: str | None = None
+) -> GptResponse:
+    """
+    Progressively edits given telegram message with text of `GptStream`.\n
+    Deltas are coalesced, so message is edited at most once per `edit_interval` seconds.
+    Telegram's `RetryAfter` postpones next edit instead of stopping the stream.
+    :param stream: instance of `GptStream`, e.g. from `GptChatCompletionRepo.stream_text`
+    :param message: message which will be edited, e.g. "Asking GPT..." placeholder sent by bot
+    :param edit_interval: minimal delay between two edits in seconds. Use ~3 seconds for group chats
+    :param min_delta_chars: minimal number of new characters required for intermediate edit
+    :param cursor: suffix shown after text until stream is finished
+    :param parse_mode: parse mode of edited text. `None` by default, since GPT output is not escaped
+
+    :return: Returns the final `aiogpt.models.GptResponse` instance
+    """
+    shown_length = 0
+    next_edit_at = time.monotonic()
+
+    async for _ in stream:
+        now = time.monotonic()
+        text = stream.text
+        if now < next_edit_at or len(text) - shown_length < min_delta_chars or not text.strip():
+            continue
+
+        try:
+            await _edit(message, text + cursor, parse_mode)
+            shown_length = len(text)
+            next_edit_at = now + edit_interval
+        except TelegramRetryAfter as e:
+            next_edit_at = now + e.retry_after
+
+    # final edit must not be skipped, so wait for flood control here
+    while stream.text.strip():
+        try:
+            await _edit(message, stream.text, parse_mode)
+            break
+        except TelegramRetryAfter as e:
+            await asyncio.sleep(e.retry_after)
+
+    return stream.response
+
+
+async def _edit(message: Message, text: str, parse_mode: str | None) -> None:
+    if len(text) > TELEGRAM_MESSAGE_LIMIT:
+        text = text[:TELEGRAM_MESSAGE_LIMIT]
+
+    try:
+        await message.edit_text(text=text, parse_mode=parse_mode)
+    except TelegramBadRequest as e:
+        if "message is not modified" not in e.message:
+            logging.warning(f"aigrammy: failed to edit streamed message. Error: {e}")
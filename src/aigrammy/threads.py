@@ -0,0 +1,194 @@
+import asyncio
+import logging
+import sqlite3
+from collections import OrderedDict, deque
+
+from .pool import ClientPool
+from .singleflight import SingleFlight
+from .sqlite import SqliteExecutor
+from .state import BaseStateBackend
+from .types.assistant import GptAssistantRepo
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS chat_threads (chat_id INTEGER PRIMARY KEY, thread_id TEXT NOT NULL, owner TEXT);
+CREATE TABLE IF NOT EXISTS thread_pool (thread_id TEXT PRIMARY KEY, owner TEXT);
+"""
+
+
+class ThreadRegistry:
+    """
+    Persistent mapping of telegram chats to assistant threads.\n
+    Mappings are cached in memory (LRU) and stored in local SQLite database, so restart does not lose them.
+    A pool of pre-created threads is kept, so the first message of a new chat does not wait for thread creation.
+    With `aigrammy.pool.ClientPool` the owner of every thread is stored too, so it is bound again after restart.
+    With `state` backend mappings are shared by processes of the bot (pool is kept per process in memory);
+    note that `reset` in one process is seen by others only after their in-memory cache evicts the chat.
+    """
+
+    def __init__(self,
+                 repo: GptAssistantRepo,
+                 path: str = "aigrammy_threads.sqlite3",
+                 cache_size: int = 10000,
+                 pool_size: int = 10,
+                 state: BaseStateBackend | None = None,
+                 prefix: str = "aigrammy:thread:"):
+        """
+        :param repo: instance of `GptAssistantRepo`, used to create threads
+        :param path: path to SQLite database
+        :param cache_size: number of mappings cached in memory
+        :param pool_size: number of pre-created threads. `0` disables pool
+        :param state: optional shared `aigrammy.state` backend, which replaces SQLite database
+        :param prefix: prefix of keys in `state`
+        """
+        self.repo = repo
+        self.path = path
+        self.cache_size = cache_size
+        self.pool_size = pool_size
+        self.state = state
+        self.prefix = prefix
+        self._cache: OrderedDict[int, tuple[str, str | None]] = OrderedDict()  # chat -> thread and its owner
+        self._pool: deque[tuple[str, str | None]] = deque()
+        self._single_flight = SingleFlight()
+        self._sqlite = SqliteExecutor("aigrammy-threads", path, _SCHEMA)
+        self._refill_needed = asyncio.Event()
+        self._refill_task: asyncio.Task | None = None
+
+    async def start(self) -> None:
+        """ Opens database, restores pool of threads and starts background refill of pool """
+        if self.state is None:
+            await self._sqlite.run(self._connect)
+            self._pool.extend(await self._sqlite.run(self._load_pool))
+            for thread_id, owner in self._pool:
+                self._bind(thread_id, owner)
+        if self.pool_size > 0:
+            self._refill_task = asyncio.create_task(self._refill())
+            self._refill_needed.set()
+
+    async def close(self) -> None:
+        if self._refill_task is not None:
+            self._refill_task.cancel()
+            await asyncio.gather(self._refill_task, return_exceptions=True)
+            self._refill_task = None
+        await self._sqlite.close()
+
+    async def get_thread_id(self, chat_id: int) -> str:
+        """ Returns thread of given chat, assigning a new one if chat has none """
+        cached = self._cache.get(chat_id)
+        if cached is not None:
+            self._cache.move_to_end(chat_id)
+            self._bind(*cached)  # owner may have been evicted from affinity of pool
+            return cached[0]
+        # concurrent first messages of the same chat must get the same thread
+        return await self._single_flight.do(str(chat_id), lambda: self._resolve(chat_id))
+
+    async def reset(self, chat_id: int) -> None:
+        """ Forgets thread of chat, so the next message starts a new conversation """
+        self._cache.pop(chat_id, None)
+        if self.state is not None:
+            await self.state.delete(f"{self.prefix}{chat_id}")
+        else:
+            await self._sqlite.run(self._delete_mapping, chat_id)
+
+    async def _resolve(self, chat_id: int) -> str:
+        thread = await self._load(chat_id)
+        if thread is None:
+            if self._pool:
+                thread = self._pool.popleft()
+            else:
+                thread_id = (await self.repo.create_thread()).id
+                thread = (thread_id, self._owner(thread_id))
+            stored = await self._store(chat_id, thread)
+            if stored != thread:  # other process has assigned thread first, keep ours for the next chat
+                self._pool.appendleft(thread)
+                thread = stored
+            self._refill_needed.set()
+
+        self._bind(*thread)
+        self._remember(chat_id, thread)
+        return thread[0]
+
+    async def _load(self, chat_id: int) -> tuple[str, str | None] | None:
+        if self.state is None:
+            return await self._sqlite.run(self._load_mapping, chat_id)
+        value = await self.state.get(f"{self.prefix}{chat_id}")
+        if value is None:
+            return None
+        thread_id, _, owner = value.decode().partition(" ")
+        return thread_id, owner or None
+
+    async def _store(self, chat_id: int, thread: tuple[str, str | None]) -> tuple[str, str | None]:
+        """ Stores mapping unless chat already has thread. Returns thread of chat and its owner """
+        if self.state is None:
+            await self._sqlite.run(self._store_mapping, chat_id, *thread)
+            return thread
+        thread_id, owner = thread
+        value = f"{thread_id} {owner}" if owner is not None else thread_id  # ids of threads have no spaces
+        if await self.state.set_if_absent(f"{self.prefix}{chat_id}", value.encode()):
+            return thread
+        return await self._load(chat_id) or thread
+
+    def _owner(self, thread_id: str) -> str | None:
+        """ Returns name of pool member which owns thread, `None` without `ClientPool` """
+        if not isinstance(self.repo.client, ClientPool):
+            return None
+        member = self.repo.client.owner(thread_id)
+        return member.name if member is not None else None
+
+    def _bind(self, thread_id: str, owner: str | None) -> None:
+        if owner is not None and isinstance(self.repo.client, ClientPool):
+            self.repo.client.bind_thread(thread_id, owner)
+
+    def _remember(self, chat_id: int, thread: tuple[str, str | None]) -> None:
+        self._cache[chat_id] = thread
+        self._cache.move_to_end(chat_id)
+        while len(self._cache) > self.cache_size:
+            self._cache.popitem(last=False)
+
+    async def _refill(self) -> None:
+        while True:
+            await self._refill_needed.wait()
+            self._refill_needed.clear()
+            while len(self._pool) < self.pool_size:
+                try:
+                    thread_id = (await self.repo.create_thread()).id
+                except Exception as e:
+                    logging.warning(f"aigrammy: failed to pre-create assistant thread. Error: {e}")
+                    await asyncio.sleep(5)
+                    continue
+                owner = self._owner(thread_id)
+                if self._db is not None:
+                    await self._sqlite.run(self._store_pooled, thread_id, owner)
+                self._pool.append((thread_id, owner))
+
+    @property
+    def _db(self) -> sqlite3.Connection | None:
+        return self._sqlite.db
+
+    # region: blocking SQLite operations, executed by `_sqlite`
+    def _connect(self) -> None:
+        db = self._sqlite.connection()
+        for table in ("chat_threads", "thread_pool"):  # databases created before owners were stored
+            if "owner" not in [row[1] for row in db.execute(f"PRAGMA table_info({table})")]:
+                db.execute(f"ALTER TABLE {table} ADD COLUMN owner TEXT")
+
+    def _load_pool(self) -> list[tuple[str, str | None]]:
+        return [tuple(row) for row in self._db.execute("SELECT thread_id, owner FROM thread_pool")]
+
+    def _load_mapping(self, chat_id: int) -> tuple[str, str | None] | None:
+        row = self._db.execute("SELECT thread_id, owner FROM chat_threads WHERE chat_id = ?", (chat_id,)).fetchone()
+        return tuple(row) if row else None
+
+    def _store_mapping(self, chat_id: int, thread_id: str, owner: str | None) -> None:
+        with self._db:
+            self._db.execute("INSERT OR REPLACE INTO chat_threads (chat_id, thread_id, owner) VALUES (?, ?, ?)",
+                             (chat_id, thread_id, owner))
+            self._db.execute("DELETE FROM thread_pool WHERE thread_id = ?", (thread_id,))
+
+    def _store_pooled(self, thread_id: str, owner: str | None) -> None:
+        with self._db:
+            self._db.execute("INSERT OR IGNORE INTO thread_pool (thread_id, owner) VALUES (?, ?)", (thread_id, owner))
+
+    def _delete_mapping(self, chat_id: int) -> None:
+        with self._db:
+            self._db.execute("DELETE FROM chat_threads WHERE chat_id = ?", (chat_id,))
+    # endregion
@@ -0,0 +1,192 @@
+import logging
+import math
+from collections import OrderedDict
+from typing import Callable, Literal
+
+from .exceptions import GptPromptTooLongException
+from .models import CONTEXT_WINDOWS
+
+try:
+    import tiktoken
+except ImportError:  # tiktoken is optional, without it tokens are estimated by length of text
+    tiktoken = None
+
+_MESSAGE_OVERHEAD = 3  # tokens of role and separators of each message
+_REPLY_PRIMING = 3  # every reply is primed with `<|start|>assistant<|message|>`
+_IMAGE_TOKENS = {"low": 85, "high": 765, "auto": 765}  # `high` is estimated as one 512px tile
+
+
+def estimate_text_tokens(text: str, chars_per_token: float = 4.0) -> int:
+    """ Estimates tokens of text by its length, used without `tiktoken` """
+    return math.ceil(len(text) / chars_per_token)
+
+
+def estimate_message_tokens(text: str) -> int:
+    """ Estimates tokens of message with given text, e.g. default counter of `aigrammy.memory.ConversationStore` """
+    return estimate_text_tokens(text) + _MESSAGE_OVERHEAD
+
+
+def estimate_tokens(messages: list) -> int:
+    """ Estimates prompt tokens of messages in OpenAI format by length of text, e.g. when repo has no estimator """
+    return _count_messages(messages, estimate_text_tokens)
+
+
+def _count_messages(messages: list, count_text: Callable[[str], int],
+                    count_system: Callable[[str], int] | None = None) -> int:
+    tokens = _REPLY_PRIMING
+    for message in messages:
+        tokens += _MESSAGE_OVERHEAD
+        content = message["content"]
+        if isinstance(content, str):
+            counter = count_system if count_system is not None and message["role"] == "system" else count_text
+            tokens += counter(content)
+            continue
+        for part in content:
+            if part["type"] == "text":
+                tokens += count_text(part["text"])
+            else:  # `image_url` or `image_file` part
+                detail = part.get(part["type"], {}).get("detail", "auto")
+                tokens += _IMAGE_TOKENS.get(detail, _IMAGE_TOKENS["auto"])
+    return tokens
+
+
+class TokenEstimator:
+    """
+    Local counter of prompt tokens.\n
+    Uses `tiktoken` when installed (encoding is loaded lazily and cached per model), otherwise
+    estimates ~4 characters per token. Counts of system prompts are memoized, since they are static.
+    """
+
+    def __init__(self,
+                 default_context_window: int = 8192,
+                 context_windows: dict[str, int] | None = None,
+                 chars_per_token: float = 4.0,
+                 memo_size: int = 128):
+        """
+        :param default_context_window: context window of models missing in `aigrammy.models.CONTEXT_WINDOWS`
+        :param context_windows: additional context windows of models, e.g. of fine-tuned ones
+        :param chars_per_token: characters per token used when `tiktoken` is not installed
+        :param memo_size: number of memoized system prompt counts
+        """
+        self.default_context_window = default_context_window
+        self.context_windows = {**CONTEXT_WINDOWS, **(context_windows or {})}
+        self.chars_per_token = chars_per_token
+        self.memo_size = memo_size
+        self._encodings: dict[str, object] = {}
+        self._memo: OrderedDict[tuple[str, str], int] = OrderedDict()
+        self._windows: dict[str, int] = {}  # resolved context windows of model names
+
+    def context_window(self, model: str) -> int:
+        """ Returns context window of model, or of the longest known prefix of it, e.g. of dated snapshot """
+        window = self._windows.get(model)
+        if window is not None:
+            return window
+
+        name = model.removeprefix("ft:")  # fine-tuned models start with `ft:{base model}:`
+        prefixes = [prefix for prefix in self.context_windows if name.startswith(prefix)]
+        if prefixes:
+            window = self.context_windows[max(prefixes, key=len)]
+        else:
+            window = self.default_context_window
+            logging.warning(f"aigrammy: context window of `{model}` is unknown, {window} tokens are assumed. "
+                            f"Pass it in `TokenEstimator(context_windows=...)`")
+        self._windows[model] = window
+        return window
+
+    def count_text(self, text: str, model: str) -> int:
+        encoding = self._encoding(model)
+        if encoding is None:
+            return estimate_text_tokens(text, self.chars_per_token)
+        return len(encoding.encode(text, disallowed_special=()))
+
+    def count_messages(self, messages: list, model: str) -> int:
+        """ Counts prompt tokens of messages in OpenAI format """
+        return _count_messages(messages,
+                               lambda text: self.count_text(text, model),
+                               lambda text: self._count_memoized(text, model))
+
+    def counter(self, model: str) -> Callable[[str], int]:
+        """ Returns counter of given model, e.g. for `aigrammy.memory.ConversationStore(token_counter=...)` """
+        return lambda text: self.count_text(text, model) + _MESSAGE_OVERHEAD
+
+    def truncate_text(self, text: str, max_tokens: int, model: str) -> str:
+        """ Cuts text to given number of tokens """
+        if max_tokens <= 0:
+            return ""
+        encoding = self._encoding(model)
+        if encoding is None:
+            return text[:int(max_tokens * self.chars_per_token)]
+        tokens = encoding.encode(text, disallowed_special=())
+        return text if len(tokens) <= max_tokens else encoding.decode(tokens[:max_tokens])
+
+    def fit(self,
+            messages: list,
+            max_tokens: int,
+            model: str,
+            policy: Literal["error", "truncate"] = "error",
+            min_completion_tokens: int = 64) -> tuple[list, int, int]:
+        """
+        Fits request into context window of model: lowers `max_tokens` to the space left by prompt,
+        and if there is no space for `min_completion_tokens`, raises or truncates the last user message.
+        Truncated prompt leaves space for `max_tokens`, but not more than quarter of context window.
+
+        :return: Returns messages, fitted `max_tokens` and number of prompt tokens
+        """
+        window = self.context_window(model)
+        prompt_tokens = self.count_messages(messages, model)
+        available = window - prompt_tokens
+        if available < min_completion_tokens:
+            if policy == "error":
+                raise GptPromptTooLongException(f"Prompt has {prompt_tokens} tokens, "
+                                                f"context window of `{model}` is {window} tokens!")
+            reserve = max(min_completion_tokens, min(max_tokens, window // 4))
+            messages = self._truncate_last_user_message(messages, prompt_tokens - window + reserve, model)
+            prompt_tokens = self.count_messages(messages, model)
+            available = window - prompt_tokens
+            if available < min_completion_tokens:
+                raise GptPromptTooLongException(f"Prompt does not fit into context window of `{model}` "
+                                                f"even after truncation!")
+            logging.warning(f"aigrammy: prompt was truncated to {prompt_tokens} tokens to fit `{model}`")
+
+        return messages, min(max_tokens, available), prompt_tokens
+
+    def _truncate_last_user_message(self, messages: list, excess: int, model: str) -> list:
+        for index in range(len(messages) - 1, -1, -1):
+            message = messages[index]
+            if message["role"] != "user":
+                continue
+
+            content = message["content"]
+            if isinstance(content, str):
+                keep = self.count_text(content, model) - excess
+                content = self.truncate_text(content, keep, model)
+            else:
+                content = [
+                    {**part, "text": self.truncate_text(part["text"], self.count_text(part["text"], model) - excess,
+                                                        model)}
+                    if part["type"] == "text" else part
+                    for part in content
+                ]
+            return [*messages[:index], {**message, "content": content}, *messages[index + 1:]]
+        return messages
+
+    def _count_memoized(self, text: str, model: str) -> int:
+        key = (model, text)
+        tokens = self._memo.get(key)
+        if tokens is None:
+            tokens = self._memo[key] = self.count_text(text, model)
+            if len(self._memo) > self.memo_size:
+                self._memo.popitem(last=False)
+        return tokens
+
+    def _encoding(self, model: str):
+        if tiktoken is None:
+            return None
+        encoding = self._encodings.get(model)
+        if encoding is None:
+            try:
+                encoding = tiktoken.encoding_for_model(model)
+            except KeyError:
+                encoding = tiktoken.get_encoding("o200k_base")
+            self._encodings[model] = encoding
+        return encoding
@@ -1,24 +1,61 @@
+import asyncio
+import itertools
 import logging
+import time
 from base64 import b64encode
-from typing import BinaryIO, Literal
+from contextlib import nullcontext
+from hashlib import sha256
+from typing import BinaryIO, Literal, Sequence
 
-from openai import AsyncOpenAI
+from openai import NOT_GIVEN, AsyncOpenAI
 from openai.types.beta import Thread
 from openai.types.beta.threads import Run
 
+from ..cache import FileIdCache
+from ..context import record_usage, remaining_time
+from ..exceptions import GptTimeoutException
+from ..imaging import ImagePreprocessor, detect_mime_type
+from ..metrics import BaseMetrics
+from ..pool import ClientPool
+from ..ratelimit import RateLimiter
 from ..types.response import GptResponse
+from ..types.stream import GptStream
+
+# delays between polls of run status: short at first, since most runs finish within a few seconds
+DEFAULT_POLL_SCHEDULE = (0.1, 0.2, 0.3, 0.5, 0.75, 1.0, 1.5, 2.0)
+_TERMINAL_STATUSES = frozenset(("completed", "incomplete", "failed", "cancelled", "expired", "requires_action"))
+_TERMINAL_EVENTS = frozenset(f"thread.run.{status}" for status in _TERMINAL_STATUSES)
 
 
 class GptAssistantRepo:
-    def __init__(self, client: AsyncOpenAI,
+    def __init__(self, client: AsyncOpenAI | ClientPool,
                  assistant_id: str | None = None,
-                 run_instructions: str | None = None):
-        self.client = client
+                 run_instructions: str | None = None,
+                 rate_limiter: RateLimiter | None = None,
+                 image_preprocessor: ImagePreprocessor | None = None,
+                 poll_schedule: Sequence[float] = DEFAULT_POLL_SCHEDULE,
+                 upload_images: bool = False,
+                 file_id_cache: FileIdCache | None = None,
+                 metrics: BaseMetrics | None = None):
+        self.client = client  # `AsyncOpenAI`, or `aigrammy.pool.ClientPool`. Threads stay bound to their client
         self.assistant_id = assistant_id
         self.run_instructions = run_instructions
+        self.rate_limiter = rate_limiter  # optional `aigrammy.ratelimit.RateLimiter`, limits runs
+        self.image_preprocessor = image_preprocessor  # optional `aigrammy.imaging.ImagePreprocessor`
+        self.poll_schedule = poll_schedule  # last delay is repeated until run is finished
+        # if `True`, `BinaryIO` images are uploaded once via Files API and referenced by file id
+        self.upload_images = upload_images
+        self.file_id_cache = file_id_cache if file_id_cache is not None else FileIdCache()
+        self.metrics = metrics  # optional instrumentation hooks, e.g. `aigrammy.metrics.PrometheusMetrics`
+        self._cancellations: set[asyncio.Task] = set()  # `runs.cancel` calls of abandoned runs
 
     async def create_thread(self) -> Thread:
-        thr = await self.client.beta.threads.create()
+        if not isinstance(self.client, ClientPool):
+            return await self.client.beta.threads.create()
+
+        member = self.client.pick()  # new threads are balanced, existing ones stay with their owner
+        thr = await member.client.beta.threads.create()
+        self.client.bind_thread(thr.id, member)
         return thr
 
     async def push_prompt_to_thread(
@@ -28,25 +65,23 @@ class GptAssistantRepo:
             max_prompt_tokens: int | None = None,
             max_completion_tokens: int | None = None
     ) -> GptResponse:
-        message = await self.client.beta.threads.messages.create(
+        message = await self._client(thread_id).beta.threads.messages.create(
             thread_id=thread_id,
             role="user",
             content=content
         )
-        run = await self._execute_run(max_completion_tokens, max_prompt_tokens, thread_id)
-        response = await self._match_status(thread_id=thread_id, run=run)
-        return response
+        return await self._run_thread(max_completion_tokens, max_prompt_tokens, thread_id)
 
     async def push_image_url_to_thread(
             self,
             thread_id: int,
             uri: str,
             content: str = "(no additional info was specified)",
-            detail: str = Literal["auto", "low", "high"],
+            detail: Literal["auto", "low", "high"] = "auto",
             max_prompt_tokens: int | None = None,
             max_completion_tokens: int | None = None
     ) -> GptResponse:
-        await self.client.beta.threads.messages.create(
+        await self._client(thread_id).beta.threads.messages.create(
             thread_id=thread_id,
             role='user',
             content=[
@@ -64,38 +99,45 @@ class GptAssistantRepo:
             ]
         )
 
-        run = await self._execute_run(max_completion_tokens, max_prompt_tokens, thread_id)
-        response = await self._match_status(thread_id=thread_id, run=run)
-        return response
+        return await self._run_thread(max_completion_tokens, max_prompt_tokens, thread_id)
 
     async def push_image_binaryio_to_thread(
             self,
             thread_id: str,
             binary_file: BinaryIO,
             content: str = "(no additional info was specified)",
-            detail: str = Literal["auto", "low", "high"],
+            detail: Literal["auto", "low", "high"] = "auto",
             max_prompt_tokens: int | None = None,
-            max_completion_tokens: int | None = None
+            max_completion_tokens: int | None = None,
+            file_unique_id: str | None = None
     ) -> GptResponse:
+        """
+        Pushes image in `BinaryIO` format with given prompt to thread and runs assistant.
+        With `upload_images` image is uploaded via Files API once and reused by its
+        `file_unique_id` (or content hash), instead of sending base64 in every message
+        """
         try:
-            b64_str = self._encode_image(binary_file)
+            if self.upload_images:
+                image_part = await self._upload_image_part(thread_id, binary_file, detail, file_unique_id)
+            else:
+                image_part = {
+                    "type": "image_url",
+                    "image_url": {
+                        "url": await self._to_data_url(binary_file, detail),
+                        "detail": detail
+                    }
+                }
         except Exception as e:
             logging.exception(f"Failed to convert BinaryIO to b64 while sending image to OpenAI. Error: {e}")
             binary_file.close()
             raise e  # try-except used here to close the binary file and avoid potential memory leak
 
-        img_url = f"data:image/jpeg;base64,{b64_str}"
-        await self.client.beta.threads.messages.create(
+        binary_file.close()
+        await self._client(thread_id).beta.threads.messages.create(
             thread_id=thread_id,
             role='user',
             content=[
-                {
-                    "type": "image_url",
-                    "image_url": {
-                        "url": img_url,
-                        "detail": detail
-                    }
-                },
+                image_part,
                 {
                     "type": "text",
                     "text": content
@@ -103,22 +145,166 @@ class GptAssistantRepo:
             ]
         )
 
-        run = await self._execute_run(max_completion_tokens, max_prompt_tokens, thread_id)
-        response = await self._match_status(thread_id=thread_id, run=run)
+        return await self._run_thread(max_completion_tokens, max_prompt_tokens, thread_id)
+
+    def stream_prompt_to_thread(
+            self,
+            content: str,
+            thread_id: str,
+            max_prompt_tokens: int | None = None,
+            max_completion_tokens: int | None = None
+    ) -> GptStream:
+        """
+        Streaming variant of `push_prompt_to_thread`. Message is pushed and run is started on first iteration.
+        Final `GptResponse` is built from run events, so no polling and no extra `messages.list` call are made
+
+        :return: Returns the `aigrammy.types.stream.GptStream` instance
+        """
+        return GptStream(lambda stream: self._stream_run(stream, content, thread_id,
+                                                         max_prompt_tokens, max_completion_tokens))
+
+    async def _stream_run(self, stream: GptStream, content: str, thread_id: str,
+                          max_prompt_tokens: int | None, max_completion_tokens: int | None):
+        """ Private generator which yields text deltas of run and fills usage of given `GptStream` """
+        await self._client(thread_id).beta.threads.messages.create(
+            thread_id=thread_id,
+            role="user",
+            content=content
+        )
+
+        method = "assistant.run.stream"
+        run = None
+        run_id = None
+        first_token_at = None
+        queued_at = time.perf_counter()
+        async with self._acquire(max_prompt_tokens, max_completion_tokens) as permit:
+            sent_at = time.perf_counter()
+            try:
+                with self._span(method):
+                    async with self._client(thread_id).beta.threads.runs.stream(
+                        assistant_id=self.assistant_id,
+                        thread_id=thread_id,
+                        instructions=self.run_instructions,
+                        max_prompt_tokens=max_prompt_tokens,
+                        max_completion_tokens=max_completion_tokens
+                    ) as events:
+                        async for event in events:
+                            if event.event == "thread.run.created":
+                                run_id = event.data.id
+                            elif event.event == "thread.message.delta":
+                                for part in event.data.delta.content or ():
+                                    if part.type == "text" and part.text and part.text.value:
+                                        if first_token_at is None:
+                                            first_token_at = time.perf_counter()
+                                        yield part.text.value
+                            elif event.event in _TERMINAL_EVENTS:
+                                run = event.data
+            except (asyncio.CancelledError, GeneratorExit):
+                if run is None and run_id is not None:  # stream was abandoned, e.g. superseded by a newer request
+                    self._cancel_run(run_id, thread_id)
+                raise
+            except Exception as e:
+                if self.metrics is not None:
+                    self.metrics.count_error(method, self.assistant_id, e)
+                raise e
+
+            if permit is not None and run is not None and run.usage is not None:
+                permit.reconcile(run.usage.total_tokens)
+
+        stream.latency = time.perf_counter() - sent_at
+        if run is None:
+            stream.finish_reason = "failed"
+            return
+
+        response = self._run_response(run, stream.text)
+        stream.finish_reason = response.finish_reason
+        stream.prompt_tokens = response.prompt_tokens
+        stream.completion_tokens = response.completion_tokens
+        stream.model = response.model
+        stream.response = stream.build_response()
+        record_usage(stream.response)
+        if self.metrics is not None:
+            self.metrics.observe_queue_wait(method, sent_at - queued_at)
+            if first_token_at is not None:
+                self.metrics.observe_time_to_first_token(method, run.model, first_token_at - sent_at)
+            self.metrics.observe_response(method, run.model, stream.response)
+
+    async def _run_thread(self, max_completion_tokens, max_prompt_tokens, thread_id) -> GptResponse:
+        """ Private method which runs assistant on thread and builds `GptResponse` of the run """
+        method = "assistant.run"
+        queued_at = time.perf_counter()
+        async with self._acquire(max_prompt_tokens, max_completion_tokens) as permit:
+            sent_at = time.perf_counter()
+            try:
+                with self._span(method):
+                    run = await self._execute_run(max_completion_tokens, max_prompt_tokens, thread_id)
+                    response = await self._match_status(thread_id=thread_id, run=run)
+            except Exception as e:
+                if self.metrics is not None:
+                    self.metrics.count_error(method, self.assistant_id, e)
+                raise e
+            if permit is not None and run.usage is not None:
+                permit.reconcile(run.usage.total_tokens)
+
+        response.latency = time.perf_counter() - sent_at
+        record_usage(response)
+        if self.metrics is not None:
+            self.metrics.observe_queue_wait(method, sent_at - queued_at)
+            self.metrics.observe_response(method, run.model, response)
         return response
 
     async def _execute_run(self, max_completion_tokens, max_prompt_tokens, thread_id):
-        run = await self.client.beta.threads.runs.create_and_poll(
+        run = await self._client(thread_id).beta.threads.runs.create(
             assistant_id=self.assistant_id,
             thread_id=thread_id,
             instructions=self.run_instructions,
             max_prompt_tokens=max_prompt_tokens,
             max_completion_tokens=max_completion_tokens
         )
-        return run
+        try:
+            return await self._poll_run(run, thread_id)
+        except (asyncio.CancelledError, GptTimeoutException):
+            self._cancel_run(run.id, thread_id)  # nobody waits for the answer, stop paying for it
+            raise
+
+    async def _poll_run(self, run: Run, thread_id: str) -> Run:
+        """ Private method which polls run with delays of `poll_schedule` until it is finished """
+        delays = itertools.chain(self.poll_schedule, itertools.repeat(self.poll_schedule[-1]))
+        for delay in delays:
+            if run.status in _TERMINAL_STATUSES:
+                return run
+            remaining = remaining_time()  # deadline of `aigrammy.context.deadline_scope`, e.g. of handler
+            if remaining is not None:
+                if remaining <= 0:
+                    raise GptTimeoutException("Assistant run was not finished before deadline!")
+                delay = min(delay, remaining)
+            await asyncio.sleep(delay)
+            run = await self._client(thread_id).beta.threads.runs.retrieve(run.id, thread_id=thread_id)
+
+    def _cancel_run(self, run_id: str, thread_id: str) -> None:
+        """ Private method which cancels run in background, since the caller is being cancelled itself """
+        task = asyncio.ensure_future(self._client(thread_id).beta.threads.runs.cancel(run_id, thread_id=thread_id))
+        self._cancellations.add(task)
+        task.add_done_callback(self._cancelled_run)
+
+    def _cancelled_run(self, task: asyncio.Task) -> None:
+        self._cancellations.discard(task)
+        if not task.cancelled() and task.exception() is not None:
+            logging.warning(f"aigrammy: failed to cancel abandoned assistant run. Error: {task.exception()}")
+
+    def _span(self, method: str):
+        if self.metrics is None:
+            return nullcontext()
+        return self.metrics.span(method, assistant_id=self.assistant_id)
+
+    def _acquire(self, max_prompt_tokens: int | None, max_completion_tokens: int | None):
+        """ Private method which returns permit of `rate_limiter`, or empty context if limiter is not set """
+        if self.rate_limiter is None:
+            return nullcontext()
+        return self.rate_limiter.acquire((max_prompt_tokens or 0) + (max_completion_tokens or 0))
 
     async def _parse_answer(self, thread_id: str, run_id: str):
-        resp = await self.client.beta.threads.messages.list(
+        resp = await self._client(thread_id).beta.threads.messages.list(
             thread_id=thread_id,
             run_id=run_id
         )
@@ -131,27 +317,81 @@ class GptAssistantRepo:
             run: Run,
     ) -> GptResponse:
         """ Match-case for `run.status` """
-        answer = await self._parse_answer(thread_id=thread_id, run_id=run.id)
+        text = None
+        if run.status in ('completed', 'incomplete'):
+            answer = await self._parse_answer(thread_id=thread_id, run_id=run.id)
+            text = answer.data.pop().content.pop().text.value
+        return self._run_response(run, text)
+
+    @staticmethod
+    def _run_response(run: Run, text: str | None) -> GptResponse:
+        """ Builds `GptResponse` from finished run and its answer """
         match run.status:
             case 'completed':
-                return GptResponse(text=answer.data.pop().content.pop().text.value,
+                return GptResponse(text=text,
                                    finish_reason="end",
                                    completion_tokens=run.usage.completion_tokens,
-                                   prompt_tokens=run.usage.prompt_tokens)
+                                   prompt_tokens=run.usage.prompt_tokens,
+                                   model=run.model)
 
             case 'incomplete':
                 logging.warning("aigrammy: INCOMPLETE REQUEST DETECTED. Check reason in return value. "
                                 "`GptResponse.finish_reason`")
-                return GptResponse(text=answer.data.pop().content.pop().text.value,
+                return GptResponse(text=text,
                                    finish_reason=run.incomplete_details.reason,
                                    completion_tokens=run.usage.completion_tokens,
-                                   prompt_tokens=run.usage.prompt_tokens)
+                                   prompt_tokens=run.usage.prompt_tokens,
+                                   model=run.model)
 
             case _:
                 return GptResponse(text=None,
                                    finish_reason="failed",
-                                   completion_tokens=run.usage.completion_tokens,
-                                   prompt_tokens=run.usage.prompt_tokens)
+                                   completion_tokens=run.usage.completion_tokens if run.usage else 0,
+                                   prompt_tokens=run.usage.prompt_tokens if run.usage else 0,
+                                   model=run.model)
+
+    async def _to_data_url(self, binary_file: BinaryIO, detail: str | None = None) -> str:
+        """ Private method used to convert `io.BinaryIO` to `data:` url, using `image_preprocessor` if set """
+        if self.image_preprocessor is not None:
+            return await self.image_preprocessor.to_data_url(binary_file, detail)
+        return f"data:image/jpeg;base64,{self._encode_image(binary_file)}"
+
+    async def _upload_image_part(self, thread_id: str, binary_file: BinaryIO, detail: str,
+                                 file_unique_id: str | None) -> dict:
+        """ Private method which uploads image once and returns `image_file` content part """
+        client = self._client(thread_id)
+        # files exist only within organization of client, so ids of pooled clients are cached separately
+        prefix = f"{self.client.member_for_thread(thread_id).name}:" if isinstance(self.client, ClientPool) else ""
+        if file_unique_id is not None:
+            file_id = self.file_id_cache.get(prefix + file_unique_id)
+            if file_id is not None:
+                return {"type": "image_file", "image_file": {"file_id": file_id, "detail": detail}}
+
+        binary_file.seek(0)
+        data = binary_file.read()
+        key = file_unique_id or sha256(data).hexdigest()
+        file_id = self.file_id_cache.get(prefix + key) if file_unique_id is None else None
+        if file_id is None:
+            if self.image_preprocessor is not None:
+                mime_type, data = await self.image_preprocessor.process(data, detail)
+            else:
+                mime_type = detect_mime_type(data)
+            expires_after = self.file_id_cache.expires_after()
+            uploaded = await client.files.create(
+                file=(f"{key}.{mime_type.split('/')[-1]}", data, mime_type),
+                purpose="vision",
+                expires_after=expires_after if expires_after is not None else NOT_GIVEN
+            )
+            file_id = uploaded.id
+            self.file_id_cache.set(prefix + key, file_id)
+
+        return {"type": "image_file", "image_file": {"file_id": file_id, "detail": detail}}
+
+    def _client(self, thread_id: str) -> AsyncOpenAI:
+        """ Private method which returns client owning given thread """
+        if isinstance(self.client, ClientPool):
+            return self.client.member_for_thread(thread_id).client
+        return self.client
 
     @staticmethod
     def _encode_image(file: BinaryIO):
@@ -1,11 +1,29 @@
+import asyncio
 import logging
+import time
 
-from typing import BinaryIO
+from contextlib import nullcontext
+from typing import Awaitable, BinaryIO, Callable, Literal, Sequence
 from base64 import b64encode
-from openai import AsyncOpenAI
+from aiogram import Bot
+from aiogram.types import Message, PhotoSize
+from openai import APIConnectionError, APITimeoutError, AsyncOpenAI, InternalServerError, RateLimitError
 
-from ..exceptions import NoGptPromptSpecifiedException
+from ..batch import ChatCompletionBatch
+from ..cache import BaseCacheBackend, ImagePayloadCache, make_cache_key
+from ..context import record_usage, remaining_time
+from ..exceptions import GptTimeoutException, NoGptPromptSpecifiedException
+from ..hedging import HedgePolicy
+from ..imaging import ImagePreprocessor
+from ..memory import ConversationStore
+from ..metrics import BaseMetrics
+from ..pool import ClientPool
+from ..ratelimit import RateLimiter
+from ..semantic import SemanticCache
+from ..singleflight import SingleFlight
+from ..tokens import TokenEstimator, estimate_tokens
 from .response import GptResponse
+from .stream import GptStream
 
 
 class GptChatCompletionRepo:
@@ -15,18 +33,72 @@ class GptChatCompletionRepo:
     """
 
     def __init__(self,
-                 client: AsyncOpenAI,
+                 client: AsyncOpenAI | ClientPool,
                  model: str,
-                 system_prompt: str = ""
+                 system_prompt: str = "",
+                 cache: BaseCacheBackend | None = None,
+                 coalesce: bool = False,
+                 rate_limiter: RateLimiter | None = None,
+                 max_retries: int = 3,
+                 memory: ConversationStore | None = None,
+                 image_preprocessor: ImagePreprocessor | None = None,
+                 image_cache: ImagePayloadCache | None = None,
+                 metrics: BaseMetrics | None = None,
+                 hedge_policy: HedgePolicy | None = None,
+                 token_estimator: TokenEstimator | None = None,
+                 overflow_policy: Literal["error", "truncate"] = "error",
+                 semantic_cache: SemanticCache | None = None
                  ):
         """
-        :param client: instance of `AsyncOpenAI`
+        :param client: instance of `AsyncOpenAI`, or `aigrammy.pool.ClientPool` to balance requests between clients
         :param model: `aigrammy.models.GPT instance, or `str` according to https://platform.openai.com/docs/models
         :param system_prompt: system prompt which will be used in message generation
+        :param cache: optional response cache, e.g. `aigrammy.cache.InMemoryCache`.
+            Identical text and image url requests are answered from cache
+        :param coalesce: if `True`, concurrent identical requests share one call to OpenAI and receive the same response
+        :param rate_limiter: optional `aigrammy.ratelimit.RateLimiter`, shared between repos of the same API key.
+            Create `AsyncOpenAI(max_retries=0)` with it, so `429` retries are scheduled by the limiter.
+            With `ClientPool` the limiter follows headers and `429` of every member
+        :param max_retries: number of retries after `429 Too Many Requests`, used with `rate_limiter` or `ClientPool`
+        :param memory: optional `aigrammy.memory.ConversationStore`. Enables history of chats in `ask_text(chat_id=...)`
+        :param image_preprocessor: optional `aigrammy.imaging.ImagePreprocessor`, which downscales and recompresses
+            images of `ask_from_binaryio_image` off the event loop
+        :param image_cache: optional `aigrammy.cache.ImagePayloadCache` of prepared images, keyed by telegram
+            `file_unique_id`. Repeated images are not downloaded and encoded again
+        :param metrics: optional instrumentation hooks, e.g. `aigrammy.metrics.PrometheusMetrics`
+        :param hedge_policy: optional `aigrammy.hedging.HedgePolicy` with deadline and hedged requests
+        :param token_estimator: optional `aigrammy.tokens.TokenEstimator`. Prompt tokens are counted before sending,
+            `max_tokens` is lowered to the space left in context window, and `rate_limiter` receives exact estimate
+        :param overflow_policy: what to do with prompt which does not fit into context window, used only with
+            `token_estimator`: `error` raises `GptPromptTooLongException`, `truncate` cuts the last user message
+        :param semantic_cache: optional `aigrammy.semantic.SemanticCache`. Prompts of `ask_text` without history
+            are answered from cache when they are similar enough to an answered one
         """
         self.model = model
         self.client = client
-        self.system_prompt = system_prompt
+        self.system_prompt = system_prompt  # also builds `_prefix`
+        self.cache = cache
+        self._single_flight = SingleFlight() if coalesce else None
+        self.rate_limiter = rate_limiter
+        self.max_retries = max_retries
+        self.memory = memory
+        self.image_preprocessor = image_preprocessor
+        self.image_cache = image_cache
+        self.metrics = metrics
+        self.hedge_policy = hedge_policy
+        self.token_estimator = token_estimator
+        self.overflow_policy = overflow_policy
+        self.semantic_cache = semantic_cache
+
+    @property
+    def system_prompt(self) -> str:
+        return self._system_prompt
+
+    @system_prompt.setter
+    def system_prompt(self, system_prompt: str) -> None:
+        # prefix is built once and shared by all requests, so it is byte-identical and cached by OpenAI prompt caching
+        self._system_prompt = system_prompt
+        self._prefix = ({"role": "system", "content": f"System instructions: {system_prompt}"},)
 
     def setup_logging(self, log_level=logging.INFO) -> None:
         """
@@ -41,42 +113,37 @@ class GptChatCompletionRepo:
     async def ask_text(
             self,
             prompt: str,
-            max_tokens=1000
+            max_tokens=1000,
+            chat_id: int | None = None
     ) -> GptResponse:
         """ Sends message to ChatGPT with given prompt.
         :param prompt: Given prompt
         :param max_tokens: Maximum number of tokens which ChatGPT can generate, `default=1000`
+        :param chat_id: id of telegram chat. If repo has `memory`, history of this chat is sent and updated
 
         :return: Returns the `aiogpt.models.GptResponse` instance
         """
         if not prompt:
             raise NoGptPromptSpecifiedException("Given prompt is `empty` or `None`!")
 
-        response = await self.client.chat.completions.create(
-            model=self.model,
-            messages=[
-                {
-                    "role": "system",
-                    "content": f"System instructions: {self.system_prompt}"
-                },
-                {
-                    "role": "user",
-                    "content": prompt
-                }
-            ],
-            max_tokens=max_tokens,
-        )
-
-        return GptResponse(text=response.choices[0].message.content,
-                           finish_reason=response.choices[0].finish_reason,
-                           completion_tokens=response.usage.completion_tokens,
-                           prompt_tokens=response.usage.prompt_tokens)
+        messages = self._text_messages(prompt, chat_id)
+        if len(messages) > 2:  # answers depending on history can not be shared between chats
+            response = await self._complete(messages, max_tokens)
+        elif self.semantic_cache is None:
+            request_key = make_cache_key(self.model, self.system_prompt, prompt, max_tokens)
+            response = await self._complete(messages, max_tokens, request_key=request_key)
+        else:
+            response = await self._complete_semantic(prompt, messages, max_tokens)
+
+        self._remember(chat_id, prompt, response.text)
+        return response
 
     async def ask_from_binaryio_image(
             self,
             binary_file: BinaryIO,
             max_tokens=500,
-            content: str = "(no additional info was specified)"
+            content: str = "(no additional info was specified)",
+            file_unique_id: str | None = None
     ) -> GptResponse:
         """
         Sends message to ChatGPT with given image in `BinaryIO` format, as well as certain given prompt.
@@ -85,85 +152,187 @@ class GptChatCompletionRepo:
             How to use: https://docs.aiogram.dev/en/latest/api/download_file.html#download-file-to-binary-i-o-object
         :param max_tokens: Maximum number of tokens which ChatGPT can generate, `default=500`
         :param content: prompt which will be sent with given image
+        :param file_unique_id: telegram `file_unique_id` of image. Enables `cache` and `image_cache` for this image
 
         :return: Returns the `aiogpt.models.GptResponse` instance
         """
-        try:
-            b64_str = self._encode_image(binary_file)
-        except Exception as e:
-            logging.exception(f"Failed to convert BinaryIO to b64 while sending image to OpenAI. Error: {e}")
-            binary_file.close()
-            raise e  # try-except used here to close the binary file and avoid potential memory leak
-
-        img_url = f"data:image/jpeg;base64,{b64_str}"
-        response = await self.client.chat.completions.create(
-            model=self.model,
-            messages=[
-                {
-                    "role": "system",
-                    "content": f"System instructions: {self.system_prompt}"
-                },
-                {
-                    "role": "user",
-                    "content": [
-                        {
-                            "type": "text",
-                            "text": content
-                        },
-                        {
-                            "type": "image_url",
-                            "image_url": {
-                                "url": img_url,
-                            },
-                        },
-                    ],
-                }
-            ],
-            max_tokens=max_tokens,
-        )
+        request_key = None
+        if file_unique_id is not None:
+            request_key = make_cache_key(self.model, self.system_prompt, content, max_tokens, image=file_unique_id)
+            cached = await self._cached(request_key)
+            if cached is not None:
+                binary_file.close()
+                return cached
 
+        img_url = self._cached_image(file_unique_id)
+        if img_url is None:
+            try:
+                img_url = await self._to_data_url(binary_file)
+            except Exception as e:
+                logging.exception(f"Failed to convert BinaryIO to b64 while sending image to OpenAI. Error: {e}")
+                binary_file.close()
+                raise e  # try-except used here to close the binary file and avoid potential memory leak
+            self._cache_image(file_unique_id, img_url)
         binary_file.close()
-        return GptResponse(text=response.choices[0].message.content,
-                           finish_reason=response.choices[0].finish_reason,
-                           completion_tokens=response.usage.completion_tokens,
-                           prompt_tokens=response.usage.prompt_tokens)
+
+        messages = self._image_messages(content, img_url)
+        if request_key is None:
+            return await self._request(messages, max_tokens)
+        return await self._shared(request_key, lambda: self._request(messages, max_tokens, request_key))
 
     async def ask_telegram_image_url(
             self,
             uri: str,
             max_tokens=500,
+            content: str = "(no additional info was specified)",
+            file_unique_id: str | None = None
+    ) -> GptResponse:
+        """
+        Sends message to ChatGPT with image from given url, e.g. link to telegram file
+        :param uri: url of image, which OpenAI can download
+        :param max_tokens: Maximum number of tokens which ChatGPT can generate, `default=500`
+        :param content: prompt which will be sent with given image
+        :param file_unique_id: telegram `file_unique_id` of image. Used as cache key instead of `uri`
+
+        :return: Returns the `aiogpt.models.GptResponse` instance
+        """
+        messages = self._image_messages(content, uri)
+        request_key = make_cache_key(self.model, self.system_prompt, content, max_tokens,
+                                     image=file_unique_id or uri)
+        return await self._complete(messages, max_tokens, request_key=request_key)
+
+    async def ask_telegram_photo(
+            self,
+            bot: Bot,
+            photo: PhotoSize,
+            max_tokens=500,
             content: str = "(no additional info was specified)"
     ) -> GptResponse:
-        response = await self.client.chat.completions.create(
-            model=self.model,
-            messages=[
-                {
-                    "role": "system",
-                    "content": f"System instructions: {self.system_prompt}"
-                },
-                {
-                    "role": "user",
-                    "content": [
-                        {
-                            "type": "text",
-                            "text": content
-                        },
-                        {
-                            "type": "image_url",
-                            "image_url": {
-                                "url": uri,
-                            },
-                        },
-                    ],
-                }
-            ],
-            max_tokens=max_tokens,
-        )
+        """
+        Sends message to ChatGPT with given telegram photo. Photo is downloaded only if
+        neither answer nor prepared image are cached for its `file_unique_id`
+        :param bot: instance of `aiogram.Bot`, used to download photo
+        :param photo: photo to send, e.g. `message.photo[-1]`
+        :param max_tokens: Maximum number of tokens which ChatGPT can generate, `default=500`
+        :param content: prompt which will be sent with given image
+
+        :return: Returns the `aiogpt.models.GptResponse` instance
+        """
+        request_key = make_cache_key(self.model, self.system_prompt, content, max_tokens,
+                                     image=photo.file_unique_id)
+        cached = await self._cached(request_key)
+        if cached is not None:
+            return cached
+
+        async def download_and_ask() -> GptResponse:
+            messages = self._image_messages(content, await self._photo_data_url(bot, photo))
+            return await self._request(messages, max_tokens, request_key)
+
+        return await self._shared(request_key, download_and_ask)
+
+    async def ask_multipart(
+            self,
+            texts: Sequence[str],
+            image_urls: Sequence[str] = (),
+            max_tokens=1000,
+            chat_id: int | None = None
+    ) -> GptResponse:
+        """
+        Sends several texts and images to ChatGPT as one message, e.g. question split into a few telegram messages
+        :param texts: parts of prompt, joined by new lines
+        :param image_urls: urls or `data:` urls of images
+        :param max_tokens: Maximum number of tokens which ChatGPT can generate, `default=1000`
+        :param chat_id: id of telegram chat. If repo has `memory`, history of this chat is sent and updated
+
+        :return: Returns the `aiogpt.models.GptResponse` instance
+        """
+        prompt = "\n".join(text for text in texts if text)
+        if not image_urls:
+            return await self.ask_text(prompt, max_tokens=max_tokens, chat_id=chat_id)
+
+        messages = self._text_messages(prompt or "(no additional info was specified)", chat_id)
+        messages[-1] = {
+            "role": "user",
+            "content": [
+                *({"type": "image_url", "image_url": {"url": url}} for url in image_urls),
+                {"type": "text", "text": messages[-1]["content"]},
+            ]
+        }
+        response = await self._complete(messages, max_tokens)
+        self._remember(chat_id, prompt, response.text)
+        return response
+
+    async def ask_telegram_messages(
+            self,
+            bot: Bot,
+            messages: Sequence[Message],
+            max_tokens=1000,
+            chat_id: int | None = None
+    ) -> GptResponse:
+        """
+        Sends texts, captions and photos of several telegram messages as one request,
+        e.g. burst collected by `aigrammy.middleware.MessageBurstMiddleware`. Photos are downloaded concurrently
+        :param bot: instance of `aiogram.Bot`, used to download photos
+        :param messages: telegram messages in order of sending
+        :param max_tokens: Maximum number of tokens which ChatGPT can generate, `default=1000`
+        :param chat_id: id of telegram chat. If repo has `memory`, history of this chat is sent and updated
+
+        :return: Returns the `aiogpt.models.GptResponse` instance
+        """
+        texts = [message.text or message.caption for message in messages if message.text or message.caption]
+        photos = [message.photo[-1] for message in messages if message.photo]
+        if not texts and not photos:
+            raise NoGptPromptSpecifiedException("Given messages have neither text nor photos!")
+
+        image_urls = await asyncio.gather(*(self._photo_data_url(bot, photo) for photo in photos))
+        return await self.ask_multipart(texts, image_urls, max_tokens=max_tokens, chat_id=chat_id)
+
+    def stream_text(
+            self,
+            prompt: str,
+            max_tokens=1000,
+            chat_id: int | None = None
+    ) -> GptStream:
+        """ Streams answer of ChatGPT for given prompt. Request is sent on first iteration.
+        :param prompt: Given prompt
+        :param max_tokens: Maximum number of tokens which ChatGPT can generate, `default=1000`
+        :param chat_id: id of telegram chat. If repo has `memory`, history of this chat is sent and updated
+
+        :return: Returns the `aigrammy.types.stream.GptStream` instance
+        """
+        if not prompt:
+            raise NoGptPromptSpecifiedException("Given prompt is `empty` or `None`!")
+
+        messages = self._text_messages(prompt, chat_id)
+        return GptStream(lambda stream: self._stream_chunks(stream, messages, max_tokens,
+                                                            chat_id=chat_id, prompt=prompt))
+
+    def stream_telegram_image_url(
+            self,
+            uri: str,
+            max_tokens=500,
+            content: str = "(no additional info was specified)"
+    ) -> GptStream:
+        """ Streaming variant of `ask_telegram_image_url` """
+        messages = self._image_messages(content, uri)
+        return GptStream(lambda stream: self._stream_chunks(stream, messages, max_tokens))
 
-        return GptResponse(text=response.choices[0].message.content,
-                           finish_reason=response.choices[0].finish_reason,
-                           completion_tokens=response.usage.completion_tokens,
-                           prompt_tokens=response.usage.prompt_tokens)
+    def batch(self,
+              completion_window: str = "24h",
+              poll_interval: float = 60.0,
+              path: str | None = None,
+              metadata: dict[str, str] | None = None) -> ChatCompletionBatch:
+        """
+        Creates batch of requests for OpenAI Batch API, for non-urgent bulk work like nightly summaries.
+        Batched requests bypass `rate_limiter`, `cache` and `memory`
+        :param completion_window: time in which OpenAI completes batch
+        :param poll_interval: seconds between checks of batch status
+        :param path: optional path where submitted JSONL file is kept
+        :param metadata: optional metadata of batch
+
+        :return: Returns the `aigrammy.batch.ChatCompletionBatch` instance
+        """
+        return ChatCompletionBatch(self, completion_window, poll_interval, path, metadata)
 
     def change_model(self, new_model: str):
         """ Changes the default model of ChatGPT"""
@@ -172,8 +341,368 @@ class GptChatCompletionRepo:
 
         logging.warning(f"Changed `ChatCompletionRepo.model` from {old_model} to {new_model}")
 
+    async def _complete(self, messages: list, max_tokens: int, request_key: str | None = None) -> GptResponse:
+        """
+        Private method which sends given messages to ChatGPT.
+        Requests with `request_key` are answered from cache and coalesced when enabled
+        """
+        if request_key is None:
+            return await self._request(messages, max_tokens)
+
+        cached = await self._cached(request_key)
+        if cached is not None:
+            return cached
+        return await self._shared(request_key, lambda: self._request(messages, max_tokens, request_key))
+
+    async def _complete_semantic(self, prompt: str, messages: list, max_tokens: int) -> GptResponse:
+        """ Private method which answers prompt from exact cache, then from `semantic_cache`, then from ChatGPT """
+        request_key = make_cache_key(self.model, self.system_prompt, prompt, max_tokens)
+        cached = await self._cached(request_key)
+        if cached is not None:
+            return cached
+
+        scope = make_cache_key(self.model, self.system_prompt, "", max_tokens)
+        try:
+            similar, embedding = await self.semantic_cache.lookup(scope, prompt)
+        except Exception as e:  # cache is an optimization, its failure must not fail the request
+            logging.warning(f"aigrammy: semantic cache lookup failed. Error: {e}")
+            similar, embedding = None, None
+        if similar is not None:
+            return self._cached_copy(similar)
+
+        response = await self._shared(request_key, lambda: self._request(messages, max_tokens, request_key))
+        if embedding is not None and not response.cached and response.finish_reason == "stop":
+            self.semantic_cache.store(scope, embedding, response)
+        return response
+
+    async def _cached(self, request_key: str) -> GptResponse | None:
+        """ Private method which returns copy of cached response flagged as `cached` """
+        if self.cache is None:
+            return None
+
+        cached = await self.cache.get(request_key)
+        if cached is None:
+            return None
+        return self._cached_copy(cached)
+
+    @staticmethod
+    def _cached_copy(cached: GptResponse) -> GptResponse:
+        return GptResponse(text=cached.text,
+                           finish_reason=cached.finish_reason,
+                           completion_tokens=cached.completion_tokens,
+                           prompt_tokens=cached.prompt_tokens,
+                           cached_tokens=cached.cached_tokens,
+                           cached=True,
+                           model=cached.model)
+
+    async def _shared(self, request_key: str, factory: Callable[[], Awaitable[GptResponse]]) -> GptResponse:
+        """ Private method which coalesces identical concurrent requests if enabled """
+        if self._single_flight is None:
+            return await factory()
+        return await self._single_flight.do(request_key, factory)
+
+    async def _request(self, messages: list, max_tokens: int, request_key: str | None = None) -> GptResponse:
+        if self.hedge_policy is None:
+            result = await self._call(self.model, messages, max_tokens)
+        else:
+            result = await self._hedged_call(messages, max_tokens)
+
+        if self.cache is not None and request_key is not None and result.finish_reason == "stop":
+            await self.cache.set(request_key, result)
+        return result
+
+    async def _hedged_call(self, messages: list, max_tokens: int) -> GptResponse:
+        """ Private method which sends request with deadline and hedged duplicate according to `hedge_policy` """
+        policy = self.hedge_policy
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + policy.deadline if policy.deadline is not None else None
+        remaining = remaining_time()
+        if remaining is not None:  # deadline of `aigrammy.context.deadline_scope`, e.g. of handler
+            deadline = min(deadline, loop.time() + remaining) if deadline is not None else loop.time() + remaining
+        primary_sent: list[float] = []
+        primary = asyncio.ensure_future(self._call(self.model, messages, max_tokens, primary_sent))
+        pending = {primary}
+        error = None
+        try:
+            hedge_delay = policy.delay()
+            if hedge_delay is not None:
+                if deadline is not None:
+                    hedge_delay = min(hedge_delay, deadline - loop.time())
+                done, _ = await asyncio.wait(pending, timeout=hedge_delay)
+                if not done:
+                    logging.info(f"aigrammy: no answer after {hedge_delay:.2f}s, sending hedged request")
+                    hedge_model = policy.hedge_model or self.model
+                    pending.add(asyncio.ensure_future(self._call(hedge_model, messages, max_tokens)))
+
+            while pending:
+                timeout = deadline - loop.time() if deadline is not None else None
+                done, pending = await asyncio.wait(pending, timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+                if not done:
+                    raise GptTimeoutException("No answer from ChatGPT before deadline!")
+
+                for task in done:
+                    if task.exception() is None:
+                        result = task.result()
+                        if task is primary:
+                            policy.observe(result.latency)
+                        elif primary_sent and not primary.done():  # primary is cancelled, its latency is at least this
+                            policy.observe(time.perf_counter() - primary_sent[0])
+                        return result
+                    error = task.exception()
+            raise error
+        finally:
+            for task in pending:
+                task.cancel()
+
+    async def _call(self, model: str, messages: list, max_tokens: int, sent: list[float] | None = None) -> GptResponse:
+        """
+        Private method which performs one upstream call to given model.
+        Time of sending is appended to optional `sent`, so hedging knows how long the call has been in flight
+        """
+        messages, max_tokens, prompt_tokens = self._fit(model, messages, max_tokens)
+        queued_at = time.perf_counter()
+        async with self._acquire(messages, max_tokens, prompt_tokens) as permit:
+            sent_at = time.perf_counter()
+            if sent is not None:
+                sent.append(sent_at)
+            try:
+                with self._span("chat.completions", model):
+                    response = await self._create(
+                        model=model,
+                        messages=messages,
+                        max_tokens=max_tokens,
+                    )
+            except Exception as e:
+                if self.metrics is not None:
+                    self.metrics.count_error("chat.completions", model, e)
+                raise e
+            if permit is not None:
+                permit.reconcile(response.usage.total_tokens)
+
+        result = GptResponse(text=response.choices[0].message.content,
+                             finish_reason=response.choices[0].finish_reason,
+                             completion_tokens=response.usage.completion_tokens,
+                             prompt_tokens=response.usage.prompt_tokens,
+                             cached_tokens=_cached_tokens(response.usage),
+                             latency=time.perf_counter() - sent_at,
+                             model=response.model)
+        record_usage(result)
+        if self.metrics is not None:
+            self.metrics.observe_queue_wait("chat.completions", sent_at - queued_at)
+            self.metrics.observe_response("chat.completions", model, result)
+        return result
+
+    async def _stream_chunks(self, stream: GptStream, messages: list, max_tokens: int,
+                             chat_id: int | None = None, prompt: str | None = None):
+        """ Private generator which yields text deltas and fills usage of given `GptStream` """
+        method = "chat.completions.stream"
+        messages, max_tokens, prompt_tokens = self._fit(self.model, messages, max_tokens)
+        queued_at = time.perf_counter()
+        async with self._acquire(messages, max_tokens, prompt_tokens) as permit:
+            sent_at = time.perf_counter()
+            first_token_at = None
+            try:
+                with self._span(method, self.model):
+                    response = await self._create(
+                        model=self.model,
+                        messages=messages,
+                        max_tokens=max_tokens,
+                        stream=True,
+                        stream_options={"include_usage": True},
+                    )
+
+                    async with response:
+                        async for chunk in response:
+                            stream.model = chunk.model
+                            if chunk.usage is not None:  # usage is sent in the last chunk with empty `choices`
+                                stream.prompt_tokens = chunk.usage.prompt_tokens
+                                stream.completion_tokens = chunk.usage.completion_tokens
+                                stream.cached_tokens = _cached_tokens(chunk.usage)
+                            if not chunk.choices:
+                                continue
+
+                            choice = chunk.choices[0]
+                            if choice.finish_reason is not None:
+                                stream.finish_reason = choice.finish_reason
+                            if choice.delta.content:
+                                if first_token_at is None:
+                                    first_token_at = time.perf_counter()
+                                yield choice.delta.content
+            except Exception as e:
+                if self.metrics is not None:
+                    self.metrics.count_error(method, self.model, e)
+                raise e
+
+            if permit is not None:
+                permit.reconcile(stream.prompt_tokens + stream.completion_tokens)
+
+        stream.latency = time.perf_counter() - sent_at
+        stream.response = stream.build_response()
+        record_usage(stream.response)
+        if self.metrics is not None:
+            self.metrics.observe_queue_wait(method, sent_at - queued_at)
+            if first_token_at is not None:
+                self.metrics.observe_time_to_first_token(method, self.model, first_token_at - sent_at)
+            self.metrics.observe_response(method, self.model, stream.response)
+        self._remember(chat_id, prompt, stream.text)
+
+    def _text_messages(self, prompt: str, chat_id: int | None = None) -> list:
+        """ Private method which builds messages of text request, including history of chat if available """
+        history = []
+        if self.memory is not None and chat_id is not None:
+            history = self.memory.messages(chat_id)
+
+        return [
+            *self._prefix,
+            *history,
+            {
+                "role": "user",
+                "content": prompt
+            }
+        ]
+
+    def _image_messages(self, content: str, img_url: str) -> list:
+        """
+        Private method which builds messages of request with image.
+        Image goes before text, so questions about the same image share a longer cached prefix
+        """
+        return [
+            *self._prefix,
+            {
+                "role": "user",
+                "content": [
+                    {
+                        "type": "image_url",
+                        "image_url": {
+                            "url": img_url,
+                        },
+                    },
+                    {
+                        "type": "text",
+                        "text": content
+                    },
+                ],
+            }
+        ]
+
+    def _remember(self, chat_id: int | None, prompt: str, answer: str | None) -> None:
+        if self.memory is not None and chat_id is not None and answer:
+            self.memory.add_exchange(chat_id, prompt, answer)
+
+    def _span(self, method: str, model: str):
+        if self.metrics is None:
+            return nullcontext()
+        return self.metrics.span(method, model=model)
+
+    def _fit(self, model: str, messages: list, max_tokens: int) -> tuple[list, int, int | None]:
+        """ Private method which fits request into context window of model if `token_estimator` is set """
+        if self.token_estimator is None:
+            return messages, max_tokens, None
+        return self.token_estimator.fit(messages, max_tokens, model, policy=self.overflow_policy)
+
+    def _acquire(self, messages: list, max_tokens: int, prompt_tokens: int | None = None):
+        """ Private method which returns permit of `rate_limiter`, or empty context if limiter is not set """
+        if self.rate_limiter is None:
+            return nullcontext()
+        if prompt_tokens is None:
+            prompt_tokens = estimate_tokens(messages)
+        return self.rate_limiter.acquire(prompt_tokens + max_tokens)
+
+    async def _create(self, **kwargs):
+        """
+        Private method which creates chat completion on client (or the best member of `ClientPool`),
+        retrying `429` according to `rate_limiter` and pool health
+        """
+        remaining = remaining_time()
+        if remaining is not None:  # deadline of `aigrammy.context.deadline_scope` limits the call itself
+            if remaining <= 0:
+                raise GptTimeoutException("Deadline of request has passed before it was sent!")
+            kwargs["timeout"] = remaining
+
+        pool = self.client if isinstance(self.client, ClientPool) else None
+        if self.rate_limiter is None and pool is None:
+            return await self.client.chat.completions.create(**kwargs)
+
+        for attempt in range(self.max_retries + 1):
+            member = pool.pick() if pool is not None else None
+            if member is not None and not member.healthy:  # all members are ejected, wait for the soonest one
+                wait = member.ejected_until - time.monotonic()
+                remaining = remaining_time()
+                if remaining is not None:
+                    if remaining <= wait:
+                        raise GptTimeoutException("Deadline of request passes before any member of pool is resumed!")
+                    kwargs["timeout"] = remaining - wait
+                await asyncio.sleep(wait)
+            client = member.client if member is not None else self.client
+            started_at = time.perf_counter()
+            try:
+                if member is not None:
+                    member.in_flight += 1
+                raw = await client.chat.completions.with_raw_response.create(**kwargs)
+            except RateLimitError as e:
+                if member is not None:  # member is ejected, so the retry is served by another one
+                    pool.report_failure(member, e, e.response.headers)
+                if self.rate_limiter is not None:
+                    self.rate_limiter.update_from_headers(e.response.headers, rate_limited=True)
+                if attempt == self.max_retries:
+                    raise e
+                logging.warning(f"aigrammy: rate limited by OpenAI, retry {attempt + 1}/{self.max_retries}")
+                if self.rate_limiter is not None:
+                    await self.rate_limiter.wait_resumed()
+                continue
+            except APITimeoutError as e:
+                raise e  # own deadline, not a failure of member
+            except (APIConnectionError, InternalServerError) as e:
+                if member is not None:
+                    pool.report_failure(member, e)
+                raise e
+            finally:
+                if member is not None:
+                    member.in_flight -= 1
+
+            if member is not None:
+                pool.report_success(member, time.perf_counter() - started_at, raw.headers)
+            if self.rate_limiter is not None:
+                self.rate_limiter.update_from_headers(raw.headers)
+            return raw.parse()
+
+    async def _to_data_url(self, binary_file: BinaryIO) -> str:
+        """ Private method used to convert `io.BinaryIO` to `data:` url, using `image_preprocessor` if set """
+        if self.image_preprocessor is not None:
+            return await self.image_preprocessor.to_data_url(binary_file)
+        return f"data:image/jpeg;base64,{self._encode_image(binary_file)}"
+
+    async def _photo_data_url(self, bot: Bot, photo: PhotoSize) -> str:
+        """ Private method which downloads telegram photo as `data:` url, unless it is in `image_cache` """
+        img_url = self._cached_image(photo.file_unique_id)
+        if img_url is None:
+            binary_file = await bot.download(photo)
+            try:
+                img_url = await self._to_data_url(binary_file)
+            finally:
+                binary_file.close()
+            self._cache_image(photo.file_unique_id, img_url)
+        return img_url
+
+    def _cached_image(self, file_unique_id: str | None) -> str | None:
+        if self.image_cache is None or file_unique_id is None:
+            return None
+        return self.image_cache.get(file_unique_id)
+
+    def _cache_image(self, file_unique_id: str | None, img_url: str) -> None:
+        if self.image_cache is not None and file_unique_id is not None:
+            self.image_cache.set(file_unique_id, img_url)
+
     @staticmethod
     def _encode_image(file: BinaryIO):
         """ Private method used to convert `io.BinaryIO` to b64 string """
         file.seek(0)
         return b64encode(file.read()).decode('utf-8')
+
+
+def _cached_tokens(usage) -> int:
+    """ Returns prompt tokens served from OpenAI prompt cache, reported only by newer models """
+    details = getattr(usage, "prompt_tokens_details", None)
+    if details is None or details.cached_tokens is None:
+        return 0
+    return details.cached_tokens
@@ -3,10 +3,35 @@ class GptResponse:
                  text: str,
                  finish_reason: str,
                  prompt_tokens: int = 0,
-                 completion_tokens: int = 0
+                 completion_tokens: int = 0,
+                 cached_tokens: int = 0,
+                 cached: bool = False,
+                 latency: float | None = None,
+                 model: str | None = None
                  ):
         self.text = text
         self.finish_reason = finish_reason
         self.completion_tokens = completion_tokens
         self.prompt_tokens = prompt_tokens
         self.total_tokens_used = prompt_tokens + completion_tokens
+        self.cached_tokens = cached_tokens  # part of `prompt_tokens` served from OpenAI prompt cache
+        self.cached = cached  # `True` if response was taken from cache and no tokens were consumed
+        self.latency = latency  # seconds spent on upstream call, `None` for cached responses
+        self.model = model  # model which actually answered, e.g. hedge model of `aigrammy.hedging.HedgePolicy`
+
+    def to_dict(self) -> dict:
+        """ Returns JSON serializable fields of response, e.g. to store it outside of process """
+        return {
+            "text": self.text,
+            "finish_reason": self.finish_reason,
+            "prompt_tokens": self.prompt_tokens,
+            "completion_tokens": self.completion_tokens,
+            "cached_tokens": self.cached_tokens,
+            "cached": self.cached,
+            "latency": self.latency,
+            "model": self.model,
+        }
+
+    @classmethod
+    def from_dict(cls, data: dict) -> "GptResponse":
+        return cls(**data)
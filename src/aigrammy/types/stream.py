@@ -0,0 +1,68 @@
+from typing import AsyncIterator, Callable
+
+from .response import GptResponse
+
+
+class GptStream:
+    """
+    Asynchronous iterator over text deltas of a streamed ChatGPT answer.\n
+    Use `async for delta in stream` to receive text as it arrives.
+    Once the stream is exhausted, final `GptResponse` is available in `GptStream.response`
+    """
+
+    def __init__(self, source: Callable[["GptStream"], AsyncIterator[str]]):
+        """
+        :param source: factory of async generator which yields text deltas.
+            Generator receives the stream itself, so it can fill `finish_reason` and token usage
+        """
+        self._source = source(self)
+        self._chunks: list[str] = []
+        self.finish_reason: str | None = None
+        self.prompt_tokens = 0
+        self.completion_tokens = 0
+        self.cached_tokens = 0
+        self.latency: float | None = None
+        self.model: str | None = None
+        self.response: GptResponse | None = None
+
+    @property
+    def text(self) -> str:
+        """ Text received so far """
+        return "".join(self._chunks)
+
+    def __aiter__(self) -> "GptStream":
+        return self
+
+    async def __anext__(self) -> str:
+        if self.response is not None:
+            raise StopAsyncIteration
+
+        try:
+            delta = await self._source.__anext__()
+        except StopAsyncIteration:
+            if self.response is None:  # source may build the response itself when it is finished
+                self.response = self.build_response()
+            raise
+
+        self._chunks.append(delta)
+        return delta
+
+    def build_response(self) -> GptResponse:
+        """ Builds `GptResponse` from text and usage received so far """
+        return GptResponse(text=self.text,
+                           finish_reason=self.finish_reason,
+                           completion_tokens=self.completion_tokens,
+                           prompt_tokens=self.prompt_tokens,
+                           cached_tokens=self.cached_tokens,
+                           latency=self.latency,
+                           model=self.model)
+
+    async def get_response(self) -> GptResponse:
+        """ Consumes the rest of the stream and returns final `GptResponse` """
+        async for _ in self:
+            pass
+        return self.response
+
+    async def aclose(self) -> None:
+        """ Stops the stream and closes underlying connection """
+        await self._source.aclose()